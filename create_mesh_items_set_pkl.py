@@ -14,6 +14,10 @@ Load the pickle file like this:
 
 and check to see if a QID is in the set like: 'Q42' in mesh_trms
 
+wd_search.py no longer uses the pickle file; it looks items up in a
+memory-mapped index built from mesh_items.txt by property_index.py (see
+INFERRED_TYPES in wd_search_config.yml).
+
 """
 
 import pickle
@@ -0,0 +1,198 @@
+"""
+
+A store of the vectors wd_search.py compares with a mention's context,
+one per item, so popular items (countries, WHO, COVID-19, ...) are
+embedded once rather than once per mention and process.  Set
+
+  EMBEDDING_STORE: 'embedding_store'
+
+in wd_search_config.yml to use one.  It's a directory with
+
+  vectors.f16  float16 vectors, one row per item, appended as items are scored
+  ids.i64      the integer id (see wd_ids.py) of each row
+  index_*.npy  sorted ids and their rows for the rows when it was last compacted
+  meta.json    the language model the vectors came from and their dimension
+
+vectors.f16 and the index are memory mapped, so processes using the same
+store share its pages.  Rows added since the index was compacted are
+read from ids.i64 as needed.  Processes append to it under a lock on the
+file lock, and an id's vector is found once its id is written, which is
+done after the vector.  Prefill a store for the items in a file of ids,
+one per line, with
+
+  python embedding_store.py embedding_store qids.txt
+
+which gets their labels and descriptions and embeds them as wd_search
+does, with item_texts, and then compacts the index.
+
+"""
+
+import os
+import json
+import threading
+import argparse as ap
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:   # no file locking on windows
+    fcntl = None
+
+from wd_ids import qid2int, is_entity_id
+
+class EmbeddingStore:
+
+    def __init__(self, path, model=None):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.meta = self.read_meta()
+        if model and self.meta.get('model') not in (None, model):
+            raise ValueError(f"{path} has vectors from the {self.meta['model']} model, not {model}")
+        self.meta.setdefault('model', model)
+        self.lock = threading.Lock()
+        self.load_index()
+
+    def file(self, name):
+        return os.path.join(self.path, name)
+
+    def read_meta(self):
+        if os.path.exists(self.file('meta.json')):
+            with open(self.file('meta.json')) as f:
+                return json.load(f)
+        return {}
+
+    def load_index(self):
+        """ map the compacted index and read the rows added after it """
+        if os.path.exists(self.file('index_ids.npy')):
+            self.index_ids = np.load(self.file('index_ids.npy'), mmap_mode='r')
+            self.index_rows = np.load(self.file('index_rows.npy'), mmap_mode='r')
+        else:
+            self.index_ids = self.index_rows = np.zeros(0, dtype=np.int64)
+        self.tail = {}     # id => row for the rows after the index
+        self.rows = self.meta.get('indexed_rows', 0)
+        self.vectors = None
+        self.read_tail()
+
+    def read_tail(self):
+        """ add the ids of rows appended since we last looked to tail """
+        if not os.path.exists(self.file('ids.i64')):
+            return
+        rows = os.path.getsize(self.file('ids.i64')) // 8
+        if rows > self.rows:
+            ids = np.fromfile(self.file('ids.i64'), dtype=np.int64, count=rows - self.rows, offset=self.rows * 8)
+            for row, n in enumerate(ids.tolist(), self.rows):
+                self.tail[n] = row
+            self.rows = rows
+            if not self.meta.get('dim'):
+                self.meta = self.read_meta()
+
+    def row(self, n):
+        """ the row of the integer id n or None """
+        row = self.tail.get(n)
+        if row is None and len(self.index_ids):
+            i = int(np.searchsorted(self.index_ids, n))
+            if i < len(self.index_ids) and self.index_ids[i] == n:
+                row = int(self.index_rows[i])
+        return row
+
+    def matrix(self):
+        """ the memory mapped vectors, remapped when rows have been added """
+        if self.vectors is None or len(self.vectors) < self.rows:
+            self.vectors = np.memmap(self.file('vectors.f16'), dtype=np.float16, mode='r',
+                                     shape=(self.rows, self.meta['dim']))
+        return self.vectors
+
+    def get_many(self, qids):
+        """ returns a dict mapping the qids in the store to their vectors as float32 arrays """
+        with self.lock:
+            rows = {qid: self.row(qid2int(qid)) for qid in qids if is_entity_id(qid)}
+            if None in rows.values():
+                self.read_tail()    # other processes may have added them
+                rows = {qid: self.row(qid2int(qid)) for qid in rows}
+            rows = {qid: row for qid, row in rows.items() if row is not None}
+            if not rows:
+                return {}
+            vectors = self.matrix()
+            return {qid: np.asarray(vectors[row], dtype=np.float32) for qid, row in rows.items()}
+
+    def put_many(self, qids, vectors):
+        """ append the vectors of the qids not already in the store """
+        vectors = np.asarray(vectors, dtype=np.float16)
+        with self.lock, open(self.file('lock'), 'a') as lock:
+            if fcntl:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            self.read_tail()
+            if not self.meta.get('dim'):
+                self.meta['dim'] = vectors.shape[1]
+                self.write_meta()
+            if vectors.shape[1] != self.meta['dim']:
+                raise ValueError(f"vectors of length {vectors.shape[1]} can't go in {self.path}, which has ones of length {self.meta['dim']}")
+            new = {}
+            for qid, vector in zip(qids, vectors):
+                if is_entity_id(qid) and self.row(qid2int(qid)) is None:
+                    new[qid2int(qid)] = vector
+            if not new:
+                return 0
+            # write the vectors before the ids so readers that see an id can read its vector
+            with open(self.file('vectors.f16'), 'r+b' if os.path.exists(self.file('vectors.f16')) else 'wb') as f:
+                f.seek(self.rows * self.meta['dim'] * 2)
+                f.write(np.array(list(new.values()), dtype=np.float16).tobytes())
+            with open(self.file('ids.i64'), 'ab') as f:
+                f.write(np.array(list(new), dtype=np.int64).tobytes())
+            self.read_tail()
+            return len(new)
+
+    def write_meta(self):
+        with open(self.file('meta.json.tmp'), 'w') as f:
+            json.dump(self.meta, f)
+        os.replace(self.file('meta.json.tmp'), self.file('meta.json'))
+
+    def compact(self):
+        """ rewrite the index to cover all of the rows, so processes share it rather than each reading them """
+        with self.lock, open(self.file('lock'), 'a') as lock:
+            if fcntl:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            ids = np.fromfile(self.file('ids.i64'), dtype=np.int64) if os.path.exists(self.file('ids.i64')) else np.zeros(0, dtype=np.int64)
+            ids, rows = np.unique(ids, return_index=True)
+            for name, array in (('index_ids', ids), ('index_rows', rows.astype(np.int64))):
+                np.save(self.file(name + '.tmp.npy'), array)
+                os.replace(self.file(name + '.tmp.npy'), self.file(name + '.npy'))
+            self.meta['indexed_rows'] = int(os.path.getsize(self.file('ids.i64')) // 8) if len(ids) else 0
+            self.write_meta()
+            self.load_index()
+            return len(ids)
+
+    def __len__(self):
+        return len(self.index_ids) + len(self.tail)
+
+## prefilling
+
+def read_qids(filename):
+    """ the item ids in a file with one per line, which may be entity urls """
+    with open(filename) as f:
+        return [id for id in (line.strip().rsplit('/', 1)[-1] for line in f) if is_entity_id(id)]
+
+def prefill(path, qids, batch_size=500):
+    """ add the vectors of the english labels and descriptions of qids to
+    the store at path, as wd_search embeds hits, and compact its index """
+    import wd_search as wds
+    store = EmbeddingStore(path, wds.LANGUAGE_MODEL)
+    added = 0
+    for i in range(0, len(qids), batch_size):
+        todo = [qid for qid in qids[i:i+batch_size] if store.row(qid2int(qid)) is None]
+        if todo:
+            texts = wds.item_texts(todo)
+            added += store.put_many(todo, wds.text_vectors([texts[qid] for qid in todo]))
+        print(f"{min(i + batch_size, len(qids))} of {len(qids)} items, {added} added")
+    print(f"{store.compact()} vectors in {path}")
+
+def get_args():
+    p = ap.ArgumentParser(description='prefill a store of the vectors wd_search compares with contexts')
+    p.add_argument('store', help='directory of the embedding store')
+    p.add_argument('qids', help='file of wikidata item ids, one per line')
+    p.add_argument('-b', '--batch', type=int, default=500, help='number of items to embed at once')
+    return p.parse_args()
+
+if __name__ == '__main__':
+    args = get_args()
+    prefill(args.store, read_qids(args.qids), args.batch)
@@ -51,13 +51,12 @@ def evaluate_column(infile, outfile=None, show_progress=False):
     if show_progress: print(out_row)
     out_rows.append(out_row)
     
-    # link data rows
-    for row in data_rows:
-        text = row[1]
+    # link data rows with no context, the header and the caption, all in one batch
+    contexts = ['', header_text, caption_text]
+    row_links = wd.link_many([{'string': row[1], 'context': context} for row in data_rows for context in contexts])
+    for n, row in enumerate(data_rows):
         annotation = row[2]
-        links = [qid(wd.link(text, context='')),
-                 qid(wd.link(text, context=header_text)),
-                 qid(wd.link(text, context=caption_text))]
+        links = [qid(link) for link in row_links[n*len(contexts):(n+1)*len(contexts)]]
         out_row = row + links
         correct = [c+1 if links[n] == annotation else c for n,c in enumerate(correct)]
         if show_progress: print(out_row)
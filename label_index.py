@@ -0,0 +1,361 @@
+"""
+
+Build and search a local index of the labels, aliases and descriptions of
+Wikidata items so that wd_search.py can find candidates without calling
+the Wikidata search API, e.g., on machines without network access.  Build
+the index from a Wikidata JSON dump (.json.bz2, .json.gz or plain JSON with
+one entity per line, like the dumps or a small fixture), which is read in
+parallel by wd_dump.py, with
+
+  python label_index.py latest-all.json.bz2 label_index --langs en
+
+and set these in wd_search_config.yml to use it
+
+  SEARCH_ACTION: local_index
+  LABEL_INDEX: 'label_index'
+
+The index is a directory of NumPy arrays and string tables that are memory
+mapped when searched, so opening it is fast and uses little memory:
+
+  keys      sorted normalized labels and aliases in the given languages,
+            each with a posting list of the entities that have it
+  tokens    sorted words from the labels, aliases and descriptions, each
+            with a posting list of the entities that have it
+  entities  sorted entity ids with their number of sitelinks and label and
+            description in the first language
+
+Posting lists are sorted by number of sitelinks, most first, so the more
+popular items come first among equally good matches.  They're written
+from sorted runs of RUN_SIZE (key, item) pairs that are merged, so
+building the index for a full dump doesn't need them all in memory.
+
+"""
+
+import os
+import re
+import mmap
+import heapq
+import bisect
+import tempfile
+import argparse as ap
+from array import array
+from functools import partial
+import numpy as np
+
+import wd_dump
+from wd_ids import qid2int, int2qid
+
+# the most keys that start with a search string we look at
+MAX_PREFIX_KEYS = 1000
+
+# (key, item) pairs sorted in memory at a time when writing an index
+RUN_SIZE = 5000000
+
+# postings copied at a time
+COPY_SIZE = 1 << 22
+
+def normalize(text):
+    """ lowercase text and collapse whitespace """
+    return ' '.join(text.lower().split())
+
+def tokenize(text):
+    return re.findall(r'\w+', text.lower())
+
+## reading
+
+class StringTable:
+    """ a memory-mapped sequence of strings stored as utf-8 bytes and an array of offsets """
+
+    def __init__(self, prefix):
+        self.offsets = np.load(prefix + '_offsets.npy', mmap_mode='r')
+        with open(prefix + '.bin', 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(prefix + '.bin') else b''
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.data[self.offsets[i]:self.offsets[i+1]].decode('utf-8')
+
+class PostingTable:
+    """ a sorted StringTable of keys, each with an array of entity ids """
+
+    def __init__(self, prefix):
+        self.keys = StringTable(prefix)
+        self.offsets = np.load(prefix + '_postings_offsets.npy', mmap_mode='r')
+        self.postings = np.load(prefix + '_postings.npy', mmap_mode='r')
+
+    def find(self, key):
+        """ returns the index of key or None """
+        i = bisect.bisect_left(self.keys, key)
+        return i if i < len(self.keys) and self.keys[i] == key else None
+
+    def get(self, key):
+        """ returns the array of ids for key, empty if it's not in the table """
+        i = self.find(key)
+        return self.postings[self.offsets[i]:self.offsets[i+1]] if i is not None else self.postings[:0]
+
+    def prefix_range(self, prefix):
+        """ returns the range of indices of keys starting with prefix """
+        lo = bisect.bisect_left(self.keys, prefix)
+        hi = bisect.bisect_left(self.keys, prefix + '\U0010ffff', lo)
+        return lo, hi
+
+class LabelIndex:
+    """ a label index built by build_index, opened for searching """
+
+    def __init__(self, path):
+        self.path = path
+        self.keys = PostingTable(os.path.join(path, 'keys'))
+        self.tokens = PostingTable(os.path.join(path, 'tokens'))
+        self.ids = np.load(os.path.join(path, 'entity_ids.npy'), mmap_mode='r')
+        self.sitelinks = np.load(os.path.join(path, 'entity_sitelinks.npy'), mmap_mode='r')
+        self.labels = StringTable(os.path.join(path, 'entity_labels'))
+        self.descriptions = StringTable(os.path.join(path, 'entity_descriptions'))
+
+    def row(self, n):
+        """ row of the integer entity id n in the entity arrays """
+        return int(np.searchsorted(self.ids, n))
+
+    def by_popularity(self, ids):
+        """ ids sorted by their number of sitelinks, most first """
+        ids = np.unique(ids)
+        order = np.argsort(-self.sitelinks[np.searchsorted(self.ids, ids)], kind='stable')
+        return ids[order]
+
+    def search(self, string, limit=20, namespace='*'):
+        """ returns up to limit hits for string: entities with a label or
+        alias equal to it, then ones with a label or alias starting with
+        it, then ones with all of its words in their label, aliases or
+        description.  Each hit is a dict like those from the Wikidata
+        search API with title, label, description and snippet keys. """
+        key = normalize(string)
+        found = dict()   # ordered set of integer ids
+        def add(ids):
+            for n in ids:
+                n = int(n)
+                if namespace == '*' or (namespace == 'Q') == (n > 0):
+                    found[n] = True
+                    if len(found) >= limit:
+                        return True
+            return False
+
+        if not key:
+            return []
+        if add(self.keys.get(key)):
+            return self.hits(found)
+        lo, hi = self.keys.prefix_range(key)
+        hi = min(hi, lo + MAX_PREFIX_KEYS)
+        if hi > lo:
+            ids = self.keys.postings[self.keys.offsets[lo]:self.keys.offsets[hi]]
+            if add(self.by_popularity(ids)):
+                return self.hits(found)
+        words = tokenize(key)
+        if words:
+            ids = None
+            for word in sorted(set(words), key=lambda w: len(self.tokens.get(w))):
+                postings = self.tokens.get(word)
+                ids = postings if ids is None else np.intersect1d(ids, postings)
+                if len(ids) == 0:
+                    break
+            add(self.by_popularity(ids))
+        return self.hits(found)
+
+    def hits(self, found):
+        hits = []
+        for n in found:
+            i = self.row(n)
+            label, desc = self.labels[i], self.descriptions[i]
+            hits.append({'title': int2qid(n), 'label': label, 'description': desc,
+                         'titlesnippet': label, 'snippet': desc})
+        return hits
+
+## building
+
+def entity_names(entity, langs):
+    """ returns the set of an entity's labels and aliases in langs """
+    names = set()
+    for lang in langs:
+        if lang in entity.get('labels', {}):
+            names.add(entity['labels'][lang]['value'])
+        for alias in entity.get('aliases', {}).get(lang, []):
+            names.add(alias['value'])
+    return names
+
+def index_record(entity, langs):
+    """ returns a tuple of what the index needs from an entity: its
+    integer id, number of sitelinks, label and description in the
+    first language, normalized names and words """
+    lang = langs[0]
+    names = entity_names(entity, langs)
+    label = entity.get('labels', {}).get(lang, {}).get('value', '')
+    desc = entity.get('descriptions', {}).get(lang, {}).get('value', '')
+    keys = sorted({normalize(name) for name in names} - {''})
+    words = sorted(set(tokenize(' '.join(names) + ' ' + desc)))
+    return (qid2int(entity['id']), len(entity.get('sitelinks', {})), label, desc, keys, words)
+
+def named_record(entity, langs):
+    """ the index_record for an entity with a label or alias in langs, else None """
+    record = index_record(entity, langs)
+    return record if record[4] else None
+
+class StringWriter:
+    """ writes a StringTable one string at a time """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.out = open(prefix + '.bin', 'wb')
+        self.offsets = array('q', [0])
+
+    def add(self, s):
+        b = s.encode('utf-8')
+        self.out.write(b)
+        self.offsets.append(self.offsets[-1] + len(b))
+
+    def close(self):
+        self.out.close()
+        np.save(self.prefix + '_offsets.npy', np.frombuffer(self.offsets, dtype=np.int64))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+def write_strings(prefix, strings):
+    writer = StringWriter(prefix)
+    for s in strings:
+        writer.add(s)
+    writer.close()
+
+class PostingRuns:
+    """ (key, -sitelinks, id) postings, sorted RUN_SIZE at a time into
+    run files in a directory and merged into one sorted stream """
+
+    def __init__(self, workdir, name):
+        self.prefix = os.path.join(workdir, name)
+        self.postings = []
+        self.files = []
+
+    def add(self, key, sitelinks, n):
+        self.postings.append((key, -sitelinks, n))
+        if len(self.postings) >= RUN_SIZE:
+            self.spill()
+
+    def spill(self):
+        """ write the postings in memory to a sorted run file.  Keys have
+        no tabs or newlines since they're normalized or words """
+        if self.postings:
+            self.postings.sort()
+            path = f"{self.prefix}-{len(self.files):05d}.txt"
+            with open(path, 'w', encoding='utf-8', newline='') as out:
+                out.writelines(f"{key}\t{p}\t{n}\n" for key, p, n in self.postings)
+            self.files.append(path)
+            self.postings = []
+
+    def merged(self):
+        """ generates all of the postings in order """
+        self.spill()
+        files = [open(path, encoding='utf-8', newline='') for path in self.files]
+        try:
+            yield from heapq.merge(*(map(read_posting, f) for f in files))
+        finally:
+            for f in files:
+                f.close()
+
+def read_posting(line):
+    key, p, n = line[:-1].split('\t')
+    return (key, int(p), int(n))
+
+def save_array(path, raw):
+    """ save the int64s in the raw file as a .npy file, copying them a chunk at a time """
+    n = os.path.getsize(raw) // 8
+    if n == 0:
+        np.save(path, np.zeros(0, dtype=np.int64))
+    else:
+        src = np.memmap(raw, dtype=np.int64, mode='r')
+        out = np.lib.format.open_memmap(path, mode='w+', dtype=np.int64, shape=(n,))
+        for i in range(0, n, COPY_SIZE):
+            out[i:i+COPY_SIZE] = src[i:i+COPY_SIZE]
+        out.flush()
+        del src, out
+    os.remove(raw)
+
+def write_postings(prefix, postings):
+    """ write a PostingTable from a sorted stream of (key, -sitelinks, id)
+    postings and return its number of keys """
+    keys = StringWriter(prefix)
+    offsets = array('q', [0])
+    last = None
+    with open(prefix + '_postings.i64', 'wb') as out:
+        batch = array('q')
+        for key, _, n in postings:
+            if key != last:
+                if last is not None:
+                    offsets.append(offsets[-1] + count)
+                keys.add(key)
+                last, count = key, 0
+            batch.append(n)
+            count += 1
+            if len(batch) >= COPY_SIZE:
+                batch.tofile(out)
+                batch = array('q')
+        batch.tofile(out)
+        if last is not None:
+            offsets.append(offsets[-1] + count)
+    keys.close()
+    np.save(prefix + '_postings_offsets.npy', np.frombuffer(offsets, dtype=np.int64))
+    save_array(prefix + '_postings.npy', prefix + '_postings.i64')
+    return len(keys)
+
+def write_index(outdir, records):
+    """ write an index from an iterable of index_record tuples.  Labels and
+    descriptions are written in the order of the records and then copied
+    in the order of their ids, and the postings are spilled to sorted runs
+    as they're read, so memory use doesn't grow with the number of names """
+    os.makedirs(outdir, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=outdir) as tmp:
+        ids, sitelinks = array('q'), array('q')
+        labels = StringWriter(os.path.join(tmp, 'labels'))
+        descriptions = StringWriter(os.path.join(tmp, 'descriptions'))
+        key_runs, token_runs = PostingRuns(tmp, 'keys'), PostingRuns(tmp, 'tokens')
+        for n, popularity, label, desc, keys, words in records:
+            ids.append(n)
+            sitelinks.append(popularity)
+            labels.add(label)
+            descriptions.add(desc)
+            for key in keys:
+                key_runs.add(key, popularity, n)
+            for word in words:
+                token_runs.add(word, popularity, n)
+        labels.close()
+        descriptions.close()
+        ids, sitelinks = np.frombuffer(ids, dtype=np.int64), np.frombuffer(sitelinks, dtype=np.int64)
+        order = np.argsort(ids, kind='stable')
+        np.save(os.path.join(outdir, 'entity_ids.npy'), ids[order])
+        np.save(os.path.join(outdir, 'entity_sitelinks.npy'), sitelinks[order].astype(np.int32))
+        for name in ('labels', 'descriptions'):
+            table = StringTable(os.path.join(tmp, name))
+            write_strings(os.path.join(outdir, 'entity_' + name), (table[i] for i in order.tolist()))
+            del table
+        nkeys = write_postings(os.path.join(outdir, 'keys'), key_runs.merged())
+        ntokens = write_postings(os.path.join(outdir, 'tokens'), token_runs.merged())
+    print(f"Wrote index of {len(ids)} entities, {nkeys} names and {ntokens} words to {outdir}")
+
+def build_index(dump, outdir, langs=['en'], workers=None, workdir=None):
+    """ build a label index for the entities in a dump with labels or
+    aliases in langs, reading the dump in parallel into shards in
+    workdir, which are kept so an interrupted build can be resumed """
+    workdir = workdir or outdir.rstrip('/') + '_shards'
+    wd_dump.ingest(dump, workdir, partial(named_record, langs=langs), workers=workers)
+    write_index(outdir, wd_dump.records(workdir))
+
+def get_args():
+    p = ap.ArgumentParser(description='build a local label index from a wikidata json dump')
+    p.add_argument('dump', help='wikidata json dump file, optionally .bz2 or .gz compressed')
+    p.add_argument('outdir', help='directory for the index')
+    p.add_argument('-l', '--langs', nargs='+', default=['en'], help='languages of labels and aliases to index; the first is used for the labels and descriptions in hits')
+    p.add_argument('-w', '--workers', type=int, default=None, help='number of processes reading the dump, defaults to the number of cores')
+    p.add_argument('--workdir', help='directory for the shards of the dump, defaults to outdir_shards')
+    return p.parse_args()
+
+if __name__ == '__main__':
+    args = get_args()
+    build_index(args.dump, args.outdir, args.langs, args.workers, args.workdir)
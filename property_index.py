@@ -0,0 +1,110 @@
+"""
+
+Build and use indexes of which Wikidata items have a given property, e.g.,
+P486 (MeSH descriptor ID), P2888 (exact match) or P3098 (ClinicalTrials.gov
+ID), so wd_search.py can give them an inferred type (see INFERRED_TYPES
+in wd_search_config.yml).  The index for a property is a sorted array of
+the integer ids (see wd_ids.py) of the items that have it, saved as
+<property>.npy in an index directory.  It's memory mapped when opened, so
+even one with millions of items loads in milliseconds and stays out of the
+Python heap, and looking up an item is a binary search.
+
+Build indexes for several properties with one pass over a Wikidata JSON
+dump, read in parallel by wd_dump.py
+
+  python property_index.py latest-all.json.bz2 property_index --props P486 P2888
+
+or for one property from a file of ids, one per line, like the results
+of the query select ?item {?item wdt:P486 []}
+
+  python property_index.py mesh_items.txt property_index --props P486
+
+"""
+
+import os
+import argparse as ap
+from functools import partial
+import numpy as np
+
+import wd_dump
+from wd_ids import qid2int, is_entity_id
+
+class PropertyIndex:
+    """ the property indexes in a directory, each opened when first used """
+
+    def __init__(self, path):
+        self.path = path
+        self.arrays = {}
+
+    def array_file(self, prop):
+        return os.path.join(self.path, prop + '.npy')
+
+    def items(self, prop):
+        """ the sorted array of integer ids of the items with prop """
+        if prop not in self.arrays:
+            self.arrays[prop] = np.load(self.array_file(prop), mmap_mode='r')
+        return self.arrays[prop]
+
+    def exists(self, prop):
+        return prop in self.arrays or os.path.exists(self.array_file(prop))
+
+    def has(self, prop, qid):
+        """ True iff the item qid has prop """
+        items = self.items(prop)
+        n = qid2int(qid)
+        i = int(np.searchsorted(items, n))
+        return i < len(items) and items[i] == n
+
+## building
+
+def save_items(path, prop, ids):
+    """ save the index for prop given an iterable of item ids or integers """
+    os.makedirs(path, exist_ok=True)
+    ints = np.unique(np.array([qid2int(id) if type(id) == str else id for id in ids], dtype=np.int64))
+    np.save(os.path.join(path, prop + '.npy'), ints)
+    return len(ints)
+
+def read_ids(filename):
+    """ generates the ids in a file with one per line, which may be entity urls """
+    with open(filename) as f:
+        for line in f:
+            id = line.strip().rsplit('/', 1)[-1]
+            if is_entity_id(id):
+                yield id
+
+def entity_properties(entity, props):
+    """ the record wd_dump extracts for an entity: its integer id and which of props it has """
+    has = [p for p in props if entity.get('claims', {}).get(p)]
+    return (qid2int(entity['id']), has) if has else None
+
+def build_from_dump(dump, path, props, workers=None, workdir=None):
+    """ build the indexes for props with one pass over a json dump """
+    workdir = workdir or path.rstrip('/') + '_shards'
+    wd_dump.ingest(dump, workdir, partial(entity_properties, props=tuple(props)),
+                   prefilter=[f'"{p}"' for p in props], workers=workers)
+    prop2ids = {p: [] for p in props}
+    for n, has in wd_dump.records(workdir):
+        for p in has:
+            prop2ids[p].append(n)
+    for p in props:
+        print(f"Wrote index of {save_items(path, p, prop2ids[p])} items with {p} to {path}")
+
+def build_from_file(filename, path, prop):
+    """ build the index for prop from a file of the ids of the items with it """
+    print(f"Wrote index of {save_items(path, prop, read_ids(filename))} items with {prop} to {path}")
+
+def get_args():
+    p = ap.ArgumentParser(description='build indexes of the wikidata items with some properties')
+    p.add_argument('source', help='wikidata json dump, optionally .bz2 or .gz compressed, or a .txt file of item ids')
+    p.add_argument('outdir', help='directory for the indexes')
+    p.add_argument('-p', '--props', nargs='+', required=True, help='properties to index, just one for a file of ids')
+    p.add_argument('-w', '--workers', type=int, default=None, help='number of processes reading a dump, defaults to the number of cores')
+    p.add_argument('--workdir', help='directory for the shards of a dump, defaults to outdir_shards')
+    return p.parse_args()
+
+if __name__ == '__main__':
+    args = get_args()
+    if args.source.endswith('.txt'):
+        build_from_file(args.source, args.outdir, args.props[0])
+    else:
+        build_from_dump(args.source, args.outdir, args.props, args.workers, args.workdir)
@@ -45,6 +45,7 @@ from abbreviation import AbbreviationDetector
 import spacy_plus as sp   # addiional spacy related functions
 
 import wd_search as wds   # code for searching the public wikidata server
+from wd_ids import qid2int, int2qid, qid_keys   # links are counted by integer ids, e.g. Q42 => 42
 # import gkg_search as gkg  # code for search the google knowledge graph
 
 
@@ -100,18 +101,18 @@ em_count_topic = {}                 # dict from ents to number of mentions in a
 topic2em_count = {}                 # dict from topic to em to count of that mention in the topic
 
 topic2em2sents = {}                 # dict from topic part to mention to list of sentences mention was in
-topic2elid_count = {}               # dict from topicid entity link counts
-el_count = defaultdict(int)         # dict from entity links to number of entity links in all topics
+topic2elid_count = {}               # dict from topicid entity link counts, keyed by integer link id
+el_count = defaultdict(int)         # dict from integer link ids to number of entity links in all topics
 #el_count_topic = {}                # dict from entity links to number of mentions in a document
-el2topics = defaultdict(set)        # dict from links to a set of topics in which they are mentioned
+el2topics = defaultdict(set)        # dict from integer link ids to a set of topics in which they are mentioned
 topic2em2links = {}                 # dict mapping a topic part's mentions to a list of possible links
 topic2emtext2links = {}             # dict mapping a topic part's mentions to a list of possible links
 topic2em2link = {}                  # dict mapping a topic part's mentions to best single link
 #topic2emtext2link = {}             # dict mapping a topic part's mentions to a list of possible links
 
-topic2links = defaultdict(dict)     # dict from topic parts to a dict of links
+topic2links = defaultdict(dict)     # dict from topic parts to a dict from integer link ids to links
 topic2linkid2sents = {}             # dict from topic parts to their links' sentences
-linkid2link = {}                    # dict from link id (i.e., Qnnnnn) to the link
+linkid2link = {}                    # dict from integer link id (i.e., nnnnn for Qnnnnn) to the link
 
 nc_count = defaultdict(int)
 nc2sents = defaultdict(list)
@@ -222,7 +223,7 @@ def process_named_entity_mentions(doc, topic_id):
         link['source'] = "entity"
         topic2em2links[topic_id][em].append(link)
         topic2emtext2links[topic_id][link_text].append(link)        
-        topic2elid_count[topic_id][link['id']] += 1  # increment count of link in this topic        
+        topic2elid_count[topic_id][qid2int(link['id'])] += 1  # increment count of link in this topic
 
     # we assume that each unique mention in a doc, e.g. (Trump,PER),
     # should link to just one WD item so choose the best one.
@@ -238,7 +239,7 @@ def process_named_entity_mentions(doc, topic_id):
         best_score = best_link['score']
         # for campatibility with Elliot's system
         best_link['scores'] = {'ts_prob':scores, 'score':scores, 'rank':ranks}
-        qid = best_link['qid']
+        qid = qid2int(best_link['qid'])
         if qid not in final_links:
             final_links[qid] = best_link
             #print(f"initial final_links: {final_links}")
@@ -309,15 +310,15 @@ def process_nominal_concepts(doc, topic_id):
             if link == NOLINK:
                 continue
 
-        link_id = link['id']
+        link_id = qid2int(link['id'])
         el_count[link_id] += 1                      # increment count of link in any topics
         topic2elid_count[topic_id][link_id] += 1    # increment count in this topic
         el2topics[link_id].add(topic_id)            # add this topic part as one the link appears in
 
     # add nc links found in topic part
     for link in links:
-        qid = link['qid']
-        link['counts'] = el_count[link['qid']]
+        qid = qid2int(link['qid'])
+        link['counts'] = el_count[qid]
         link['scores'] = {'ts_prob': [link['score']], 'score': [link['score']], 'rank':[link['score']]}
         if qid not in topic2links[topic_id]:
             topic2links[topic_id][qid] = link # xxx
@@ -352,9 +353,9 @@ def write_outfile(infile, outfile, topic_ids_todo=[]):
                 out.write(line)
             else:  # add linking data to this line's json object
                 in_data['resources'] = {'entity_linking' : {
-                    'title_text': {'entities': topic2links[(topic_id, 'title')]},
-                    'description_text': {'entities': topic2links[(topic_id, 'description')]},
-                    'report_text': {'entities': topic2links[(topic_id, 'report')]},
+                    'title_text': {'entities': qid_keys(topic2links[(topic_id, 'title')])},
+                    'description_text': {'entities': qid_keys(topic2links[(topic_id, 'description')])},
+                    'report_text': {'entities': qid_keys(topic2links[(topic_id, 'report')])},
                     'time_stamp' : TIMESTAMP,
                     'eval' : '',
                     'inbox' : ''}}
@@ -433,7 +434,7 @@ def write_summary_file(outfile):
                         out.write(f"  {s}\n")  # print MAX_SENTENCE_LENGTH characters
 
                 # show linkids and frequency in topic part
-                links = sorted(topic2elid_count[part].items(), key=lambda t: t[1], reverse=True)
+                links = [(int2qid(id), n) for id, n in sorted(topic2elid_count[part].items(), key=lambda t: t[1], reverse=True)]
                 out.write(f"\n{len(links)} LINKS: {links}")
                     
 def write_topic_stats(out):
@@ -443,7 +444,7 @@ def write_topic_stats(out):
         out.write(f"{count}\t{mention}\n")
     out.write("\nTen linked entities/concepts appearing the most topics\n")
     for link, topics in sorted(el2topics.items(), key=lambda link_topicSet: len(link_topicSet[1]), reverse=True)[:10]:
-        out.write(f"{len(topics)}\t{link}\n")
+        out.write(f"{len(topics)}\t{int2qid(link)}\n")
 
 
 def get_args():
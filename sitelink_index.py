@@ -0,0 +1,98 @@
+"""
+
+Build and use a local table of the number of sitelinks (links to Wikipedia
+and other Wikimedia sites) and the English Wikipedia title of Wikidata
+items, so wd_search.py can get them without a SPARQL query per hit and use
+the number of sitelinks as a cheap measure of an item's popularity.  Build
+it from a Wikidata JSON dump or fixture, read in parallel by wd_dump.py,
+with
+
+  python sitelink_index.py latest-all.json.bz2 sitelink_index
+
+and set SITELINK_INDEX: 'sitelink_index' in wd_search_config.yml to use it.
+
+Only items with sitelinks are stored: a sorted array of their integer ids
+(see wd_ids.py), an array of their sitelink counts and a string table of
+their enwiki titles, all memory mapped.  An item that's not in the table
+has no sitelinks if its id is at most the largest id in the table and is
+unknown, e.g., newer than the dump, otherwise.
+
+"""
+
+import os
+import tempfile
+import argparse as ap
+from array import array
+import numpy as np
+
+import wd_dump
+from wd_ids import qid2int
+from label_index import StringTable, StringWriter, write_strings
+
+class SitelinkIndex:
+
+    def __init__(self, path):
+        self.path = path
+        self.ids = np.load(os.path.join(path, 'ids.npy'), mmap_mode='r')
+        self.sitelinks = np.load(os.path.join(path, 'sitelinks.npy'), mmap_mode='r')
+        self.titles = StringTable(os.path.join(path, 'enwiki'))
+        self.max_id = int(self.ids[-1]) if len(self.ids) else 0
+
+    def lookup(self, qid):
+        """ returns a tuple of qid's number of sitelinks and enwiki title
+        ('' if it has none) or None if qid is not known to the index """
+        n = qid2int(qid)
+        i = int(np.searchsorted(self.ids, n))
+        if i < len(self.ids) and self.ids[i] == n:
+            return (int(self.sitelinks[i]), self.titles[i])
+        return (0, '') if 0 < n <= self.max_id else None
+
+## building
+
+def entity_sitelinks(entity):
+    """ the record wd_dump extracts for an item with sitelinks: its integer id, number of sitelinks and enwiki title """
+    sitelinks = entity.get('sitelinks', {})
+    if not sitelinks or entity['id'][0] != 'Q':
+        return None
+    return (qid2int(entity['id']), len(sitelinks), sitelinks.get('enwiki', {}).get('title', ''))
+
+def write_index(outdir, records):
+    """ write an index from an iterable of entity_sitelinks records.  As in
+    label_index.py, the titles are written in the order of the records and
+    then copied in the order of their ids, so only the ids and counts are
+    held in memory, as arrays """
+    os.makedirs(outdir, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=outdir) as tmp:
+        ids, sitelinks = array('q'), array('i')
+        titles = StringWriter(os.path.join(tmp, 'enwiki'))
+        for n, count, title in records:
+            ids.append(n)
+            sitelinks.append(count)
+            titles.add(title)
+        titles.close()
+        ids, sitelinks = np.frombuffer(ids, dtype=np.int64), np.frombuffer(sitelinks, dtype=np.int32)
+        order = np.argsort(ids, kind='stable')
+        np.save(os.path.join(outdir, 'ids.npy'), ids[order])
+        np.save(os.path.join(outdir, 'sitelinks.npy'), sitelinks[order])
+        table = StringTable(os.path.join(tmp, 'enwiki'))
+        write_strings(os.path.join(outdir, 'enwiki'), (table[i] for i in order))
+        del table
+    print(f"Wrote sitelink index of {len(ids)} items to {outdir}")
+
+def build_index(dump, outdir, workers=None, workdir=None):
+    """ build a sitelink index for a dump, keeping its shards in workdir so an interrupted build can be resumed """
+    workdir = workdir or outdir.rstrip('/') + '_shards'
+    wd_dump.ingest(dump, workdir, entity_sitelinks, prefilter=['"site"'], workers=workers)
+    write_index(outdir, wd_dump.records(workdir))
+
+def get_args():
+    p = ap.ArgumentParser(description='build a local table of the sitelinks of wikidata items from a json dump')
+    p.add_argument('dump', help='wikidata json dump file, optionally .bz2 or .gz compressed')
+    p.add_argument('outdir', help='directory for the index')
+    p.add_argument('-w', '--workers', type=int, default=None, help='number of processes reading the dump, defaults to the number of cores')
+    p.add_argument('--workdir', help='directory for the shards of the dump, defaults to outdir_shards')
+    return p.parse_args()
+
+if __name__ == '__main__':
+    args = get_args()
+    build_index(args.dump, args.outdir, args.workers, args.workdir)
@@ -0,0 +1,130 @@
+"""
+
+Score how well the label and description of each of a search's hits
+match a mention's context with sparse word vectors, an alternative to
+spaCy similarity that needs no language model.  Set LANGUAGE_MODEL in
+wd_search_config.yml to
+
+  tfidf  the cosine similarity of the tf-idf vectors of the context and the hit's text
+  bm25   the Okapi BM25 score of the hit's text for the context's words
+
+Both weigh words by their inverse document frequency in the english
+labels and descriptions of Wikidata items, from an IDF table built from
+a Wikidata JSON dump, read in parallel by wd_dump.py, with
+
+  python sparse_scorer.py latest-all.json.bz2 idf_table
+
+and set as IDF_TABLE.  The table is a sorted, memory-mapped string table
+of the words in at least MIN_DF items with an array of their IDFs.
+Words not in it get the IDF of a word in no items.
+
+"""
+
+import os
+import json
+import bisect
+import argparse as ap
+from math import log
+from functools import lru_cache
+from collections import Counter
+import numpy as np
+
+import wd_dump
+from label_index import StringTable, write_strings, tokenize
+
+# words in fewer items are left out of the table
+MIN_DF = 2
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+def idf(n, df):
+    """ the BM25 inverse document frequency of a word in df of n documents, which is never negative """
+    return log(1 + (n - df + 0.5) / (df + 0.5))
+
+class IdfTable:
+
+    def __init__(self, path):
+        self.words = StringTable(os.path.join(path, 'words'))
+        self.idfs = np.load(os.path.join(path, 'idf.npy'), mmap_mode='r')
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        self.n = meta['documents']
+        self.avgdl = meta['average_length']
+        self.unknown = idf(self.n, 0)
+        self.get = lru_cache(maxsize=100000)(self.get)
+
+    def get(self, word):
+        """ the idf of word """
+        i = bisect.bisect_left(self.words, word)
+        return float(self.idfs[i]) if i < len(self.words) and self.words[i] == word else self.unknown
+
+class SparseScorer:
+    """ scores texts for a context with tf-idf cosine similarity or BM25 """
+
+    def __init__(self, path, method='tfidf'):
+        assert method in ('tfidf', 'bm25')
+        self.idf = IdfTable(path)
+        self.method = method
+
+    def scores(self, texts, context):
+        """ an array of the score of each of a list of texts for a context string """
+        docs = [Counter(tokenize(text)) for text in texts]
+        query = Counter(tokenize(context))
+        vocabulary = {word: i for i, word in enumerate(set(query).union(*docs))}
+        counts = np.zeros((len(docs), len(vocabulary)), dtype=np.float32)
+        for row, doc in enumerate(docs):
+            for word, n in doc.items():
+                counts[row, vocabulary[word]] = n
+        q = np.zeros(len(vocabulary), dtype=np.float32)
+        for word, n in query.items():
+            q[vocabulary[word]] = n
+        idfs = np.array([self.idf.get(word) for word in vocabulary], dtype=np.float32)
+        if self.method == 'bm25':
+            lengths = counts.sum(axis=1, keepdims=True)
+            tf = counts * (K1 + 1) / (counts + K1 * (1 - B + B * lengths / self.idf.avgdl))
+            return tf @ (idfs * q)
+        vectors, vector = counts * idfs, q * idfs
+        norms = np.linalg.norm(vectors, axis=1) * np.linalg.norm(vector)
+        dots = vectors @ vector
+        return np.divide(dots, norms, out=np.zeros_like(dots), where=norms > 0)
+
+## building
+
+def entity_words(entity, lang='en'):
+    """ the record wd_dump extracts for an entity: the number of words
+    in its label and description and the set of them """
+    words = tokenize(entity.get('labels', {}).get(lang, {}).get('value', '') + ' ' +
+                     entity.get('descriptions', {}).get(lang, {}).get('value', ''))
+    return (len(words), sorted(set(words))) if words else None
+
+def build_table(dump, outdir, workers=None, workdir=None):
+    """ build an IDF table from the english labels and descriptions of the items in a dump """
+    workdir = workdir or outdir.rstrip('/') + '_shards'
+    wd_dump.ingest(dump, workdir, entity_words, prefilter=['"en"'], workers=workers)
+    df = Counter()
+    n = length = 0
+    for size, words in wd_dump.records(workdir):
+        n += 1
+        length += size
+        df.update(words)
+    words = sorted(word for word, count in df.items() if count >= MIN_DF)
+    os.makedirs(outdir, exist_ok=True)
+    write_strings(os.path.join(outdir, 'words'), words)
+    np.save(os.path.join(outdir, 'idf.npy'), np.array([idf(n, df[word]) for word in words], dtype=np.float32))
+    with open(os.path.join(outdir, 'meta.json'), 'w') as f:
+        json.dump({'documents': n, 'average_length': length / max(n, 1)}, f)
+    print(f"Wrote IDF table of {len(words)} words in {n} items to {outdir}")
+
+def get_args():
+    p = ap.ArgumentParser(description='build a table of the IDFs of the words in the labels and descriptions of wikidata items')
+    p.add_argument('dump', help='wikidata json dump file, optionally .bz2 or .gz compressed')
+    p.add_argument('outdir', help='directory for the table')
+    p.add_argument('-w', '--workers', type=int, default=None, help='number of processes reading the dump, defaults to the number of cores')
+    p.add_argument('--workdir', help='directory for the shards of the dump, defaults to outdir_shards')
+    return p.parse_args()
+
+if __name__ == '__main__':
+    args = get_args()
+    build_table(args.dump, args.outdir, args.workers, args.workdir)
@@ -0,0 +1,69 @@
+""" wd_search reads wd_search_config.yml from the current directory when
+it's imported, so the tests run in a scratch directory with a copy of
+procure_config.yml that needs no network, language model or local files
+and get a fake Wikidata in place of its http session """
+
+import os
+import sys
+import atexit
+import shutil
+import tempfile
+
+import yaml
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+TEST_CONFIG = {
+    'YAML_FILE_NAME': 'tests',
+    'USE_CONTEXT': False,
+    'LEMMATIZE_SEARCH_STRING': False,
+    'THROTTLE': False,
+    'PERSISTENT_CACHE': False,
+    'CACHE_SOFT_TTL': 0,
+    'CACHE_SIGNALS': False,
+    'RESULT_CACHE': False,
+    'SPECULATIVE_SEARCH': False,
+    # the speedups the shipped config leaves off
+    'BATCH_TYPE_QUERIES': True,
+    'BULK_COMPLETION': True,
+    'CONCURRENT_CANDIDATES': True,
+    'ADAPTIVE_CANDIDATES': True,
+    'DBPEDIA': False,
+    'DOMAIN': 'tests',
+    'INFERRED_TYPES': {},
+    'TARGET_TYPES': ['PERSON'],
+    'GOOD_TYPES': ['disease'],
+    'OK_TYPES': ['ORG'],
+    'BAD_TYPES': ['WIKIDISAMBIGUATION'],
+}
+
+workdir = tempfile.mkdtemp(prefix='wdtools-tests-')
+atexit.register(shutil.rmtree, workdir, ignore_errors=True)
+with open(os.path.join(ROOT, 'procure_config.yml')) as f:
+    config = yaml.load(f, Loader=yaml.FullLoader)
+config.update(TEST_CONFIG)
+with open(os.path.join(workdir, 'wd_search_config.yml'), 'w') as f:
+    yaml.dump(config, f)
+os.chdir(workdir)
+
+from fake_wikidata import FakeWikidata, ENTITIES
+
+@pytest.fixture
+def wds(monkeypatch):
+    """ wd_search with empty caches and counters """
+    import wd_search
+    import wd_cache as wdc
+    for wrapper in wdc.cached_functions:
+        wrapper.cache_clear()
+    monkeypatch.setattr(wd_search, 'type_labels', {})
+    monkeypatch.setattr(wd_search, 'result_cache', None)
+    return wd_search
+
+@pytest.fixture
+def wikidata(wds, monkeypatch):
+    """ a fake of the Wikidata services wd_search uses, answering from ENTITIES """
+    fake = FakeWikidata(ENTITIES)
+    monkeypatch.setattr(wds, 'http', fake)
+    return fake
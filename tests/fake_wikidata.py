@@ -0,0 +1,237 @@
+""" a small Wikidata world for the tests: the entities, a fake of the api
+and query service that answers the requests wd_search sends from them,
+a writer of json dumps of them and brute-force type closures """
+
+import re
+import bz2
+import gzip
+import json
+import threading
+from urllib.parse import urlparse
+
+import requests
+
+# each entity has an english label, description and aliases, P31 and
+# P279 values and sitelinks, a dict of site => title.  Other properties'
+# values only go in dumps
+ENTITIES = {
+    # classes
+    'Q215627': {'label': 'person', 'description': 'being that has certain capacities or attributes'},
+    'Q5': {'label': 'human', 'description': 'common name of Homo sapiens', 'P279': ['Q215627']},
+    'Q43229': {'label': 'organization', 'description': 'social entity established to meet needs or pursue goals'},
+    'Q4830453': {'label': 'business', 'description': 'organization undertaking commercial activity', 'P279': ['Q43229']},
+    'Q476028': {'label': 'association football club', 'description': 'sports club', 'P279': ['Q43229']},
+    'Q12136': {'label': 'disease', 'description': 'abnormal condition negatively affecting organisms'},
+    'Q18123741': {'label': 'infectious disease', 'description': 'disease caused by pathogens', 'P279': ['Q12136']},
+    'Q4167410': {'label': 'Wikimedia disambiguation page', 'description': 'navigational page'},
+    'Q515': {'label': 'city', 'description': 'large human settlement'},
+    'Q9143': {'label': 'programming language', 'description': 'language for communicating instructions to a machine'},
+    # items
+    'Q1001': {'label': 'Ada Lovelace', 'description': 'English mathematician and writer', 'aliases': ['Augusta Ada King'],
+              'P31': ['Q5'], 'sitelinks': {'enwiki': 'Ada Lovelace', 'frwiki': 'Ada Lovelace', 'dewiki': 'Ada Lovelace'}},
+    'Q1002': {'label': 'Ada', 'description': 'Wikimedia disambiguation page', 'P31': ['Q4167410'], 'sitelinks': {'enwiki': 'Ada'}},
+    'Q1003': {'label': 'Ada', 'description': 'programming language', 'P31': ['Q9143'], 'sitelinks': {'enwiki': 'Ada (programming language)'}},
+    'Q1004': {'label': 'Ada Health', 'description': 'German health company', 'P31': ['Q4830453']},
+    'Q1005': {'label': 'Ada fever', 'description': 'infectious disease of cattle', 'P31': ['Q18123741']},
+    'Q1006': {'label': 'Ada Yonath', 'description': 'Israeli crystallographer', 'P31': ['Q5'], 'sitelinks': {'enwiki': 'Ada Yonath'}},
+    'Q1007': {'label': 'Paris', 'description': 'capital of France', 'P31': ['Q515'],
+              'sitelinks': {'enwiki': 'Paris', 'frwiki': 'Paris'}},
+    'Q1008': {'label': 'Paris Hilton', 'description': 'American media personality', 'P31': ['Q5'], 'sitelinks': {'enwiki': 'Paris Hilton'}},
+    'Q1009': {'label': 'Paris Saint-Germain', 'description': 'French football club', 'aliases': ['PSG'],
+              'P31': ['Q476028'], 'sitelinks': {'enwiki': 'Paris Saint-Germain F.C.'}},
+    'Q1010': {'label': 'Lyme disease', 'description': 'infectious disease caused by Borrelia bacteria',
+              'aliases': ['Lyme borreliosis'], 'P31': ['Q18123741'], 'sitelinks': {'enwiki': 'Lyme disease'}},
+    'Q1011': {'label': 'Paris', 'description': 'Wikimedia disambiguation page', 'P31': ['Q4167410']},
+    'Q1012': {'label': 'Yonath Health', 'description': 'health company', 'P31': ['Q4830453']},
+}
+
+def words(text):
+    return re.findall(r'\w+', text.lower())
+
+## type closures
+
+def superclasses(entities, qid):
+    """ the classes qid is a P279+ subclass of """
+    seen, todo = set(), list(entities.get(qid, {}).get('P279', []))
+    while todo:
+        c = todo.pop()
+        if c not in seen:
+            seen.add(c)
+            todo.extend(entities.get(c, {}).get('P279', []))
+    return seen
+
+def instance_types(entities, qid):
+    """ the types qid has via P31/P279* """
+    types = set()
+    for c in entities.get(qid, {}).get('P31', []):
+        types |= {c} | superclasses(entities, c)
+    return types
+
+def category_closure(entities, qid, category):
+    """ the types of qid in a category as the original per-category queries defined them, including qid """
+    entity = entities.get(qid, {})
+    if category == 'all':
+        types = instance_types(entities, qid) | superclasses(entities, qid)
+    elif category == 'instance':
+        types = instance_types(entities, qid)
+    elif category == 'strictinstance':
+        types = set() if entity.get('P279') else instance_types(entities, qid)
+    elif category == 'strictconcept':
+        types = set() if entity.get('P31') else superclasses(entities, qid)
+    else:
+        types = superclasses(entities, qid)
+    return types | {qid}
+
+## the fake services
+
+class FakeResponse:
+
+    def __init__(self, data, status_code=200, headers=None):
+        self.data = data
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    def json(self):
+        return self.data
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} error")
+
+def uri(qid):
+    return {'type': 'uri', 'value': 'http://www.wikidata.org/entity/' + qid}
+
+def literal(value):
+    return {'type': 'literal', 'value': value}
+
+class FakeWikidata:
+    """ stands in for wd_search.http, answering api and sparql requests
+    from a dict of entities and recording them in calls """
+
+    def __init__(self, entities=ENTITIES):
+        self.entities = entities
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def count(self, kind):
+        """ the number of requests of a kind: search, wbgetentities, sparql or dbpedia """
+        return sum(1 for k, params in self.calls if k == kind)
+
+    def get(self, url, params=None, headers=None, timeout=None):
+        host = urlparse(url).netloc
+        if 'dbpedia' in host:
+            self.record('dbpedia', params)
+            return FakeResponse({'results': {'bindings': []}})
+        if 'query.wikidata.org' in host:
+            self.record('sparql', params)
+            return FakeResponse(self.sparql(params['query']))
+        action = params.get('action')
+        if action == 'query' and params.get('list') == 'search':
+            self.record('search', params)
+            return FakeResponse({'query': {'search': self.search(params['srsearch'], int(params['srlimit']))}})
+        if action == 'wbsearchentities':
+            self.record('search', params)
+            hits = self.search(params['search'], int(params['limit']))
+            return FakeResponse({'search': [{'id': h['title'], 'title': h['title'], 'label': self.entities[h['title']]['label'],
+                                             'description': h['snippet']} for h in hits]})
+        if action == 'wbgetentities':
+            self.record('wbgetentities', params)
+            return FakeResponse({'entities': self.wbgetentities(params['ids'].split('|'), params.get('props', ''))})
+        raise AssertionError(f"unexpected request to {url}: {params}")
+
+    def post(self, url, data=None, headers=None, timeout=None):
+        return self.get(url, data, headers, timeout)
+
+    def record(self, kind, params):
+        with self.lock:
+            self.calls.append((kind, params))
+
+    def search(self, string, limit):
+        """ the items with every word of string in their label, aliases or description, in id order """
+        query = words(string)
+        hits = []
+        for qid, e in self.entities.items():
+            text = words(' '.join([e['label'], e['description']] + e.get('aliases', [])))
+            if query and all(w in text for w in query):
+                label = e['label']
+                for w in sorted(set(query), key=len, reverse=True):
+                    label = re.sub(f"(?i)\\b({re.escape(w)})\\b", r'<span class="searchmatch">\1</span>', label)
+                hits.append({'ns': 0, 'title': qid, 'titlesnippet': label, 'snippet': e['description']})
+        return hits[:limit]
+
+    def wbgetentities(self, qids, props):
+        result = {}
+        for qid in qids:
+            e = self.entities.get(qid)
+            if e is None:
+                result[qid] = {'id': qid, 'missing': ''}
+                continue
+            data = {'id': qid, 'labels': {'en': {'language': 'en', 'value': e['label']}}}
+            if 'descriptions' in props:
+                data['descriptions'] = {'en': {'language': 'en', 'value': e['description']}}
+            if 'aliases' in props:
+                data['aliases'] = {'en': [{'language': 'en', 'value': a} for a in e.get('aliases', [])]}
+            if 'sitelinks' in props:
+                data['sitelinks'] = {site: {'site': site, 'title': title} for site, title in e.get('sitelinks', {}).items()}
+            result[qid] = data
+        return result
+
+    def sparql(self, query):
+        qids = re.findall(r'wd:(Q\d+)', query)
+        rows = []
+        if 'BIND ("self"' in query:
+            for qid in qids:
+                e = self.entities.get(qid, {})
+                rows.append({'item': uri(qid), 'view': literal('self'),
+                             'p31': literal('true' if e.get('P31') else 'false'), 'p279': literal('true' if e.get('P279') else 'false')})
+                rows += [{'item': uri(qid), 'type': uri(t), 'view': literal('instance')} for t in sorted(instance_types(self.entities, qid))]
+                rows += [{'item': uri(qid), 'type': uri(t), 'view': literal('concept')} for t in sorted(superclasses(self.entities, qid))]
+        elif '?item ?p ?class' in query:
+            for qid in qids:
+                for prop in ('P31', 'P279'):
+                    p = {'type': 'uri', 'value': 'http://www.wikidata.org/prop/direct/' + prop}
+                    rows += [{'item': uri(qid), 'p': p, 'class': uri(c)} for c in self.entities.get(qid, {}).get(prop, [])]
+        else:
+            raise AssertionError(f"unexpected sparql query: {query}")
+        return {'head': {}, 'results': {'bindings': rows}}
+
+## json dumps
+
+def entity_json(qid, e):
+    """ an entity as it is in a wikidata json dump """
+    def claim(prop, value):
+        if re.fullmatch(r'Q\d+', value):
+            datavalue = {'value': {'entity-type': 'item', 'id': value, 'numeric-id': int(value[1:])}, 'type': 'wikibase-entityid'}
+        else:
+            datavalue = {'value': value, 'type': 'string'}
+        return {'mainsnak': {'snaktype': 'value', 'property': prop, 'datavalue': datavalue},
+                'type': 'statement', 'rank': 'normal'}
+    entity = {'type': 'item' if qid[0] == 'Q' else 'property', 'id': qid,
+              'labels': {'en': {'language': 'en', 'value': e['label']}} if e.get('label') else {},
+              'descriptions': {'en': {'language': 'en', 'value': e['description']}} if e.get('description') else {},
+              'aliases': {'en': [{'language': 'en', 'value': a} for a in e['aliases']]} if e.get('aliases') else {},
+              'claims': {prop: [claim(prop, v) for v in values] for prop, values in e.items() if re.fullmatch(r'P\d+', prop) and values},
+              'sitelinks': {site: {'site': site, 'title': title, 'badges': []} for site, title in e.get('sitelinks', {}).items()}}
+    return json.dumps(entity)
+
+def dump_lines(entities):
+    return ['[\n'] + [entity_json(qid, e) + ',\n' for qid, e in entities.items()][:-1] + \
+           [entity_json(*list(entities.items())[-1]) + '\n', ']\n']
+
+def write_dump(path, entities, streams=1):
+    """ write entities as a json dump to path, compressed as its extension
+    says; a .bz2 dump is written as streams bz2 streams, as pbzip2 does """
+    data = ''.join(dump_lines(entities)).encode('utf-8')
+    if path.endswith('.gz'):
+        with gzip.open(path, 'wb') as f:
+            f.write(data)
+    elif path.endswith('.bz2'):
+        lines = data.splitlines(keepends=True)
+        size = -(-len(lines) // streams)
+        with open(path, 'wb') as f:
+            for i in range(0, len(lines), size):
+                f.write(bz2.compress(b''.join(lines[i:i+size])))
+    else:
+        with open(path, 'wb') as f:
+            f.write(data)
+    return path
@@ -0,0 +1,82 @@
+import numpy as np
+import pytest
+
+import embedding_store as es
+
+def vectors(n, dim=8, seed=0):
+    return np.random.default_rng(seed).normal(size=(n, dim)).astype(np.float32)
+
+def test_vectors_are_stored_as_float16(tmp_path):
+    store = es.EmbeddingStore(str(tmp_path), 'md')
+    v = vectors(3)
+    assert store.put_many(['Q1', 'Q2', 'P3'], v) == 3
+    found = store.get_many(['Q2', 'Q1', 'Q9', 'P3', 'not an id'])
+    assert list(found) == ['Q2', 'Q1', 'P3']
+    for i, qid in enumerate(['Q1', 'Q2', 'P3']):
+        assert found[qid].dtype == np.float32
+        assert np.allclose(found[qid], v[i], atol=1e-2)
+    assert len(store) == 3
+
+def test_ids_already_stored_are_not_added(tmp_path):
+    store = es.EmbeddingStore(str(tmp_path), 'md')
+    v = vectors(2)
+    store.put_many(['Q1', 'Q2'], v)
+    assert store.put_many(['Q2', 'Q3'], vectors(2, seed=1)) == 1
+    assert np.allclose(store.get_many(['Q2'])['Q2'], v[1], atol=1e-2)
+    assert store.put_many(['Q1'], v[:1]) == 0 and store.rows == 3
+
+def test_other_processes_see_added_rows(tmp_path):
+    first = es.EmbeddingStore(str(tmp_path), 'md')
+    second = es.EmbeddingStore(str(tmp_path), 'md')
+    v = vectors(4)
+    first.put_many(['Q1', 'Q2'], v[:2])
+    assert list(second.get_many(['Q1', 'Q2'])) == ['Q1', 'Q2']
+    second.put_many(['Q3', 'Q4'], v[2:])
+    found = first.get_many(['Q1', 'Q2', 'Q3', 'Q4'])
+    assert np.allclose(np.array([found[q] for q in ['Q1', 'Q2', 'Q3', 'Q4']]), v, atol=1e-2)
+
+def test_compacting_indexes_every_row(tmp_path):
+    store = es.EmbeddingStore(str(tmp_path), 'md')
+    v = vectors(50)
+    qids = [f'Q{n}' for n in np.random.default_rng(2).permutation(1000)[:50]]
+    store.put_many(qids[:30], v[:30])
+    assert store.compact() == 30 and not store.tail
+    store.put_many(qids[30:], v[30:])
+    assert len(store.tail) == 20 and len(store) == 50
+    reopened = es.EmbeddingStore(str(tmp_path), 'md')
+    assert len(reopened.tail) == 20 and len(reopened.index_ids) == 30
+    found = reopened.get_many(qids)
+    assert np.allclose(np.array([found[q] for q in qids]), v, atol=1e-2)
+    assert reopened.compact() == 50 and len(reopened) == 50
+
+def test_vectors_from_another_model_are_refused(tmp_path):
+    es.EmbeddingStore(str(tmp_path), 'md').put_many(['Q1'], vectors(1))
+    with pytest.raises(ValueError):
+        es.EmbeddingStore(str(tmp_path), 'lg')
+    store = es.EmbeddingStore(str(tmp_path))
+    assert store.meta['model'] == 'md'
+    with pytest.raises(ValueError):
+        store.put_many(['Q2'], vectors(1, dim=4))
+
+def test_read_qids(tmp_path):
+    path = tmp_path / 'qids.txt'
+    path.write_text('Q1\nhttp://www.wikidata.org/entity/Q42\n\nnot an id\n  P31 \n')
+    assert es.read_qids(str(path)) == ['Q1', 'Q42', 'P31']
+
+def test_wd_search_shares_vectors_through_the_store(wds, wikidata, monkeypatch, tmp_path):
+    computed = []
+    def text_vectors(texts):
+        computed.extend(texts)
+        return vectors(len(texts), seed=len(computed))
+    monkeypatch.setattr(wds, 'text_vectors', text_vectors)
+    monkeypatch.setattr(wds, 'EMBEDDING_STORE', str(tmp_path / 'store'))
+    monkeypatch.setattr(wds, 'embedding_store', None)
+    es.prefill(str(tmp_path / 'store'), ['Q1001', 'Q1003'])
+    assert len(computed) == 2
+    first = wds.item_vectors(['Q1001', 'Q1003', 'Q1009'])
+    assert len(computed) == 3 and wds.get_stats()['vectors_stored'] == 2
+    # as if in another process
+    wds.item_vector.cache_clear()
+    monkeypatch.setattr(wds, 'embedding_store', None)
+    assert np.allclose(wds.item_vectors(['Q1009', 'Q1001', 'Q1003']), first[[2, 0, 1]], atol=1e-2)
+    assert len(computed) == 3
@@ -0,0 +1,82 @@
+import os
+
+import pytest
+
+import label_index as li
+from wd_ids import qid2int, int2qid
+from fake_wikidata import ENTITIES, write_dump
+
+def sitelinks(qid):
+    return len(ENTITIES[qid].get('sitelinks', {}))
+
+def names(qid):
+    e = ENTITIES[qid]
+    return {li.normalize(name) for name in [e['label']] + e.get('aliases', [])}
+
+@pytest.fixture(scope='module')
+def index(tmp_path_factory):
+    tmp = tmp_path_factory.mktemp('label_index')
+    dump = write_dump(str(tmp / 'dump.json'), ENTITIES)
+    li.RUN_SIZE, run_size = 7, li.RUN_SIZE    # so the postings are merged from many runs
+    try:
+        li.build_index(dump, str(tmp / 'index'), workers=2)
+    finally:
+        li.RUN_SIZE = run_size
+    return li.LabelIndex(str(tmp / 'index'))
+
+def test_entities(index):
+    qids = sorted(ENTITIES, key=qid2int)
+    assert index.ids.tolist() == [qid2int(qid) for qid in qids]
+    for i, qid in enumerate(qids):
+        assert index.sitelinks[i] == sitelinks(qid)
+        assert index.labels[i] == ENTITIES[qid]['label']
+        assert index.descriptions[i] == ENTITIES[qid]['description']
+
+def postings(table):
+    return {table.keys[i]: [int2qid(n) for n in table.postings[table.offsets[i]:table.offsets[i+1]]]
+            for i in range(len(table.keys))}
+
+def test_keys_match_brute_force(index):
+    expected = {}
+    for qid in ENTITIES:
+        for name in names(qid):
+            expected.setdefault(name, set()).add(qid)
+    found = postings(index.keys)
+    assert list(found) == sorted(expected)
+    for key, qids in found.items():
+        assert set(qids) == expected[key]
+        assert [sitelinks(qid) for qid in qids] == sorted((sitelinks(qid) for qid in qids), reverse=True)
+
+def test_tokens_match_brute_force(index):
+    expected = {}
+    for qid, e in ENTITIES.items():
+        for word in li.tokenize(' '.join(names(qid)) + ' ' + e['description']):
+            expected.setdefault(word, set()).add(qid)
+    found = postings(index.tokens)
+    assert list(found) == sorted(expected)
+    assert all(set(qids) == expected[word] for word, qids in found.items())
+
+def test_search(index):
+    hits = index.search('Ada', limit=20)
+    # exact matches, then ones starting with it, each with the most sitelinks first
+    assert [hit['title'] for hit in hits] == ['Q1002', 'Q1003', 'Q1001', 'Q1006', 'Q1004', 'Q1005']
+    assert hits[0]['label'] == 'Ada' and hits[0]['snippet'] == hits[0]['description']
+    assert [hit['title'] for hit in index.search('psg')] == ['Q1009']
+    assert [hit['title'] for hit in index.search('borrelia bacteria')] == ['Q1010']
+    assert len(index.search('Ada', limit=3)) == 3
+    assert index.search('zorblax') == [] and index.search('  ') == []
+
+def test_runs_give_the_same_index(index, tmp_path):
+    # records in another order, written from one run
+    records = [li.index_record({'id': qid, 'labels': {'en': {'value': e['label']}}, 'descriptions': {'en': {'value': e['description']}},
+                                'aliases': {'en': [{'value': a} for a in e.get('aliases', [])]},
+                                'sitelinks': e.get('sitelinks', {})}, ['en'])
+               for qid, e in reversed(list(ENTITIES.items()))]
+    li.write_index(str(tmp_path), records)
+    other = li.LabelIndex(str(tmp_path))
+    assert (other.ids == index.ids).all() and (other.sitelinks == index.sitelinks).all()
+    assert [other.labels[i] for i in range(len(other.ids))] == [index.labels[i] for i in range(len(index.ids))]
+    for table in ('keys', 'tokens'):
+        a, b = postings(getattr(index, table)), postings(getattr(other, table))
+        assert a.keys() == b.keys() and all(sorted(a[k]) == sorted(b[k]) for k in a)
+    assert not [name for name in os.listdir(tmp_path) if name.startswith('tmp')]
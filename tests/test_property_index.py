@@ -0,0 +1,69 @@
+import os
+import sys
+import subprocess
+
+import yaml
+import pytest
+
+import property_index as pi
+from fake_wikidata import ENTITIES, write_dump
+from conftest import ROOT, config
+
+# the fixture entities with some MeSH descriptor ids and exact matches
+WORLD = {qid: dict(e) for qid, e in ENTITIES.items()}
+WORLD['Q1005']['P486'] = ['D000001']
+WORLD['Q1010']['P486'] = ['D008193', 'D008194']
+WORLD['Q12136']['P486'] = ['D004194']
+WORLD['Q1010']['P2888'] = ['http://purl.obolibrary.org/obo/DOID_11729']
+WORLD['Q1001']['P2888'] = []
+PROPS = ['P486', 'P2888', 'P3098']
+
+def brute_force(qid, prop):
+    return bool(WORLD.get(qid, {}).get(prop))
+
+@pytest.fixture(scope='module', params=['dump', 'file'])
+def index(request, tmp_path_factory):
+    tmp = tmp_path_factory.mktemp('property_index')
+    path = str(tmp / 'index')
+    if request.param == 'dump':
+        pi.build_from_dump(write_dump(str(tmp / 'dump.json.bz2'), WORLD, streams=2), path, PROPS, workers=2)
+    else:
+        # ids and entity urls as the query service gives them
+        for prop in PROPS:
+            with open(tmp / f'{prop}.txt', 'w') as f:
+                for qid in WORLD:
+                    if brute_force(qid, prop):
+                        f.write(f'http://www.wikidata.org/entity/{qid}\n' if qid < 'Q1006' else f'{qid}\n')
+                f.write('item\n')
+            pi.build_from_file(str(tmp / f'{prop}.txt'), path, prop)
+    return pi.PropertyIndex(path)
+
+def test_has_matches_brute_force(index):
+    for prop in PROPS:
+        assert index.exists(prop)
+        for qid in list(WORLD) + ['Q1', 'Q99999999']:
+            assert index.has(prop, qid) == brute_force(qid, prop), (prop, qid)
+    assert list(index.items('P486')) == sorted(int(qid[1:]) for qid in ['Q1005', 'Q1010', 'Q12136'])
+    assert not index.exists('P31')
+
+def test_search_infers_types_from_the_index(wds, wikidata, monkeypatch, tmp_path):
+    pi.save_items(str(tmp_path / 'index'), 'P486', [qid for qid in WORLD if brute_force(qid, 'P486')])
+    monkeypatch.setattr(wds, 'INFERRED_TYPES', {'P486': {'type': 'Q199897', 'label': 'MESH'}})
+    monkeypatch.setattr(wds, 'inferred_types_index', pi.PropertyIndex(str(tmp_path / 'index')), raising=False)
+    assert wds.infer_types('Q1010', 'all') == {199897} and wds.infer_types('Q1001', 'all') == set()
+    hits = wds.search('Ada', target_types=['Q199897'], good_types=[], ok_types=[], bad_types=[], complete=False)
+    assert [hit['id'] for hit in hits] == ['Q1005']
+
+def test_configured_inferred_types_build_and_use_the_index(tmp_path):
+    with open(tmp_path / 'mesh_items.txt', 'w') as f:
+        f.write('http://www.wikidata.org/entity/Q1005\nQ1010\n')
+    with open(tmp_path / 'wd_search_config.yml', 'w') as f:
+        yaml.dump(dict(config, INFERRED_TYPES={'P486': {'type': 'Q199897', 'label': 'MESH', 'items': 'mesh_items.txt'}},
+                       PROPERTY_INDEX='mesh_index'), f)
+    script = ("import wd_search as wds; "
+              "print(type(wds.inferred_types_index).__name__, sorted(wds.infer_types('Q1005', 'all')), "
+              "sorted(wds.infer_types('Q1001', 'all')))")
+    out = subprocess.run([sys.executable, '-c', script], cwd=tmp_path, capture_output=True, text=True,
+                         env=dict(os.environ, PYTHONPATH=ROOT), check=True).stdout
+    assert out.split('\n')[-2] == 'PropertyIndex [199897] []'
+    assert os.path.exists(tmp_path / 'mesh_index' / 'P486.npy')
@@ -0,0 +1,64 @@
+import os
+import random
+
+import pytest
+
+import sitelink_index as si
+from wd_ids import qid2int, int2qid
+from fake_wikidata import ENTITIES, write_dump
+
+@pytest.fixture(scope='module')
+def index_path(tmp_path_factory):
+    tmp = tmp_path_factory.mktemp('sitelink_index')
+    si.build_index(write_dump(str(tmp / 'dump.json.gz'), ENTITIES, streams=2), str(tmp / 'index'), workers=2)
+    return str(tmp / 'index')
+
+def test_lookup(index_path):
+    index = si.SitelinkIndex(index_path)
+    assert index.lookup('Q1001') == (3, 'Ada Lovelace')
+    assert index.lookup('Q1009') == (1, 'Paris Saint-Germain F.C.')
+    # no sitelinks, but older than the newest item with some
+    assert index.lookup('Q1004') == (0, '') and index.lookup('Q5') == (0, '')
+    # newer than the dump
+    assert index.lookup('Q99999999') is None
+    for qid, e in ENTITIES.items():
+        if e.get('sitelinks'):
+            assert index.lookup(qid) == (len(e['sitelinks']), e['sitelinks'].get('enwiki', ''))
+
+def test_records_in_any_order_are_written_sorted_by_id(tmp_path):
+    records = [(qid2int(qid), len(e['sitelinks']), e['sitelinks'].get('enwiki', ''))
+               for qid, e in ENTITIES.items() if e.get('sitelinks')]
+    random.Random(1).shuffle(records)
+    si.write_index(str(tmp_path / 'index'), iter(records))
+    index = si.SitelinkIndex(str(tmp_path / 'index'))
+    assert list(index.ids) == sorted(r[0] for r in records)
+    for n, count, title in records:
+        assert index.lookup(int2qid(n)) == (count, title)
+    assert sorted(os.listdir(tmp_path / 'index')) == ['enwiki.bin', 'enwiki_offsets.npy', 'ids.npy', 'sitelinks.npy']
+
+def checked(wikidata):
+    """ the items whose types were queried """
+    return {qid for kind, params in wikidata.calls if kind == 'sparql'
+            for qid in ['Q1001', 'Q1002', 'Q1003', 'Q1004', 'Q1005', 'Q1006'] if f'wd:{qid} ' in params['query'] + ' '}
+
+@pytest.fixture
+def pruning(wds, monkeypatch, index_path):
+    monkeypatch.setattr(wds, 'PRUNE_OBSCURE_CANDIDATES', True)
+    monkeypatch.setattr(wds, 'SITELINK_INDEX', index_path)
+    monkeypatch.setattr(wds, 'local_sitelink_index', None)
+    monkeypatch.setattr(wds, 'MIN_SITELINKS', 2)
+    return wds
+
+def test_obscure_candidates_are_pruned_given_top_target_hits(pruning, wikidata):
+    hits = pruning.search('Ada', target_types=['Q5'], good_types=[], ok_types=[], bad_types=[], top=1,
+                          promote_exact_label_match=False, complete=False)
+    assert [hit['id'] for hit in hits] == ['Q1001']
+    assert pruning.get_stats()['candidates_pruned'] == 5
+    assert checked(wikidata) == {'Q1001'}
+
+def test_obscure_candidates_are_checked_without_top_target_hits(pruning, wikidata):
+    hits = pruning.search('Ada', target_types=['Q5'], good_types=[], ok_types=[], bad_types=[], top=2,
+                          promote_exact_label_match=False, complete=False)
+    assert [hit['id'] for hit in hits] == ['Q1001', 'Q1006']
+    assert 'candidates_pruned' not in pruning.get_stats()
+    assert checked(wikidata) == {'Q1001', 'Q1002', 'Q1003', 'Q1004', 'Q1005', 'Q1006'}
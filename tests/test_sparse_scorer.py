@@ -0,0 +1,77 @@
+from math import sqrt
+from collections import Counter
+
+import pytest
+
+import sparse_scorer as ss
+from label_index import tokenize
+from fake_wikidata import ENTITIES, write_dump
+
+def document_frequencies():
+    df = Counter()
+    for e in ENTITIES.values():
+        df.update(set(tokenize(e['label'] + ' ' + e['description'])))
+    return df
+
+@pytest.fixture(scope='module')
+def table(tmp_path_factory):
+    tmp = tmp_path_factory.mktemp('idf_table')
+    dump = write_dump(str(tmp / 'dump.json.bz2'), ENTITIES, streams=4)
+    ss.build_table(dump, str(tmp / 'table'), workers=2)
+    return str(tmp / 'table')
+
+def test_idfs_match_brute_force(table):
+    idfs = ss.IdfTable(table)
+    df = document_frequencies()
+    n = len(ENTITIES)
+    assert idfs.n == n
+    assert idfs.avgdl == pytest.approx(sum(len(tokenize(e['label'] + ' ' + e['description'])) for e in ENTITIES.values()) / n)
+    assert list(idfs.words) == sorted(word for word, count in df.items() if count >= ss.MIN_DF)
+    for word, count in df.items():
+        expected = ss.idf(n, count if count >= ss.MIN_DF else 0)
+        assert idfs.get(word) == pytest.approx(expected, rel=1e-6), word
+    assert idfs.get('zorblax') == ss.idf(n, 0) and ss.idf(n, n) > 0
+
+TEXTS = ['Ada Lovelace English mathematician and writer', 'Ada programming language', 'Ada fever infectious disease of cattle']
+
+def test_tfidf_is_the_cosine_of_idf_weighted_counts(table):
+    scorer = ss.SparseScorer(table, 'tfidf')
+    context = 'the mathematician wrote about a language'
+    def vector(text):
+        return {word: n * scorer.idf.get(word) for word, n in Counter(tokenize(text)).items()}
+    q = vector(context)
+    for text, score in zip(TEXTS, scorer.scores(TEXTS, context)):
+        d = vector(text)
+        dot = sum(w * q.get(word, 0) for word, w in d.items())
+        assert score == pytest.approx(dot / sqrt(sum(w * w for w in d.values())) / sqrt(sum(w * w for w in q.values())), rel=1e-5)
+    assert scorer.scores(TEXTS, 'cattle disease').argmax() == 2
+    assert scorer.scores(TEXTS, 'nothing here').tolist() == [0, 0, 0]
+
+def test_bm25_matches_its_formula(table):
+    scorer = ss.SparseScorer(table, 'bm25')
+    context = 'English writer and mathematician'
+    query = Counter(tokenize(context))
+    for text, score in zip(TEXTS, scorer.scores(TEXTS, context)):
+        doc = Counter(tokenize(text))
+        length = sum(doc.values())
+        expected = sum(scorer.idf.get(word) * q * doc[word] * (ss.K1 + 1) /
+                       (doc[word] + ss.K1 * (1 - ss.B + ss.B * length / scorer.idf.avgdl))
+                       for word, q in query.items())
+        assert score == pytest.approx(expected, rel=1e-5)
+    assert scorer.scores(TEXTS, context).argmax() == 0
+    assert scorer.scores(TEXTS, 'programming').argmax() == 1
+
+def test_wd_search_scores_entity_text_with_the_sparse_scorer(wds, wikidata, monkeypatch, table):
+    scorer = ss.SparseScorer(table, 'bm25')
+    monkeypatch.setattr(wds, 'sparse_scorer', scorer)
+    monkeypatch.setattr(wds, 'text_vectors', lambda texts: pytest.fail("no vectors with a sparse scorer"))
+    # hits with search snippets are scored on the items' own text, as vectors are
+    hits = [{'id': qid, 'label': ENTITIES[qid]['label'], 'description': 'a search snippet', 'score': 0.0}
+            for qid in ('Q1001', 'Q1003', 'Q1005')]
+    wds.score_hits(hits, 'a disease of cattle')
+    texts = [wds.hit_text(ENTITIES[hit['id']]) for hit in hits]
+    assert [hit['score'] for hit in hits] == pytest.approx(scorer.scores(texts, 'a disease of cattle').tolist())
+    assert max(hits, key=lambda hit: hit['score'])['id'] == 'Q1005'
+    assert [(kind, params['props']) for kind, params in wikidata.calls] == [('wbgetentities', 'labels|descriptions')]
+    wds.score_hits(hits, 'a programming language')
+    assert len(wikidata.calls) == 1
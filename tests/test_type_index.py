@@ -0,0 +1,89 @@
+import numpy as np
+import pytest
+
+import type_index as ti
+from wd_ids import qid2int
+from fake_wikidata import ENTITIES, write_dump, instance_types, superclasses
+
+# the fixture entities, a subclass cycle, an item with no types and a property
+WORLD = dict(ENTITIES)
+WORLD.update({
+    'Q2001': {'label': 'thing a', 'description': 'in a cycle', 'P279': ['Q2002']},
+    'Q2002': {'label': 'thing b', 'description': 'in a cycle', 'P279': ['Q2001', 'Q12136']},
+    'Q2003': {'label': 'cyclic thing', 'description': 'an instance of a class in a cycle', 'P31': ['Q2001']},
+    'Q2004': {'label': 'untyped', 'description': 'has no P31 or P279'},
+    'P1001': {'label': 'some property', 'description': 'a property', 'P31': ['Q2001']},
+    'P1000': {'label': 'untyped property', 'description': 'has no P31'},
+})
+CLASSES = ['Q215627', 'Q5', 'Q43229', 'Q4830453', 'Q476028', 'Q12136', 'Q18123741', 'Q4167410', 'Q515', 'Q9143', 'Q2001']
+# more than 64 types, so masks take more than one word
+TYPES = sorted(CLASSES + [f'Q{9000 + i}' for i in range(70)], key=qid2int)
+
+def expected_record(qid):
+    indexed = {qid2int(t) for t in TYPES}
+    return {'instance': {qid2int(t) for t in instance_types(WORLD, qid)} & indexed,
+            'concept': {qid2int(t) for t in superclasses(WORLD, qid)} & indexed,
+            'P31': bool(WORLD[qid].get('P31')), 'P279': bool(WORLD[qid].get('P279'))}
+
+def write_nt(path, entities):
+    with open(path, 'w') as f:
+        for qid, e in entities.items():
+            for prop in ('P31', 'P279'):
+                for value in e.get(prop, []):
+                    f.write(f"<http://www.wikidata.org/entity/{qid}> <http://www.wikidata.org/prop/direct/{prop}> "
+                            f"<http://www.wikidata.org/entity/{value}> .\n")
+    return path
+
+@pytest.fixture(scope='module', params=['dump.json.bz2', 'truthy.nt'])
+def index(request, tmp_path_factory):
+    tmp = tmp_path_factory.mktemp('type_index')
+    path = str(tmp / request.param)
+    write_nt(path, WORLD) if path.endswith('.nt') else write_dump(path, WORLD, streams=3)
+    ti.build_index(path, str(tmp / 'index'), TYPES, workers=2)
+    return ti.TypeIndex(str(tmp / 'index'))
+
+def test_records_match_brute_force_closures(index):
+    for qid in WORLD:
+        assert index.record(qid) == expected_record(qid), qid
+
+def test_unknown_ids_are_newer_than_the_dump(index):
+    assert index.record('Q1') == {'instance': set(), 'concept': set(), 'P31': False, 'P279': False}
+    assert index.record('Q99999999') is None
+    assert index.record('P1') == {'instance': set(), 'concept': set(), 'P31': False, 'P279': False}
+    assert index.record('P5000') is None
+
+def test_covers(index):
+    assert index.covers(['Q5', 'Q12136']) and not index.covers(['Q5', 'Q1001'])
+    assert index.labels[qid2int('Q5')] in ('human', 'Q5')
+
+def test_type_masks_match_breadth_first_search():
+    rng = np.random.default_rng(3)
+    for trial in range(30):
+        n = int(rng.integers(1, 200))
+        sub, sup = rng.integers(0, n, 2 * n), rng.integers(0, n, 2 * n)
+        rows = rng.choice(n, size=int(rng.integers(0, min(n, 130))), replace=False)
+        masks = ti.type_masks(np.arange(n), sub, sup, rows)
+        children = {}
+        for s, p in zip(sub.tolist(), sup.tolist()):
+            children.setdefault(p, set()).add(s)
+        for j, row in enumerate(rows.tolist()):
+            below, todo = set(), [row]
+            while todo:
+                c = todo.pop()
+                if c not in below:
+                    below.add(c)
+                    todo.extend(children.get(c, ()))
+            has_bit = (masks[:, j // 64] >> np.uint64(j % 64)) & np.uint64(1)
+            assert set(np.flatnonzero(has_bit).tolist()) == below, (trial, j)
+
+def test_wd_search_uses_the_index(wds, wikidata, monkeypatch, tmp_path):
+    path = write_dump(str(tmp_path / 'dump.json'), WORLD)
+    ti.build_index(path, str(tmp_path / 'index'), TYPES, workers=1)
+    monkeypatch.setattr(wds, 'TYPE_INDEX', str(tmp_path / 'index'))
+    monkeypatch.setattr(wds, 'local_type_index', None)
+    records = wds.get_type_records(['Q1001', 'Q1010', 'Q2004', 'Q1'], local=True)
+    assert wikidata.count('sparql') == 0
+    assert records['Q2004'] == {'instance': set(), 'concept': set(), 'P31': False, 'P279': False}
+    wds.get_type_records(['Q1001', 'Q99999999'], local=True)
+    assert wikidata.count('sparql') == 1 and 'wd:Q99999999' in wikidata.calls[0][1]['query']
+    assert 'wd:Q1001' not in wikidata.calls[0][1]['query']
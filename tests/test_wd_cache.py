@@ -0,0 +1,277 @@
+import os
+import json
+import time
+import signal
+import multiprocessing
+
+import pytest
+
+import wd_cache as wdc
+
+@pytest.fixture(autouse=True)
+def own_functions(monkeypatch):
+    """ keep the functions cached here out of wd_cache's list and refresher """
+    monkeypatch.setattr(wdc, 'cached_functions', [])
+    monkeypatch.setattr(wdc, 'refresher', None)
+
+@pytest.fixture
+def store(tmp_path):
+    return wdc.PersistentCache(str(tmp_path / 'cache.sqlite'), ttl=100, soft_ttl=10)
+
+def counted(store, name='square'):
+    """ a cached function and the list of arguments it was called with """
+    calls = []
+    @wdc.cached(100, store, name=name)
+    def square(qid, power=2):
+        calls.append(qid)
+        return int(qid[1:]) ** power
+    return square, calls
+
+def wait_for(condition, timeout=5):
+    end = time.time() + timeout
+    while not condition():
+        assert time.time() < end, "timed out"
+        time.sleep(0.01)
+
+def fill(path, start, n):
+    """ compute squares with a cached function in another process """
+    square, calls = counted(wdc.PersistentCache(path))
+    for i in range(start, start + n):
+        square(f'Q{i}')
+
+def in_processes(*tasks):
+    processes = [multiprocessing.get_context('fork').Process(target=func, args=args) for func, args in tasks]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+
+def test_processes_share_the_cache_file(tmp_path):
+    path = str(tmp_path / 'cache.sqlite')
+    in_processes((fill, (path, 0, 200)), (fill, (path, 100, 200)))
+    square, calls = counted(wdc.PersistentCache(path))
+    assert [square(f'Q{i}') for i in range(300)] == [i * i for i in range(300)]
+    assert calls == [] and square.cache_store.stats()['entries'] == {'square': 300}
+
+def test_a_store_opened_before_a_fork_works_after_it(tmp_path):
+    store = wdc.PersistentCache(str(tmp_path / 'cache.sqlite'))
+    square, calls = counted(store)
+    square('Q2')
+    in_processes((lambda: counted(store)[0]('Q3'), ()))
+    assert square('Q3') == 9 and calls == ['Q2']
+
+def test_key_qid():
+    assert wdc.key_qid(repr(('Q42', 'en'))) == 'Q42'
+    assert wdc.key_qid(repr(('P31',))) == 'P31'
+    assert wdc.key_qid(repr(('Paris', 'Q42'))) is None
+    assert wdc.key_qid(repr((42,))) is None
+
+def test_entries_are_shared_through_the_store(store, tmp_path):
+    square, calls = counted(store)
+    assert square('Q3') == 9 and square('Q3', 2) == 9
+    assert calls == ['Q3']
+    other, other_calls = counted(wdc.PersistentCache(str(tmp_path / 'cache.sqlite')))
+    assert other('Q3') == 9 and other_calls == []
+    assert store.stats()['entries'] == {'square': 1}
+
+def test_entries_past_the_hard_ttl_are_recomputed(store):
+    square, calls = counted(store)
+    store.put('square', repr(('Q3', 2)), 'old', stored=time.time() - 101)
+    assert store.get('square', repr(('Q3', 2))) == (False, None)
+    assert square('Q3') == 9 and calls == ['Q3']
+    # and ones that expired in memory
+    square.cache_memory.put(repr(('Q3', 2)), ('older', time.time() - 101))
+    store.put('square', repr(('Q3', 2)), 'old', stored=time.time() - 101)
+    assert square('Q3') == 9 and calls == ['Q3', 'Q3']
+
+def test_stale_entries_are_returned_then_refreshed(store, monkeypatch):
+    refresher = wdc.Refresher(batch_size=2, interval=0.05)
+    monkeypatch.setattr(wdc, 'refresher', refresher)
+    square, calls = counted(store)
+    batches = []
+    square.batch_refresh = lambda arg_tuples: batches.append(arg_tuples) or [int(q[1:]) ** p for q, p in arg_tuples]
+    for qid in ('Q2', 'Q3', 'Q4'):
+        store.put('square', repr((qid, 2)), 'stale', stored=time.time() - 11)
+    assert [square(qid) for qid in ('Q2', 'Q3', 'Q4')] == ['stale'] * 3
+    assert calls == [] and square.cache_info()['stale'] == 3
+    wait_for(lambda: refresher.stats()['refreshed'] == 3)
+    assert sorted(args for batch in batches for args in batch) == [('Q2', 2), ('Q3', 2), ('Q4', 2)]
+    assert max(len(batch) for batch in batches) <= 2
+    assert [square(qid) for qid in ('Q2', 'Q3', 'Q4')] == [4, 9, 16]
+    assert store.get('square', repr(('Q4', 2))) == (True, 16) and calls == []
+
+def test_failed_refreshes_leave_entries_stale(store, monkeypatch):
+    refresher = wdc.Refresher(interval=0.05)
+    monkeypatch.setattr(wdc, 'refresher', refresher)
+    square, calls = counted(store)
+    square.batch_refresh = lambda arg_tuples: 1 / 0
+    store.put('square', repr(('Q2', 2)), 'stale', stored=time.time() - 11)
+    assert square('Q2') == 'stale'
+    wait_for(lambda: refresher.stats()['failed'] == 1)
+    assert square('Q2') == 'stale'
+
+def test_the_invalidation_file_makes_entries_stale(store, tmp_path, monkeypatch):
+    square, calls = counted(store)
+    cube, cube_calls = counted(store, 'cube')
+    for qid in ('Q2', 'Q3'):
+        square(qid)
+        cube(qid, 3)
+    ids = tmp_path / 'invalidate.txt'
+    ids.write_text('Q2\n\nQ7\n')
+    refresher = wdc.Refresher(invalidation_file=str(ids))
+    monkeypatch.setattr(wdc, 'refresher', refresher)
+    refresher.check_invalidation_file()
+    assert not ids.exists() and (tmp_path / 'invalidate.txt.done').read_text() == 'Q2\n\nQ7\n'
+    assert refresher.stats()['invalidated'] == 4    # in memory and in the store
+    for func, power in ((square, 2), (cube, 3)):
+        value, stored = func.cache_memory.get(repr(('Q2', power)))[1]
+        assert store.stale(stored) and store.stale(store.get_entry(func.cache_info()['function'], repr(('Q2', power)))[2])
+    assert not store.stale(square.cache_memory.get(repr(('Q3', 2)))[1][1])
+    # stale entries are still returned until they're refreshed
+    square.cache_memory.clear()
+    assert square('Q2') == 4 and calls == ['Q2', 'Q3'] and square.cache_info()['stale'] == 1
+
+def test_without_a_soft_ttl_invalid_entries_are_removed(tmp_path):
+    store = wdc.PersistentCache(str(tmp_path / 'cache.sqlite'))
+    square, calls = counted(store)
+    square('Q2')
+    square('Q3')
+    assert wdc.invalidate({'Q2'}) == 2
+    assert store.get('square', repr(('Q2', 2))) == (False, None)
+    assert square('Q2') == 4 and square('Q3') == 9 and calls == ['Q2', 'Q3', 'Q2']
+
+def test_ttls_apply_to_memory_without_a_store(monkeypatch):
+    monkeypatch.setattr(wdc, 'memory_ttl', 0)
+    monkeypatch.setattr(wdc, 'memory_soft_ttl', 0)
+    wdc.set_ttls(100, 10)
+    refresher = wdc.Refresher(interval=0.05)
+    monkeypatch.setattr(wdc, 'refresher', refresher)
+    square, calls = counted(None)
+    square.cache_memory.put(repr(('Q2', 2)), ('stale', time.time() - 11))
+    square.cache_memory.put(repr(('Q3', 2)), ('expired', time.time() - 101))
+    assert square('Q3') == 9 and calls == ['Q3']
+    assert square('Q2') == 'stale' and square.cache_info()['stale'] == 1
+    wait_for(lambda: refresher.stats()['refreshed'] == 1)
+    assert square('Q2') == 4 and calls == ['Q3', 'Q2']
+    # invalid entries in memory are made stale too
+    assert wdc.invalidate({'Q3'}) == 1
+    assert square('Q3') == 9 and square.cache_info()['stale'] == 2
+    memo = wdc.Memo('results', 10)
+    memo.put(('Ada',), ['Q1001'])
+    memo.cache_memory.put(repr(('Paris',)), (['Q1007'], time.time() - 11))
+    assert memo.get(('Ada',)) == (True, ['Q1001']) and memo.get(('Paris',)) == (False, None)
+
+def test_the_oldest_entries_are_pruned(tmp_path, monkeypatch):
+    monkeypatch.setattr(wdc, 'PRUNE_INTERVAL', 1)
+    store = wdc.PersistentCache(str(tmp_path / 'cache.sqlite'), max_entries=3)
+    for i in range(5):
+        store.put('f', repr((f'Q{i}',)), i, stored=1000 + i)
+    assert [store.get('f', repr((f'Q{i}',)))[0] for i in range(5)] == [False, False, True, True, True]
+
+def test_the_memory_layer_keeps_to_its_byte_budget():
+    memory = wdc.MemoryCache(maxsize=1000, maxbytes=2000)
+    for i in range(100):
+        memory.put(repr((f'Q{i}',)), 'x' * 100)
+    assert memory.nbytes <= 2000 and memory.evictions == 100 - len(memory.data)
+    assert memory.nbytes == sum(memory.sizes.values())
+    assert memory.keys()[-1] == repr(('Q99',)) and memory.get(repr(('Q0',))) == (False, None)
+    # the least recently used go first
+    first = memory.keys()[0]
+    memory.get(first)
+    memory.put(repr(('Q100',)), 'x' * 100)
+    assert first in memory.keys()
+    memory.put(repr(('big',)), 'x' * 5000)    # bigger than the budget on its own
+    assert memory.nbytes == 0 and not memory.data
+    memory.set_budget(0)
+    for i in range(2000):
+        memory.put(i, i)
+    assert len(memory.data) == 1000
+
+def test_sizeof_counts_what_values_hold():
+    assert wdc.sizeof(['x' * 1000]) > 1000
+    assert wdc.sizeof({'a': {'b': 'x' * 1000}}) > 1000
+    shared = 'x' * 1000
+    assert wdc.sizeof([shared, shared]) < 2000
+
+def test_budgets_apply_to_functions_already_defined(monkeypatch):
+    monkeypatch.setattr(wdc, 'budgets', {})
+    monkeypatch.setattr(wdc, 'default_budget', 0)
+    square, calls = counted(None)
+    @wdc.cached(100)
+    def big(n):
+        return 'x' * n
+    wdc.set_budgets(1500, {'big': 3000, 'cube_ints': 2000, 'results': 1000})
+    # budgets are keyed by the names in cache_info and dumps
+    cube, cube_calls = counted(None, 'cube_ints')
+    memo = wdc.Memo('results', 10)
+    assert square.cache_memory.maxbytes == 1500 and big.cache_memory.maxbytes == 3000
+    assert cube.cache_memory.maxbytes == 2000 and memo.cache_memory.maxbytes == 1000
+    wdc.set_budgets(1500, {'square': 2500})
+    assert square.cache_memory.maxbytes == 2500 and cube.cache_memory.maxbytes == 1500
+    wdc.set_budgets(1500, {'big': 3000})
+    for n in range(1000, 1010):
+        big(n)
+    assert big.cache_info()['evictions'] > 0 and big.cache_info()['bytes'] <= 3000
+    report = wdc.memory_report()
+    assert [info['function'] for info in report] == ['big']
+
+def read_report(path):
+    """ the report dumped to path, or None until it's there in full """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+@pytest.fixture
+def signal_handlers(tmp_path):
+    if not hasattr(signal, 'SIGUSR1'):
+        pytest.skip("no SIGUSR1 here")
+    saved = {s: signal.getsignal(s) for s in (signal.SIGUSR1, signal.SIGUSR2)}
+    assert wdc.install_signal_handlers(str(tmp_path / 'dump.json'))
+    yield
+    for s, handler in saved.items():
+        signal.signal(s, handler)
+
+def test_signals_while_a_lock_is_held_do_not_deadlock(signal_handlers, tmp_path):
+    square, calls = counted(None)
+    for qid in ('Q2', 'Q3'):
+        square(qid)
+    with square.cache_memory.lock:
+        os.kill(os.getpid(), signal.SIGUSR1)
+        time.sleep(0.05)
+    wait_for(lambda: read_report(tmp_path / 'dump.json'))
+    report = read_report(tmp_path / 'dump.json')
+    assert report['pid'] == os.getpid() and report['functions'][0]['size'] == 2
+    with square.cache_memory.lock:
+        os.kill(os.getpid(), signal.SIGUSR2)
+        time.sleep(0.05)
+    wait_for(lambda: not square.cache_memory.data)
+    assert square('Q2') == 4 and calls == ['Q2', 'Q3', 'Q2']
+
+def test_memos_copy_values_in_and_out():
+    memo = wdc.Memo('results', 10)
+    value = {'hits': [1, 2]}
+    memo.put(('Ada', ('PERSON',)), value)
+    value['hits'].append(3)
+    found, got = memo.get(('Ada', ('PERSON',)))
+    assert found and got == {'hits': [1, 2]}
+    got['hits'].clear()
+    assert memo.get(('Ada', ('PERSON',))) == (True, {'hits': [1, 2]})
+    assert memo.get(('Ada', ('ORG',))) == (False, None)
+    assert memo.cache_info()['size'] == 1 and wdc.cached_functions == [memo]
+
+def test_memos_are_kept_in_the_store(tmp_path):
+    path = str(tmp_path / 'cache.sqlite')
+    memo = wdc.Memo('results', 10, wdc.PersistentCache(path, soft_ttl=10))
+    memo.put(('Ada',), ['Q1001'])
+    memo.put(('Paris',), ['Q1007'])
+    store = wdc.PersistentCache(path, soft_ttl=10)
+    other = wdc.Memo('results', 10, store)
+    assert other.get(('Ada',)) == (True, ['Q1001'])
+    # a stale result can't be refreshed, so it's recomputed
+    store.put('results', repr(('Paris',)), ['Q1007'], stored=time.time() - 11)
+    assert other.get(('Paris',)) == (False, None)
+    other.cache_clear()
+    assert wdc.Memo('results', 10, store).get(('Ada',)) == (False, None)
@@ -0,0 +1,86 @@
+import io
+import os
+import glob
+
+import pytest
+
+import wd_dump
+from fake_wikidata import ENTITIES, write_dump
+
+def label(entity):
+    """ the record extracted from each entity """
+    return (entity['id'], entity['labels'].get('en', {}).get('value'))
+
+def only_items(entity):
+    return label(entity) if entity['id'].startswith('Q1') else None
+
+def expected(path, extract=label):
+    return [r for r in map(extract, wd_dump.read_entities(path)) if r is not None]
+
+@pytest.mark.parametrize('name,streams,shard_size', [
+    ('dump.json', 1, 97), ('dump.json', 1, 1000), ('dump.json', 1, 1 << 30),
+    ('dump.json.gz', 1, 500), ('dump.json.bz2', 1, 500),
+    ('dump.json.bz2', 8, 1), ('dump.json.bz2', 8, 2000)])
+def test_ingest_gives_the_records_in_dump_order(tmp_path, name, streams, shard_size):
+    path = write_dump(str(tmp_path / name), ENTITIES, streams=streams)
+    shards = wd_dump.ingest(path, str(tmp_path / 'shards'), label, workers=3, shard_size=shard_size)
+    assert list(wd_dump.records(str(tmp_path / 'shards'))) == expected(path)
+    assert shards == len(glob.glob(str(tmp_path / 'shards' / 'shard-*.pkl')))
+    assert [record[0] for record in expected(path)] == list(ENTITIES)
+
+def test_every_line_belongs_to_one_shard(monkeypatch):
+    monkeypatch.setattr(wd_dump, 'CHUNK_SIZE', 7)
+    data = b'first line\nsecond\n\nfourth line is longer\nlast'
+    for split in range(len(data) + 1):
+        f = io.BytesIO(data)
+        lines = list(wd_dump.own_lines(wd_dump.plain_chunks(f, 0, split), True)) + \
+                list(wd_dump.own_lines(wd_dump.plain_chunks(f, split, len(data)), False))
+        assert lines == data.decode().split('\n'), split
+
+def test_bz2_streams_are_found(tmp_path):
+    path = write_dump(str(tmp_path / 'dump.json.bz2'), ENTITIES, streams=5)
+    assert len(wd_dump.bz2_streams(path)) == 5
+    assert wd_dump.plan_shards(path, 1)[0] == 'bz2' and len(wd_dump.plan_shards(path, 1)[1]) == 5
+    assert len(wd_dump.plan_shards(path, 1 << 30)[1]) == 1
+    single = write_dump(str(tmp_path / 'single.json.bz2'), ENTITIES)
+    assert wd_dump.plan_shards(single) == ('reader', [])
+
+def test_prefilter_and_extract_drop_lines(tmp_path):
+    path = write_dump(str(tmp_path / 'dump.json.bz2'), ENTITIES, streams=3)
+    wd_dump.ingest(path, str(tmp_path / 'a'), label, prefilter=['enwiki'], workers=2, shard_size=1)
+    assert list(wd_dump.records(str(tmp_path / 'a'))) == \
+           [label(e) for e in wd_dump.read_entities(path) if 'enwiki' in e['sitelinks']]
+    wd_dump.ingest(path, str(tmp_path / 'b'), only_items, workers=2, shard_size=1)
+    assert list(wd_dump.records(str(tmp_path / 'b'))) == expected(path, only_items)
+
+def test_lines_are_passed_without_a_parse_function(tmp_path):
+    path = write_dump(str(tmp_path / 'dump.json'), ENTITIES)
+    wd_dump.ingest(path, str(tmp_path / 'shards'), str.strip, parse=None, workers=2, shard_size=300)
+    with open(path) as f:
+        assert list(wd_dump.records(str(tmp_path / 'shards'))) == [line.strip() for line in f]
+
+@pytest.mark.parametrize('name,streams', [('dump.json', 1), ('dump.json.bz2', 6), ('dump.json.gz', 1)])
+def test_an_interrupted_run_keeps_its_shards(tmp_path, name, streams):
+    path = write_dump(str(tmp_path / name), ENTITIES, streams=streams)
+    workdir = str(tmp_path / 'shards')
+    wd_dump.ingest(path, workdir, label, workers=2, shard_size=1000)
+    shards = sorted(glob.glob(os.path.join(workdir, 'shard-*.pkl')))
+    assert len(shards) > 2
+    # as if the run was killed before the last shards were done
+    os.remove(shards[1])
+    os.rename(shards[-1], shards[-1] + '.tmp')
+    kept = {path: os.stat(path).st_mtime_ns for path in shards[2:-1] + shards[:1]}
+    wd_dump.ingest(path, workdir, label, workers=2, shard_size=1000)
+    assert all(os.stat(path).st_mtime_ns == mtime for path, mtime in kept.items())
+    assert list(wd_dump.records(workdir)) == expected(path)
+
+def test_another_dump_starts_over(tmp_path):
+    path = str(tmp_path / 'dump.json')
+    workdir = str(tmp_path / 'shards')
+    write_dump(path, ENTITIES)
+    wd_dump.ingest(path, workdir, label, workers=2, shard_size=500)
+    smaller = {qid: e for qid, e in ENTITIES.items() if qid != 'Q1001'}
+    write_dump(path, smaller)
+    os.utime(path, ns=(0, 0))
+    wd_dump.ingest(path, workdir, label, workers=2, shard_size=500)
+    assert list(wd_dump.records(workdir)) == expected(path) and ('Q1001', 'Ada Lovelace') not in expected(path)
@@ -0,0 +1,67 @@
+import json
+import threading
+from urllib.parse import parse_qs, urlparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+class Endpoint(BaseHTTPRequestHandler):
+    """ a sparql endpoint with no results that records the requests and connections it gets """
+    protocol_version = 'HTTP/1.1'   # keep connections alive
+
+    def answer(self, query):
+        self.server.requests.append((self.command, self.client_address[1], query))
+        body = json.dumps({'results': {'bindings': []}}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/sparql-results+json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.answer(parse_qs(urlparse(self.path).query)['query'][0])
+
+    def do_POST(self):
+        data = self.rfile.read(int(self.headers['Content-Length'])).decode()
+        self.answer(parse_qs(data)['query'][0])
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def endpoint():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Endpoint)
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, args=(0.01,), daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def url(server):
+    return f'http://127.0.0.1:{server.server_address[1]}/sparql'
+
+def test_one_session_with_a_pool_per_host(wds):
+    adapter = wds.http.get_adapter(wds.default_wd_endpoint)
+    assert adapter is wds.http.get_adapter(wds.default_wd_api)
+    assert adapter._pool_maxsize == wds.HTTP_POOL_SIZE
+    assert wds.http.headers['User-Agent'] == wds.USER_AGENT and 'gzip' in wds.http.headers['Accept-Encoding']
+
+def test_queries_reuse_a_connection(wds, endpoint):
+    for i in range(5):
+        assert wds.query_endpoint(f'select ?x {{ wd:Q{i} ?p ?x }}', url(endpoint)) == {'results': {'bindings': []}}
+    assert [command for command, port, query in endpoint.requests] == ['GET'] * 5
+    assert len({port for command, port, query in endpoint.requests}) == 1
+
+def test_long_queries_are_posted(wds, endpoint, monkeypatch):
+    monkeypatch.setattr(wds, 'MAX_GET_QUERY_LENGTH', 100)
+    short = 'select ?x { wd:Q1 ?p ?x }'
+    long = 'select ?x { VALUES ?item { ' + ' '.join(f'wd:Q{i}' for i in range(100)) + ' } ?item ?p ?x }'
+    wds.query_endpoint(short, url(endpoint))
+    wds.query_endpoint(long, url(endpoint))
+    assert [(command, query) for command, port, query in endpoint.requests] == [('GET', short), ('POST', long)]
+
+def test_concurrent_queries_share_the_pool(wds, endpoint):
+    wds.thread_map(lambda i: wds.query_endpoint(f'select ?x {{ wd:Q{i} ?p ?x }}', url(endpoint)), range(40))
+    assert len(endpoint.requests) == 40
+    assert len({port for command, port, query in endpoint.requests}) <= wds.HTTP_POOL_SIZE
@@ -0,0 +1,312 @@
+import random
+
+import numpy as np
+import pytest
+
+import wd_cache as wdc
+from wd_ids import qid2int
+from fake_wikidata import FakeWikidata, ENTITIES, instance_types, superclasses, category_closure
+
+ITEMS = [qid for qid in ENTITIES if 1000 < qid2int(qid) < 2000]
+
+def ints(qids):
+    return {qid2int(qid) for qid in qids}
+
+## type records
+
+def test_type_records_are_fetched_in_batches(wds, wikidata, monkeypatch):
+    monkeypatch.setattr(wds, 'TYPE_BATCH_SIZE', 5)
+    records = wds.get_type_records(ITEMS)
+    assert wikidata.count('sparql') == 3
+    for qid in ITEMS:
+        assert set(records[qid]['instance']) == ints(instance_types(ENTITIES, qid))
+        assert set(records[qid]['concept']) == ints(superclasses(ENTITIES, qid))
+        assert records[qid]['P31'] == bool(ENTITIES[qid].get('P31'))
+        assert records[qid]['P279'] == bool(ENTITIES[qid].get('P279'))
+
+def test_type_records_are_cached(wds, wikidata):
+    wds.get_type_records(ITEMS[:4])
+    queries = wikidata.count('sparql')
+    records = wds.get_type_records(ITEMS)
+    assert wikidata.count('sparql') == queries + 1
+    assert ITEMS[4] in wikidata.calls[-1][1]['query'] and ITEMS[0] not in wikidata.calls[-1][1]['query']
+    assert records['Q1001'] == wds.get_type_record('Q1001')
+    assert wikidata.count('sparql') == queries + 1
+
+def test_batched_types_match_single_queries(wds, wikidata):
+    batched = wds.query_for_types_batch(ITEMS, 'all')
+    wds.get_type_record.cache_clear()
+    for qid in ITEMS:
+        assert batched[qid] == wds.query_for_types(qid, 'all')
+
+def test_long_queries_are_posted(wds, wikidata, monkeypatch):
+    monkeypatch.setattr(wds, 'MAX_GET_QUERY_LENGTH', 100)
+    posted = []
+    monkeypatch.setattr(wikidata, 'post', lambda url, data=None, headers=None, timeout=None:
+                        posted.append(data) or wikidata.get(url, data, headers, timeout))
+    records = wds.get_type_records(ITEMS)
+    assert posted and set(records) == set(ITEMS)
+
+## completion
+
+def test_entities_are_fetched_in_batches(wds, wikidata, monkeypatch):
+    monkeypatch.setattr(wds, 'ENTITY_BATCH_SIZE', 5)
+    entities = wds.get_entities(ITEMS, ('en',))
+    assert len([p for kind, p in wikidata.calls if kind == 'wbgetentities' and 'sitelinks' in p['props']]) == 3
+    for qid in ITEMS:
+        e = ENTITIES[qid]
+        sitelinks = e.get('sitelinks', {})
+        assert entities[qid]['ladw']['en'] == (e['label'], e.get('aliases', []), e['description'], sitelinks.get('enwiki', ''))
+        assert entities[qid]['sitelinks'] == len(sitelinks)
+        assert entities[qid]['wikipedia'] == sitelinks.get('enwiki', '').replace(' ', '_')
+        assert entities[qid]['immediate_types'] == [c + ':' + ENTITIES[c]['label'] for c in e['P31']]
+    calls = len(wikidata.calls)
+    assert wds.get_entity('Q1001', ('en',)) == entities['Q1001']
+    assert len(wikidata.calls) == calls
+
+def test_complete_item_uses_the_entity(wds, wikidata):
+    item = wds.complete_item({'id': 'Q1009'}, ['en'], False)
+    assert item['en'] == {'label': 'Paris Saint-Germain', 'aliases': ['PSG'], 'description': 'French football club',
+                          'wikiname': 'Paris Saint-Germain F.C.'}
+    assert item['immediate_types'] == ['Q476028:association football club']
+    assert item['is_instance'] and not item['is_concept']
+    assert item['sitelinks'] == 1 and item['wikipedia'] == 'Paris_Saint-Germain_F.C.'
+    assert wikidata.count('wbgetentities') == 2    # the item and its types' labels
+
+## candidates
+
+def test_candidates_are_cached_including_misses(wds, wikidata):
+    hits = wds.get_candidates1('Ada', 'label_aliases_description', 20, 'en', '*')
+    assert wds.item_ids(hits) == [hit['title'] for hit in wikidata.search('Ada', 20)]
+    assert wds.get_candidates1('Zorblax', 'label_aliases_description', 20, 'en', '*') == []
+    searches = wikidata.count('search')
+    assert wds.get_candidates1('Ada', 'label_aliases_description', 20, 'en', '*') == hits
+    assert wds.get_candidates1('Zorblax', 'label_aliases_description', 20, 'en', '*') == []
+    assert wikidata.count('search') == searches
+
+def test_cached_candidates_are_copies(wds, wikidata):
+    hits = wds.get_candidates1('Paris', 'label_aliases_description', 20, 'en', '*')
+    hits[0]['label'] = 'changed'
+    hits.pop()
+    again = wds.get_candidates1('Paris', 'label_aliases_description', 20, 'en', '*')
+    assert 'label' not in again[0] and len(again) == len(hits) + 1
+
+def test_a_miss_falls_back_to_the_string_without_its_first_word(wds, wikidata):
+    assert wds.item_ids(wds.get_candidates('Zorblax Lyme disease')[1]) == ['Q1010']
+    assert wds.get_candidates('Zorblax Lyme disease')[0] == 'Lyme disease'
+    searches = wikidata.count('search')
+    wds.get_candidates('Zorblax Lyme disease')
+    assert wikidata.count('search') == searches
+
+def test_speculative_search_gives_the_same_candidates(wds, wikidata, monkeypatch):
+    expected = [wds.get_candidates(s) for s in ('Zorblax Lyme disease', 'Paris Hilton', 'Zorblax')]
+    wds.get_candidates1.cache_clear()
+    monkeypatch.setattr(wds, 'SPECULATIVE_SEARCH', True)
+    assert [wds.get_candidates(s) for s in ('Zorblax Lyme disease', 'Paris Hilton', 'Zorblax')] == expected
+
+## checking candidates
+
+def random_worlds(trials, seed=1):
+    """ worlds of up to 20 items called 'thing' or 'thing i', each with a random type """
+    rng = random.Random(seed)
+    classes = {qid: e for qid, e in ENTITIES.items() if qid2int(qid) < 1000 or qid2int(qid) > 2000}
+    for trial in range(trials):
+        world = dict(classes)
+        n = rng.randint(0, 20)
+        exact = set(rng.sample(range(n), k=min(n, rng.randint(0, 3))))
+        for i in range(n):
+            world[f'Q{3000 + i}'] = {'label': 'thing' if i in exact else f'thing {i}', 'description': 'a thing',
+                                     'P31': [rng.choice(['Q5', 'Q4830453', 'Q476028', 'Q18123741', 'Q4167410', 'Q515', 'Q9143'])]}
+        yield trial, world, dict(target_types=rng.choice([['PERSON'], ['ORG'], ['disease']]), top=rng.randint(1, 5),
+                                 limit=n or 1, promote_exact_label_match=bool(trial % 2))
+
+def test_adaptive_candidates_give_the_same_hits(wds, monkeypatch):
+    skipped = 0
+    for trial, world, args in random_worlds(100):
+        monkeypatch.setattr(wds, 'http', FakeWikidata(world))
+        results = []
+        for adaptive in (False, True):
+            monkeypatch.setattr(wds, 'ADAPTIVE_CANDIDATES', adaptive)
+            wds.get_candidates1.cache_clear()
+            wds.get_type_record.cache_clear()
+            hits = wds.search('thing', complete=False, **args)
+            results.append([(hit['id'], hit['types'], hit['search_rank']) for hit in hits])
+            if adaptive:
+                skipped += wds.get_stats().get('candidates_skipped', 0)
+        assert results[0] == results[1], trial
+    assert skipped > 0
+
+def test_concurrent_candidates_give_the_same_hits(wds, monkeypatch):
+    for trial, world, args in random_worlds(30, seed=2):
+        monkeypatch.setattr(wds, 'http', FakeWikidata(world))
+        results = []
+        for concurrent in (False, True):
+            monkeypatch.setattr(wds, 'CONCURRENT_CANDIDATES', concurrent)
+            wds.get_candidates1.cache_clear()
+            wds.get_type_record.cache_clear()
+            results.append([(hit['id'], hit['types']) for hit in wds.search('thing', complete=False, **args)])
+        assert results[0] == results[1], trial
+
+## categories
+
+def test_every_category_comes_from_one_type_query(wds, wikidata):
+    qids = ITEMS + ['Q5', 'Q18123741', 'Q43229']
+    for qid in qids:
+        queries = wikidata.count('sparql')
+        for category in wds.CATEGORIES:
+            assert wds.query_for_types(qid, category) == ints(category_closure(ENTITIES, qid, category)), (qid, category)
+        assert wikidata.count('sparql') == queries + 1
+
+def test_batched_categories_match(wds, wikidata):
+    for category in wds.CATEGORIES:
+        types = wds.query_for_types_batch(['Q1001', 'Q5', 'Q1010', 'Q18123741'], category)
+        assert types == {qid: ints(category_closure(ENTITIES, qid, category)) for qid in types}
+
+## context scores
+
+def letter_vectors(calls):
+    """ a text_vectors that counts the letters in each text and records the texts """
+    def text_vectors(texts):
+        calls.append(list(texts))
+        return np.array([[text.lower().count(c) for c in 'abcdefghijklmnopqrstuvwxyz'] for text in texts], dtype=np.float32)
+    return text_vectors
+
+def test_item_vectors_are_computed_once_from_the_entity(wds, wikidata, monkeypatch):
+    calls = []
+    monkeypatch.setattr(wds, 'text_vectors', letter_vectors(calls))
+    vectors = wds.item_vectors(['Q1001', 'Q1009', 'Q1001'])
+    # only their labels and descriptions are fetched, with no type queries
+    assert [(kind, params['props']) for kind, params in wikidata.calls] == [('wbgetentities', 'labels|descriptions')]
+    assert calls == [[wds.entity_text(wds.get_entity(qid, ('en',))) for qid in ('Q1001', 'Q1009')]]
+    assert calls[0][1] == 'Paris Saint-Germain French football club'
+    assert (vectors[0] == vectors[2]).all() and (vectors[1] == letter_vectors([])([calls[0][1]])[0]).all()
+    entity_calls = wikidata.count('wbgetentities')
+    assert (wds.item_vectors(['Q1009', 'Q1001']) == vectors[[1, 0]]).all()
+    assert (wds.item_vector('Q1009') == vectors[1]).all()
+    assert len(calls) == 1 and wikidata.count('wbgetentities') == entity_calls
+    assert wds.get_stats()['vectors_computed'] == 2
+
+def test_item_texts_come_from_cached_entities_or_a_labels_call(wds, wikidata, monkeypatch):
+    monkeypatch.setattr(wds, 'ENTITY_BATCH_SIZE', 2)
+    wds.get_entities(['Q1001'], ('en',))
+    before = len(wikidata.calls)
+    texts = wds.item_texts(['Q1001', 'Q1005', 'Q1009', 'Q1010'])
+    assert texts == {qid: wds.hit_text(ENTITIES[qid]) for qid in ('Q1001', 'Q1005', 'Q1009', 'Q1010')}
+    assert [params['ids'] for kind, params in wikidata.calls[before:]] == ['Q1005|Q1009', 'Q1010']
+    assert wds.item_texts(['Q1005']) == {'Q1005': texts['Q1005']} and len(wikidata.calls) == before + 2
+    assert wds.refresh_item_texts([('Q1005',), ('Q1009',), ('Q1010',)]) == [texts[qid] for qid in ('Q1005', 'Q1009', 'Q1010')]
+    assert len(wikidata.calls) == before + 4
+
+def test_cached_item_vectors_do_not_hold_their_batch(wds, wikidata, monkeypatch):
+    monkeypatch.setattr(wds, 'text_vectors', letter_vectors([]))
+    vectors = wds.item_vectors(ITEMS)
+    for qid in ITEMS:
+        found, vector = wds.item_vector.cache_get(qid)
+        assert found and vector.base is None
+    assert wds.item_vector.cache_memory.nbytes > vectors.nbytes
+
+def test_item_vector_matches_item_vectors(wds, wikidata, monkeypatch):
+    monkeypatch.setattr(wds, 'text_vectors', letter_vectors([]))
+    single = [wds.item_vector(qid) for qid in ITEMS]
+    wds.item_vector.cache_clear()
+    assert (wds.item_vectors(ITEMS) == np.array(single)).all()
+
+def test_hits_are_scored_against_the_context(wds, wikidata, monkeypatch):
+    monkeypatch.setattr(wds, 'text_vectors', letter_vectors([]))
+    monkeypatch.setattr(wds, 'sparse_scorer', None)
+    hits = [{'id': qid, 'label': ENTITIES[qid]['label'], 'description': ENTITIES[qid]['description'], 'score': 0.0}
+            for qid in ('Q1007', 'Q1008', 'Q1009')]
+    hits.append({'id': 'Q1011', 'label': 'Paris', 'description': '', 'score': 0.0})
+    context = 'the football club of Paris'
+    wds.score_hits(hits, context)
+    vector = wds.text_vectors([context])[0]
+    for hit in hits[:3]:
+        item = wds.item_vector(hit['id'])
+        assert hit['score'] == pytest.approx(item @ vector / np.linalg.norm(item) / np.linalg.norm(vector))
+        assert hit['context'] == context
+    assert hits[3]['score'] == 0.0
+    assert max(hits, key=lambda hit: hit['score'])['id'] == 'Q1009'
+    assert wds.cosine_similarities(np.zeros((2, 3)), np.ones(3)).tolist() == [0, 0]
+
+## result cache
+
+@pytest.fixture
+def result_cache(wds, monkeypatch):
+    cache = wdc.Memo('link_results', 100)
+    monkeypatch.setattr(wds, 'result_cache', cache)
+    return cache
+
+def test_repeated_links_are_answered_from_the_result_cache(wds, wikidata, result_cache):
+    result = wds.link('Ada Lovelace')
+    assert result['id'] == 'Q1001'
+    calls = len(wikidata.calls)
+    assert wds.link(' Ada  Lovelace ') == result and len(wikidata.calls) == calls
+    assert wds.get_stats()['result_cache_hits'] == 1
+    # callers get copies they can change
+    wds.link('Ada Lovelace')['id'] = 'changed'
+    assert wds.link('Ada Lovelace') == result
+    size = result_cache.cache_info()['size']
+    wds.link('Ada Lovelace', target_types=['ORG'])
+    assert 'result_cache_hits' not in wds.get_stats() and result_cache.cache_info()['size'] > size
+    hits = wds.search('Paris')
+    calls = len(wikidata.calls)
+    assert wds.search('Paris') == hits and len(wikidata.calls) == calls
+    size = result_cache.cache_info()['size']
+    wds.search('Paris', complete=False)
+    assert 'result_cache_hits' not in wds.get_stats() and result_cache.cache_info()['size'] == size + 1
+
+def test_result_keys(wds, monkeypatch):
+    def key(**args):
+        return wds.call_key('link', wds.call_args(wds.link, args, {}))
+    assert key(string='Ada  Lovelace') == key(string='Ada Lovelace', target_types=wds.TARGET_TYPES)
+    assert key(string='Ada Lovelace', target_types=['ORG']) != key(string='Ada Lovelace')
+    assert key(string='Ada Lovelace', bad_types=[]) != key(string='Ada Lovelace')
+    assert key(string='Ada Lovelace', top=2) != key(string='Ada Lovelace')
+    assert key(string='Ada', context='a language') == key(string='Ada', context='a mathematician')
+    monkeypatch.setattr(wds, 'USE_CONTEXT', True)
+    assert key(string='Ada', context='a language') != key(string='Ada', context='a mathematician')
+    assert key(string='Ada', context='a language') == key(string='Ada', context='a language')
+    assert wds.call_key('search', wds.call_args(wds.search, {'string': 'Ada'}, {}))[0] == 'search'
+
+## linking many mentions
+
+MENTIONS = ['Ada Lovelace', 'Paris', ('Paris', ['ORG']), 'Ada Lovelace', 'Zorblax Lyme disease',
+            {'string': 'Ada', 'target_types': ['ORG'], 'top': 2}, 'Zorblax', ' Paris ']
+
+def clear_caches():
+    for wrapper in wdc.cached_functions:
+        wrapper.cache_clear()
+
+def test_link_many_gives_what_link_does(wds, wikidata):
+    results = wds.link_many(MENTIONS, langs=['en'])
+    stats = wds.get_stats()
+    assert stats['requests'] == 8 and stats['unique_requests'] == 6 and stats['cached_requests'] == 0
+    assert stats['queries_saved'] > 0
+    searched = [params['srsearch'] for kind, params in wikidata.calls if kind == 'search']
+    assert len(searched) == len(set(searched))
+    clear_caches()
+    for mention, result in zip(MENTIONS, results):
+        args = wds.call_args(wds.link, mention, {'langs': ['en']})
+        assert wds.link(**args) == result, mention
+    assert results[0]['id'] == 'Q1001' and results[6] is None
+    assert results[0] == results[3] and results[0] is not results[3]
+
+def test_search_many_gives_what_search_does(wds, wikidata):
+    mentions = MENTIONS + [{'string': 'Paris', 'complete': False}]
+    results = wds.search_many(mentions)
+    assert wds.get_stats()['unique_requests'] == 7
+    clear_caches()
+    for mention, hits in zip(mentions, results):
+        assert wds.search(**wds.call_args(wds.search, mention, {})) == hits, mention
+
+def test_link_many_uses_the_result_cache(wds, wikidata, result_cache):
+    first = wds.link_many(MENTIONS)
+    calls = len(wikidata.calls)
+    assert wds.link_many(MENTIONS) == first and len(wikidata.calls) == calls
+    assert wds.get_stats()['cached_requests'] == 6
+    assert wds.link('Ada Lovelace') == first[0]
+    assert wds.get_stats()['result_cache_hits'] == 1
+
+def test_link_many_of_nothing(wds, wikidata):
+    assert wds.link_many([]) == [] and wds.search_many([]) == []
+    assert wikidata.calls == []
@@ -0,0 +1,118 @@
+import time
+import threading
+from email.utils import formatdate
+
+import pytest
+import requests
+
+import wd_throttle as wdth
+from fake_wikidata import FakeResponse
+
+def responses(*statuses, headers=None):
+    """ a send function returning responses with statuses in turn, then 200s """
+    statuses = list(statuses)
+    def send():
+        status = statuses.pop(0) if statuses else 200
+        if isinstance(status, Exception):
+            raise status
+        return FakeResponse({}, status, headers if status != 200 else None)
+    return send
+
+def test_token_bucket_allows_bursts_then_paces():
+    throttle = wdth.Throttle(rate=50, burst=5, max_concurrency=100)
+    send = responses()
+    start = time.monotonic()
+    for i in range(5):
+        throttle.request(send)
+    assert time.monotonic() - start < 0.05
+    for i in range(10):
+        throttle.request(send)
+    assert time.monotonic() - start >= 10 / 50 * 0.9
+    assert throttle.metrics()['requests'] == 15
+
+def test_no_rate_means_no_waiting():
+    throttle = wdth.Throttle(rate=None, burst=1)
+    start = time.monotonic()
+    for i in range(100):
+        throttle.request(responses())
+    assert time.monotonic() - start < 0.1
+
+def test_retry_after_is_honoured_and_pauses_everyone():
+    throttle = wdth.Throttle(rate=None, backoff_base=0.001)
+    start = time.monotonic()
+    response = throttle.request(responses(429, headers={'Retry-After': '0.3'}))
+    assert response.status_code == 200
+    assert time.monotonic() - start >= 0.3
+    metrics = throttle.metrics()
+    assert metrics['retries'] == 1 and metrics['status_429'] == 1
+
+    # a 429 pauses other threads' requests too
+    throttle = wdth.Throttle(rate=None, backoff_base=0.001)
+    first = threading.Thread(target=throttle.request, args=(responses(429, headers={'Retry-After': '0.3'}),))
+    first.start()
+    time.sleep(0.05)
+    start = time.monotonic()
+    throttle.request(responses())
+    assert time.monotonic() - start >= 0.2
+    first.join()
+
+def test_retry_after_dates():
+    response = FakeResponse({}, 503, {'Retry-After': formatdate(time.time() + 30, usegmt=True)})
+    assert 25 <= wdth.retry_after(response) <= 30
+    assert wdth.retry_after(FakeResponse({}, 503, {'Retry-After': '7'})) == 7
+    assert wdth.retry_after(FakeResponse({}, 503, {'Retry-After': 'soon'})) is None
+    assert wdth.retry_after(FakeResponse({}, 503)) is None
+
+def test_server_errors_are_retried_with_backoff():
+    throttle = wdth.Throttle(rate=None, backoff_base=0.001, max_retries=3)
+    assert throttle.request(responses(500, 502, 503)).status_code == 200
+    assert throttle.metrics()['retries'] == 3
+    assert throttle.request(responses(500, 500, 500, 500)).status_code == 500
+    assert throttle.metrics()['failures'] == 1
+    assert throttle.request(responses(404)).status_code == 404    # not worth retrying
+
+def test_connection_errors_are_retried_then_raised():
+    throttle = wdth.Throttle(rate=None, backoff_base=0.001, max_retries=2)
+    assert throttle.request(responses(requests.ConnectionError(), requests.Timeout())).status_code == 200
+    assert throttle.metrics()['connection_errors'] == 2
+    with pytest.raises(requests.ConnectionError):
+        throttle.request(responses(*[requests.ConnectionError()] * 3))
+
+def test_errors_cut_concurrency():
+    throttle = wdth.Throttle(rate=None, max_concurrency=8, backoff_base=0.0001, max_retries=0)
+    for i in range(wdth.MIN_ERROR_SAMPLE):
+        throttle.request(responses(503))
+    assert throttle.metrics()['concurrency'] == 4
+
+def test_processes_share_the_rate_in_the_throttle_file(tmp_path):
+    ctrl = str(tmp_path / 'throttle.ctrl')
+    open(ctrl, 'w').close()
+    first = wdth.Throttle(rate=10, ctrl_file=ctrl)
+    second = wdth.Throttle(rate=10, ctrl_file=ctrl)
+    other_site = wdth.Throttle(rate=10, ctrl_file=ctrl, site='dbpedia:dbpedia')
+    assert first.process_rate == 10 and second.process_rate == 5 and other_site.process_rate == 10
+    first.check_ctrl_file()
+    assert first.process_rate == 5
+    with open(ctrl) as f:
+        assert len(f.readlines()) == 3
+    second.release_ctrl_file()
+    first.check_ctrl_file()
+    assert first.process_rate == 10
+    with open(ctrl) as f:
+        assert len(f.readlines()) == 2
+
+def test_a_missing_throttle_file_is_not_shared(tmp_path):
+    ctrl = str(tmp_path / 'throttle.ctrl')
+    first = wdth.Throttle(rate=10, ctrl_file=ctrl)
+    second = wdth.Throttle(rate=10, ctrl_file=ctrl)
+    assert first.process_rate == 10 and second.process_rate == 10
+    assert first.ctrl_file is None and not (tmp_path / 'throttle.ctrl').exists()
+    first.release_ctrl_file()
+
+def test_dbpedia_has_its_own_throttle(wds, wikidata):
+    assert wds.dbpedia_throttle is not wds.throttle
+    wikidata_requests = wds.throttle.metrics().get('requests', 0)
+    dbpedia_requests = wds.dbpedia_throttle.metrics().get('requests', 0)
+    wds.query_dbpedia('select ?x { ?x ?p ?o }')
+    assert wds.dbpedia_throttle.metrics()['requests'] == dbpedia_requests + 1
+    assert wds.throttle.metrics().get('requests', 0) == wikidata_requests
@@ -0,0 +1,86 @@
+import wd_cache as wdc
+from wd_ids import qid2int, int2qid, qid_keys, is_entity_id
+from fake_wikidata import ENTITIES
+
+def ints(qids):
+    return {qid2int(qid) for qid in qids}
+
+## integer ids
+
+def test_ids_round_trip_through_integers():
+    for id in ['Q0', 'Q5', 'Q42', 'Q18123741', 'P31', 'P279']:
+        assert int2qid(qid2int(id)) == id
+    assert qid2int('Q42') == 42 and qid2int('P31') == -31
+    assert is_entity_id('Q42') and is_entity_id('P31') and not is_entity_id('Q') and not is_entity_id('L42')
+
+def test_report_counts_keyed_by_integers_get_their_ids_back():
+    counts = {qid2int('Q1001'): 3, qid2int('P31'): 1, 0: 2}
+    assert qid_keys(counts) == {'Q1001': 3, 'P31': 1, 'Q0': 2}
+
+def test_type_records_hold_integers(wds, wikidata, tmp_path):
+    record = wds.get_type_record('Q1005')
+    assert record == {'instance': tuple(sorted(ints(['Q18123741', 'Q12136']))), 'concept': (), 'P31': True, 'P279': False}
+    store = wdc.PersistentCache(str(tmp_path / 'cache.sqlite'))
+    store.put('get_type_record_ints', repr(('Q1005',)), record)
+    assert store.get('get_type_record_ints', repr(('Q1005',))) == (True, record)
+    assert wds.query_for_types('Q1005', 'all') == ints(['Q1005', 'Q18123741', 'Q12136'])
+
+def test_get_types_still_gives_id_label_tuples(wds, wikidata):
+    assert wds.get_types('Q1001', ['Q5'], [], [], ['Q43229'], ['Q4167410'], 'all') == ([('Q5', 'human')], [], [], [])
+    target, near_miss, good, ok = wds.get_types('Q5', ['Q5', 'Q215627'], [], [], [], [], 'all')
+    assert sorted(target) == [('Q215627', 'person'), ('Q5', 'SELF')]
+
+## type labels
+
+def test_type_queries_only_return_ids(wds, wikidata):
+    wds.get_type_records(['Q1001', 'Q1005'])
+    query = wikidata.calls[-1][1]['query']
+    assert 'rdfs:label' not in query and 'wikibase:label' not in query
+    assert wikidata.count('wbgetentities') == 0
+
+def test_type_labels_are_fetched_in_batches_once(wds, wikidata, monkeypatch):
+    monkeypatch.setattr(wds, 'ENTITY_BATCH_SIZE', 3)
+    ids = [qid2int(qid) for qid in ['Q5', 'Q215627', 'Q43229', 'Q12136', 'Q18123741', 'Q5', 'Q9143']]
+    labels = wds.get_type_labels(ids)
+    assert labels == {id: ENTITIES[int2qid(id)]['label'] for id in ids}
+    assert [len(params['ids'].split('|')) for kind, params in wikidata.calls] == [3, 3]
+    assert all(params['props'] == 'labels' for kind, params in wikidata.calls)
+    assert wds.get_type_labels(ids[:3]) == {id: labels[id] for id in ids[:3]}
+    assert wds.get_label('Q43229') == 'organization' and len(wikidata.calls) == 2
+    # labels in get_label's cache aren't fetched again
+    monkeypatch.setattr(wds, 'type_labels', {})
+    assert wds.get_type_labels([qid2int('Q515')]) == {qid2int('Q515'): 'city'}
+    assert wds.get_type_labels(ids) == labels and len(wikidata.calls) == 3
+
+def test_types_get_their_labels_when_returned(wds, wikidata):
+    found = wds.found_type_tuples(['Q1005', 'Q1009'], [([qid2int('Q18123741'), qid2int('Q1005')], [], [], []),
+                                                        ([], [], [], [qid2int('Q43229')])])
+    assert found == [([('Q18123741', 'infectious disease'), ('Q1005', 'SELF')], [], [], []),
+                     ([], [], [], [('Q43229', 'organization')])]
+    assert wikidata.count('wbgetentities') == 1
+
+## type profiles
+
+def test_type_profiles_classify_types(wds):
+    profile = wds.TypeProfile(['Q5'], ['Q43229'], ['Q12136'], ['Q515', 'Q5'], ['Q4167410'])
+    assert profile.type_ids == {'Q5', 'Q43229', 'Q12136', 'Q515', 'Q4167410'}
+    assert profile.classify(ints(['Q5', 'Q215627'])) == ([5], [], [], [])    # target before ok
+    assert profile.classify(ints(['Q43229', 'Q12136', 'Q515', 'Q9143'])) == ([], [43229], [12136], [515])
+    assert profile.classify(set()) == ([], [], [], [])
+    # a bad type overrides the rest
+    assert profile.classify(ints(['Q5', 'Q12136', 'Q4167410'])) == ([], [], [], [])
+    both = wds.TypeProfile(['Q5'], [], [], [], ['Q5'])
+    assert both.classify(ints(['Q5'])) == ([], [], [], [])
+
+def test_type_profiles_for_names_are_cached(wds):
+    profile = wds.get_type_profile(['PERSON'], ['disease'], ['ORG'], ['WIKIDISAMBIGUATION'])
+    assert profile is wds.get_type_profile(['PERSON'], ['disease'], ['ORG'], ['WIKIDISAMBIGUATION'])
+    assert {'Q5', 'Q12136', 'Q43229', 'Q4167410'} <= profile.type_ids
+    # the near misses of PERSON, from the config
+    assert profile.classify(ints(['Q43229'])) == ([], [43229], [], [])
+    assert profile.classify(ints(['Q5', 'Q4167410'])) == ([], [], [], [])
+
+def test_search_drops_candidates_with_a_bad_type(wds, wikidata):
+    hits = wds.search('Ada', target_types=['Q9143', 'Q4167410'], good_types=[], ok_types=[],
+                      bad_types=['Q4167410'], complete=False)
+    assert [hit['id'] for hit in hits] == ['Q1003']
@@ -0,0 +1,252 @@
+"""
+
+Build and use a local index of the Wikidata type hierarchy so that
+wd_search.py can classify candidates without sending the expensive
+wdt:P31/wdt:P279* property-path queries to the query service.
+
+The index is built from the P31 (instance of) and P279 (subclass of)
+statements in a Wikidata JSON dump or an N-Triples file of truthy
+statements (e.g., latest-truthy.nt.bz2), read in parallel by wd_dump.py.  Only the types we might ask
+about are kept: the ones in entity_types.py (wdtype2names, the spaCy
+mapping and the cyber type dicts), the type lists in a wd_search config
+file and any given with --types.  Build it with
+
+  python type_index.py latest-all.json.bz2 type_index --config wd_search_config.yml
+
+and set TYPE_INDEX: 'type_index' in wd_search_config.yml to use it.
+
+The index is a directory of NumPy arrays:
+
+  nodes.npy            sorted integer ids (see wd_ids.py) of items with P31 or P279 values
+  p31_indptr.npy       CSR row pointers and column indices giving each node's
+  p31_indices.npy      P31 values as positions in classes.npy
+  p279_indptr.npy      ditto for P279
+  p279_indices.npy
+  classes.npy          sorted integer ids of every item that is a P31 or P279 value
+  masks.npy            for each class, a bitmask (uint64 words) of the indexed types
+                       it is a subclass of or equal to
+  types.json           the indexed types as a list of [id, label], in bit order,
+                       with english labels from a json dump or else entity_types.py
+
+so an item's types are the OR of the masks of its P31 values (instance
+view) and P279 values (concept view), a few array lookups.  An item or
+property that's not in nodes.npy has no P31 or P279 values if its id is
+at most the largest one of its kind in the index and is unknown, e.g.,
+newer than the dump, otherwise.
+
+"""
+
+import os
+import re
+import json
+import yaml
+import argparse as ap
+from array import array
+from functools import partial
+import numpy as np
+
+import entity_types as et
+from wd_ids import qid2int, is_entity_id
+import wd_dump
+
+## using the index
+
+class TypeIndex:
+
+    def __init__(self, path):
+        self.path = path
+        load = lambda name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+        self.nodes = load('nodes')
+        self.p31_indptr, self.p31_indices = load('p31_indptr'), load('p31_indices')
+        self.p279_indptr, self.p279_indices = load('p279_indptr'), load('p279_indices')
+        self.classes = load('classes')
+        # the largest item and property ids in the dump, negative for properties
+        self.max_item = max(int(self.nodes[-1]), 0) if len(self.nodes) else 0
+        self.max_property = min(int(self.nodes[0]), 0) if len(self.nodes) else 0
+        self.masks = load('masks')
+        with open(os.path.join(path, 'types.json')) as f:
+            types = json.load(f)
+        self.types = [qid2int(id) for id, label in types]   # in bit order
+        self.labels = {qid2int(id): label for id, label in types}
+        self.type_ids = {id for id, label in types}
+
+    def covers(self, types):
+        """ True iff every type in types is indexed, so the records from
+        this index are enough to classify a candidate """
+        return all(t in self.type_ids for t in types)
+
+    def mask_types(self, mask):
+        """ the set of integer type ids for the bits set in mask """
+        return {self.types[64 * w + b] for w, word in enumerate(mask) if word
+                for b in range(64) if (int(word) >> b) & 1}
+
+    def record(self, qid):
+        """ returns a type record like wd_search.get_type_record's for
+        qid, limited to the indexed types, or None if qid is not known
+        to the index, i.e., is newer than the dump it was built from """
+        n = qid2int(qid)
+        row = int(np.searchsorted(self.nodes, n))
+        if row >= len(self.nodes) or self.nodes[row] != n:
+            if 0 < n <= self.max_item or self.max_property <= n < 0:
+                return {'instance': set(), 'concept': set(), 'P31': False, 'P279': False}
+            return None
+        p31 = self.p31_indices[self.p31_indptr[row]:self.p31_indptr[row+1]]
+        p279 = self.p279_indices[self.p279_indptr[row]:self.p279_indptr[row+1]]
+        return {'instance': self.mask_types(np.bitwise_or.reduce(self.masks[p31], axis=0)) if len(p31) else set(),
+                'concept': self.mask_types(np.bitwise_or.reduce(self.masks[p279], axis=0)) if len(p279) else set(),
+                'P31': len(p31) > 0, 'P279': len(p279) > 0}
+
+## building the index
+
+def truthy_values(entity, prop):
+    """ the ids of an entity's best-ranked item values for a property, like wdt: in the query service """
+    statements = [s for s in entity.get('claims', {}).get(prop, []) if s.get('rank') != 'deprecated']
+    if any(s.get('rank') == 'preferred' for s in statements):
+        statements = [s for s in statements if s.get('rank') == 'preferred']
+    values = []
+    for s in statements:
+        snak = s.get('mainsnak', {})
+        if snak.get('snaktype', 'value') == 'value' and 'datavalue' in snak:
+            value = snak['datavalue'].get('value')
+            if isinstance(value, dict) and 'id' in value:
+                values.append(value['id'])
+    return values
+
+# the records extracted from the dump by wd_dump.py are tuples of an
+# entity's id, a list of its (property, value id) edges and its english
+# label if it's one of the indexed types, else None
+
+def entity_edges(entity, types):
+    """ the record for an entity in a json dump """
+    edges = [(prop, value) for prop in ('P31', 'P279') for value in truthy_values(entity, prop)]
+    label = entity.get('labels', {}).get('en', {}).get('value') if entity['id'] in types else None
+    return (entity['id'], edges, label) if edges or label else None
+
+nt_pattern = re.compile(r'<http://www\.wikidata\.org/entity/([QP]\d+)> <http://www\.wikidata\.org/prop/direct/(P31|P279)> <http://www\.wikidata\.org/entity/([QP]\d+)>')
+
+def nt_edge(line):
+    """ the record for a P31 or P279 triple in an N-Triples file """
+    m = nt_pattern.match(line)
+    return (m.group(1), [m.group(2, 3)], None) if m else None
+
+def read_edges(path, types, workers=None, workdir=None):
+    """ read the P31 and P279 edges in a dump in parallel into shards in
+    workdir and generate their records """
+    if '.nt' in os.path.basename(path):
+        wd_dump.ingest(path, workdir, nt_edge, parse=None, prefilter=['/P31>', '/P279>'], workers=workers)
+    else:
+        # types without P31 or P279 values get their labels from entity_types.py
+        wd_dump.ingest(path, workdir, partial(entity_edges, types=frozenset(types)),
+                       prefilter=['"P31"', '"P279"'], workers=workers)
+    return wd_dump.records(workdir)
+
+def csr(sources, targets, nodes):
+    """ CSR indptr and indices arrays for edges given as parallel arrays, rows in nodes order """
+    order = np.argsort(sources, kind='stable')
+    rows = np.searchsorted(nodes, sources[order])
+    indptr = np.zeros(len(nodes) + 1, dtype=np.int64)
+    np.add.at(indptr, rows + 1, 1)
+    return np.cumsum(indptr), targets[order]
+
+def gather(indptr, indices, rows):
+    """ the concatenated CSR rows for an array of row numbers """
+    starts, lens = indptr[rows], indptr[rows + 1] - indptr[rows]
+    total = int(lens.sum())
+    if not total:
+        return indices[:0]
+    offsets = np.repeat(starts - np.cumsum(lens) + lens, lens) + np.arange(total)
+    return indices[offsets]
+
+def type_masks(classes, sub, sup, type_rows):
+    """ a bitmask array for classes where bit j is set for a class that
+    is type_rows[j] or one of its subclasses; sub and sup are the class
+    positions of the subclass edges among classes.  The bits of all of
+    the types are pushed down the subclass edges together, a level at a
+    time from the classes whose masks changed, until none do, so cycles
+    in the hierarchy are fine """
+    words = (len(type_rows) + 63) // 64
+    masks = np.zeros((len(classes), max(words, 1)), dtype=np.uint64)
+    for j, row in enumerate(type_rows):
+        masks[row, j // 64] |= np.uint64(1 << (j % 64))
+    # reverse subclass graph: for each class, its immediate subclasses
+    indptr, indices = csr(sup, sub, np.arange(len(classes)))
+    frontier = np.unique(np.asarray(type_rows, dtype=np.int64))
+    while len(frontier):
+        parents = np.repeat(frontier, indptr[frontier + 1] - indptr[frontier])
+        children = gather(indptr, indices, frontier)
+        if not len(children):
+            break
+        targets = np.unique(children)
+        before = masks[targets]
+        np.bitwise_or.at(masks, children, masks[parents])
+        frontier = targets[(masks[targets] != before).any(axis=1)]
+    return masks
+
+def indexed_types(config_file=None, extra=[]):
+    """ the type ids to index: those in entity_types.py, in a wd_search config file and in extra """
+    types = set(et.wdtype2names) | set(et.wd_cyber_target) | set(et.wd_cyber_ok) | set(et.wd_cyber_bad)
+    for wdtypes in et.spacytype2wdtypes.values():
+        types.update(wdtypes)
+    names = list(extra)
+    if config_file:
+        with open(config_file) as f:
+            config = yaml.load(f, Loader=yaml.FullLoader)
+        for key in ['TARGET_TYPES', 'GOOD_TYPES', 'OK_TYPES', 'BAD_TYPES']:
+            names += config.get(key) or []
+        for near_misses in (config.get('NEAR_MISS_TYPES') or {}).values():
+            names += near_misses
+    types.update(et.wd_types(names))
+    return sorted((t for t in types if is_entity_id(t)), key=qid2int)
+
+def build_index(path, outdir, types, workers=None, workdir=None):
+    """ build a type index from the P31 and P279 edges in a dump for a
+    list of type ids, keeping the shards of the dump in workdir so an
+    interrupted build can be resumed """
+    workdir = workdir or outdir.rstrip('/') + '_shards'
+    sources, props, targets = array('q'), array('b'), array('q')
+    labels = {}   # english labels of the types, from a json dump
+    for source, edges, label in read_edges(path, types, workers, workdir):
+        for prop, target in edges:
+            sources.append(qid2int(source))
+            props.append(prop == 'P279')
+            targets.append(qid2int(target))
+        if label:
+            labels[source] = label
+    sources = np.frombuffer(sources, dtype=np.int64)
+    is_p279 = np.frombuffer(props, dtype=np.int8).astype(bool)
+    targets = np.frombuffer(targets, dtype=np.int64)
+
+    type_ints = np.array([qid2int(t) for t in types], dtype=np.int64)
+    nodes = np.unique(sources)
+    classes = np.unique(np.concatenate([targets, type_ints]))
+    target_pos = np.searchsorted(classes, targets)
+    p31_indptr, p31_indices = csr(sources[~is_p279], target_pos[~is_p279], nodes)
+    p279_indptr, p279_indices = csr(sources[is_p279], target_pos[is_p279], nodes)
+
+    # subclass edges between classes, as positions in classes
+    sub_pos = np.searchsorted(classes, sources[is_p279])
+    sub_pos[sub_pos == len(classes)] = 0
+    among = classes[sub_pos] == sources[is_p279]
+    masks = type_masks(classes, sub_pos[among], target_pos[is_p279][among], np.searchsorted(classes, type_ints))
+
+    os.makedirs(outdir, exist_ok=True)
+    for name, data in [('nodes', nodes), ('p31_indptr', p31_indptr), ('p31_indices', p31_indices),
+                       ('p279_indptr', p279_indptr), ('p279_indices', p279_indices), ('classes', classes), ('masks', masks)]:
+        np.save(os.path.join(outdir, name + '.npy'), data)
+    with open(os.path.join(outdir, 'types.json'), 'w') as out:
+        json.dump([[t, labels.get(t) or (et.wdtype2names[t][0] if et.wdtype2names.get(t) else t)] for t in types], out)
+    print(f"Wrote type index of {len(nodes)} items, {len(classes)} classes and {len(types)} types to {outdir}")
+
+def get_args():
+    p = ap.ArgumentParser(description='build a local type index from a wikidata json dump or n-triples file')
+    p.add_argument('dump', help='wikidata json dump or truthy n-triples file, optionally .bz2 or .gz compressed')
+    p.add_argument('outdir', help='directory for the index')
+    p.add_argument('-c', '--config', default='wd_search_config.yml', help='wd_search config file whose type lists should be indexed')
+    p.add_argument('-t', '--types', nargs='+', default=[], help='more types (ids or names in entity_types.py) to index')
+    p.add_argument('-w', '--workers', type=int, default=None, help='number of processes reading the dump, defaults to the number of cores')
+    p.add_argument('--workdir', help='directory for the shards of the dump, defaults to outdir_shards')
+    return p.parse_args()
+
+if __name__ == '__main__':
+    args = get_args()
+    build_index(args.dump, args.outdir, indexed_types(args.config, args.types), args.workers, args.workdir)
@@ -0,0 +1,640 @@
+"""
+
+Caching for the Wikidata and DBpedia lookups done by wd_search.py.  Each cached
+function gets a small in-memory LRU layer and, optionally, a persistent layer
+backed by an SQLite database in WAL mode so that results survive across runs and
+can be shared by several processes (e.g., parallel scale_reports.py runs) working
+on the same machine.  Entries are keyed by the function name and its arguments and
+expire after a configurable time to live.
+
+The persistent layer is turned on in wd_search_config.yml:
+
+  PERSISTENT_CACHE: True
+  CACHE_FILE: wd_cache.sqlite
+  CACHE_TTL: 604800           # seconds, 0 means entries never expire
+  CACHE_MAX_ENTRIES: 2000000  # oldest entries are pruned beyond this, 0 means no limit
+
+The memory layer holds at most CACHE_SIZE entries per function or, if
+given a budget, entries taking up about that many bytes:
+
+  CACHE_BYTES: 16000000       # per function, 0 means use CACHE_SIZE
+  CACHE_BUDGETS:              # for particular functions, by the name
+    get_entity: 64000000      # their entries are filed and reported under
+
+and counts the entries it evicts.  memory_report, dump and clear_memory
+report on, dump and clear the memory layers of all cached functions,
+e.g., from the thread that install_signal_handlers hands signals to.
+
+CACHE_TTL is a hard limit: an older entry is recomputed before it's
+returned.  Setting a shorter soft limit
+
+  CACHE_SOFT_TTL: 86400
+
+makes entries older than it stale: they're still returned at once, but
+a Refresher thread recomputes them in the background, in batches for
+functions that have a batch_refresh function, and saves the new values.
+Entries keyed by a wikidata id (their function's first argument) can be
+refreshed on demand by writing the ids, one per line, to
+
+  CACHE_INVALIDATION_FILE: wd_cache_invalidate.txt
+
+which the refresher checks every few seconds and renames to
+wd_cache_invalidate.txt.done once it has made their entries stale (or
+removed them if there's no soft limit) in the cache file and in the
+memory of its process.  Both limits apply to the memory layer of
+functions without a persistent layer too, once set with set_ttls.
+
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import pickle
+import signal
+import sqlite3
+import inspect
+import threading
+from queue import SimpleQueue
+from copy import deepcopy
+from collections import OrderedDict
+from functools import wraps
+
+# number of writes between checks of the size limit
+PRUNE_INTERVAL = 1000
+
+# the wikidata id a cache key starts with, e.g., Q42 in "('Q42', 'en')"
+key_qid_pattern = re.compile(r"\('([QP]\d+)'")
+
+def key_qid(key):
+    """ the wikidata id that is the first argument in a key or None """
+    match = key_qid_pattern.match(key)
+    return match.group(1) if match else None
+
+class PersistentCache:
+    """ an SQLite-backed store of pickled values keyed by (function name, key string) """
+
+    def __init__(self, path, ttl=0, max_entries=0, soft_ttl=0):
+        self.path = path
+        self.ttl = ttl or 0
+        self.soft_ttl = soft_ttl or 0
+        self.max_entries = max_entries or 0
+        self.local = threading.local()   # one connection per thread and process
+        self.lock = threading.Lock()
+        self.writes = 0
+        self.hits = self.misses = 0
+        self.connect().execute("""create table if not exists cache (
+                                    func text not null,
+                                    key text not null,
+                                    value blob,
+                                    stored real not null,
+                                    qid text,
+                                    primary key (func, key))""")
+        if 'qid' not in [row[1] for row in self.connect().execute("pragma table_info(cache)")]:
+            self.connect().execute("alter table cache add column qid text")   # a file from before invalidation
+        self.connect().execute("create index if not exists cache_stored on cache(stored)")
+        self.connect().execute("create index if not exists cache_qid on cache(qid)")
+
+    def connect(self):
+        """ returns a connection for this thread, reopening it after a fork """
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+            conn.execute("pragma journal_mode=wal")
+            conn.execute("pragma synchronous=normal")
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    def get(self, func, key):
+        """ returns a tuple (found, value) """
+        found, value, stored = self.get_entry(func, key)
+        return (found, value)
+
+    def get_entry(self, func, key):
+        """ returns a tuple (found, value, time stored) """
+        row = self.connect().execute("select value, stored from cache where func=? and key=?", (func, key)).fetchone()
+        if row is None or self.expired(row[1]):
+            self.misses += 1
+            return (False, None, None)
+        self.hits += 1
+        return (True, pickle.loads(row[0]), row[1])
+
+    def expired(self, stored):
+        return bool(self.ttl) and time.time() - stored > self.ttl
+
+    def stale(self, stored):
+        return bool(self.soft_ttl) and time.time() - stored > self.soft_ttl
+
+    def put(self, func, key, value, stored=None):
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        self.connect().execute("insert or replace into cache (func, key, value, stored, qid) values (?,?,?,?,?)",
+                               (func, key, blob, stored or time.time(), key_qid(key)))
+        with self.lock:
+            self.writes += 1
+            prune = self.writes % PRUNE_INTERVAL == 0
+        if prune:
+            self.prune()
+
+    def prune(self):
+        """ remove expired entries and the oldest ones beyond max_entries """
+        conn = self.connect()
+        if self.ttl:
+            conn.execute("delete from cache where stored < ?", (time.time() - self.ttl,))
+        if self.max_entries:
+            n = conn.execute("select count(*) from cache").fetchone()[0]
+            if n > self.max_entries:
+                conn.execute("delete from cache where rowid in (select rowid from cache order by stored limit ?)",
+                             (n - self.max_entries,))
+
+    def invalidate(self, qids):
+        """ make the entries keyed by the wikidata ids in qids stale, or
+        remove them if there's no soft ttl, returning how many there were """
+        conn = self.connect()
+        n = 0
+        qids = list(qids)
+        for i in range(0, len(qids), 500):
+            marks = ','.join('?' * len(qids[i:i+500]))
+            if self.soft_ttl:
+                cursor = conn.execute(f"update cache set stored=min(stored, ?) where qid in ({marks})",
+                                      [time.time() - self.soft_ttl - 1] + qids[i:i+500])
+            else:
+                cursor = conn.execute(f"delete from cache where qid in ({marks})", qids[i:i+500])
+            n += cursor.rowcount
+        return n
+
+    def clear(self, func=None):
+        if func:
+            self.connect().execute("delete from cache where func=?", (func,))
+        else:
+            self.connect().execute("delete from cache")
+
+    def stats(self):
+        counts = dict(self.connect().execute("select func, count(*) from cache group by func").fetchall())
+        return {'path': self.path, 'hits': self.hits, 'misses': self.misses, 'entries': counts}
+
+
+def sizeof(value, seen=None):
+    """ an estimate of the number of bytes used by value and the
+    containers, strings, numbers and objects it holds """
+    if seen is None:
+        seen = set()
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(sizeof(k, seen) + sizeof(v, seen) for k, v in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(sizeof(x, seen) for x in value)
+    elif hasattr(value, '__dict__'):
+        size += sizeof(vars(value), seen)
+    return size
+
+
+class MemoryCache:
+    """ a thread-safe LRU dictionary holding at most maxsize entries or,
+    if maxbytes is given, entries taking up at most about maxbytes bytes """
+
+    def __init__(self, maxsize, maxbytes=0):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes or 0
+        self.data = OrderedDict()
+        self.sizes = {}    # key => estimated size of the key and value
+        self.nbytes = 0
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+        self.evictions = self.evicted_bytes = 0
+
+    def get(self, key):
+        with self.lock:
+            if key in self.data:
+                self.data.move_to_end(key)
+                self.hits += 1
+                return (True, self.data[key])
+            self.misses += 1
+            return (False, None)
+
+    def put(self, key, value):
+        size = sizeof(key) + sizeof(value)
+        with self.lock:
+            self.nbytes += size - self.sizes.get(key, 0)
+            self.data[key] = value
+            self.sizes[key] = size
+            self.data.move_to_end(key)
+            self.evict()
+
+    def full(self):
+        if self.maxbytes:
+            return self.nbytes > self.maxbytes
+        return bool(self.maxsize) and len(self.data) > self.maxsize
+
+    def evict(self):
+        """ drop least recently used entries until within the limit, holding the lock """
+        while self.data and self.full():
+            key, value = self.data.popitem(last=False)
+            size = self.sizes.pop(key)
+            self.nbytes -= size
+            self.evictions += 1
+            self.evicted_bytes += size
+
+    def set_budget(self, maxbytes):
+        with self.lock:
+            self.maxbytes = maxbytes or 0
+            self.evict()
+
+    def pop(self, key):
+        with self.lock:
+            if key in self.data:
+                self.nbytes -= self.sizes.pop(key)
+            return self.data.pop(key, None)
+
+    def keys(self):
+        with self.lock:
+            return list(self.data)
+
+    def largest(self, n):
+        """ the keys and sizes of the n largest entries """
+        with self.lock:
+            return sorted(self.sizes.items(), key=lambda item: -item[1])[:n]
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.sizes.clear()
+            self.nbytes = 0
+            self.hits = self.misses = 0
+
+
+class Refresher:
+    """ a daemon thread that recomputes stale cache entries in batches of
+    up to batch_size and, every interval seconds, checks for an
+    invalidation file of wikidata ids whose entries should be refreshed """
+
+    def __init__(self, batch_size=50, invalidation_file=None, interval=5):
+        self.batch_size = batch_size
+        self.invalidation_file = invalidation_file
+        self.interval = interval
+        self.pending = OrderedDict()   # (function name, key) => (wrapper, args)
+        self.busy = set()              # the (function name, key)s being refreshed
+        self.cond = threading.Condition()
+        self.thread = None
+        self.pid = None
+        self.refreshed = self.failed = self.invalidated = 0
+
+    def start(self):
+        """ starts the thread if it's not running in this process, e.g., after a fork """
+        with self.cond:
+            if self.pid != os.getpid() or not self.thread.is_alive():
+                self.pending.clear()
+                self.busy.clear()
+                self.pid = os.getpid()
+                self.thread = threading.Thread(target=self.run, name='cache-refresher', daemon=True)
+                self.thread.start()
+
+    def schedule(self, wrapper, key, args):
+        """ ask for the entry for key, the result of calling wrapper with args, to be refreshed """
+        self.start()
+        entry = (wrapper.cache_info()['function'], key)
+        with self.cond:
+            if entry not in self.pending and entry not in self.busy:
+                self.pending[entry] = (wrapper, args)
+                self.cond.notify()
+
+    def next_batch(self):
+        """ waits for up to interval seconds for stale entries and takes
+        up to batch_size of them for one function """
+        with self.cond:
+            if not self.pending:
+                self.cond.wait(self.interval)
+            batch = []
+            for entry, (wrapper, args) in list(self.pending.items()):
+                if len(batch) >= self.batch_size:
+                    break
+                if not batch or wrapper is batch[0][1]:
+                    batch.append((entry, wrapper, args))
+                    del self.pending[entry]
+                    self.busy.add(entry)
+            return batch
+
+    def run(self):
+        while True:
+            self.check_invalidation_file()
+            batch = self.next_batch()
+            if not batch:
+                continue
+            wrapper = batch[0][1]
+            try:
+                wrapper.cache_refresh([args for entry, wrapper, args in batch])
+                self.refreshed += len(batch)
+            except Exception as e:
+                # leave them stale, they are scheduled again when next used
+                self.failed += len(batch)
+                print(f"Failed to refresh {len(batch)} {wrapper.__name__} cache entries: {e}", file=sys.stderr)
+            with self.cond:
+                self.busy.difference_update(entry for entry, wrapper, args in batch)
+
+    def check_invalidation_file(self):
+        """ invalidate the entries for the ids in the invalidation file, if there is one """
+        if not (self.invalidation_file and os.path.exists(self.invalidation_file)):
+            return
+        done = self.invalidation_file + '.done'
+        try:
+            os.replace(self.invalidation_file, done)
+        except FileNotFoundError:
+            return   # another process got it first
+        with open(done) as f:
+            qids = {line.strip() for line in f if line.strip()}
+        self.invalidated += invalidate(qids)
+
+    def stats(self):
+        return {'pending': len(self.pending), 'refreshed': self.refreshed, 'failed': self.failed,
+                'invalidated': self.invalidated}
+
+# the wrappers of all cached functions, so their entries can be invalidated
+cached_functions = []
+
+# the refresher of stale entries, if start_refresher has been called
+refresher = None
+
+# byte budgets for the memory layers of cached functions, by the name
+# their entries are filed under (the 'function' in their cache_info and
+# dumps), and the one for the others (0 means they hold maxsize entries)
+budgets = {}
+default_budget = 0
+
+# the hard and soft ttls of entries of cached functions without a store,
+# which use its ttls (0 means never)
+memory_ttl = memory_soft_ttl = 0
+
+def set_ttls(ttl=0, soft_ttl=0):
+    """ set the ttls for the memory layers of cached functions without a store """
+    global memory_ttl, memory_soft_ttl
+    memory_ttl, memory_soft_ttl = ttl or 0, soft_ttl or 0
+
+def ttls(store):
+    """ the hard and soft ttls of entries of a cached function with store, which may be None """
+    return (store.ttl, store.soft_ttl) if store else (memory_ttl, memory_soft_ttl)
+
+def expired(store, stored):
+    ttl = ttls(store)[0]
+    return bool(ttl) and time.time() - stored > ttl
+
+def stale(store, stored):
+    soft_ttl = ttls(store)[1]
+    return bool(soft_ttl) and time.time() - stored > soft_ttl
+
+def set_budgets(default=0, per_function=None):
+    """ set the byte budgets of the memory layers of cached functions,
+    including ones that are already defined """
+    global default_budget
+    default_budget = default or 0
+    budgets.clear()
+    budgets.update(per_function or {})
+    for wrapper in cached_functions:
+        wrapper.cache_memory.set_budget(budgets.get(wrapper.cache_info()['function'], default_budget))
+
+def memory_report():
+    """ the cache_info of every cached function with entries in memory """
+    return [wrapper.cache_info() for wrapper in cached_functions if wrapper.cache_memory.data]
+
+def dump(path, largest=20):
+    """ write a json report of the memory layers of cached functions,
+    with the keys of their largest entries, to path """
+    report = {'pid': os.getpid(), 'time': time.time(),
+              'bytes': sum(wrapper.cache_memory.nbytes for wrapper in cached_functions),
+              'functions': [dict(wrapper.cache_info(), largest=wrapper.cache_memory.largest(largest))
+                            for wrapper in cached_functions if wrapper.cache_memory.data]}
+    with open(path, 'w') as out:
+        json.dump(report, out, indent=1)
+    return report
+
+def clear_memory():
+    """ empty the memory layers of all cached functions, leaving their stores alone """
+    for wrapper in cached_functions:
+        wrapper.cache_memory.clear()
+
+# the dumps and clears asked for by signals, done by signal_thread
+signal_requests = SimpleQueue()
+signal_thread = None
+
+def handle_signal_requests():
+    while True:
+        action = signal_requests.get()
+        try:
+            action()
+        except Exception as e:
+            print(f"WARNING: cache signal handler failed: {e}", file=sys.stderr)
+
+def install_signal_handlers(dump_file):
+    """ dump the memory caches to dump_file on SIGUSR1 and clear them on
+    SIGUSR2, where there are such signals and we are in the main thread.
+    The handlers only queue the work for a thread, since a signal can
+    arrive while the main thread holds a memory cache's lock """
+    global signal_thread
+    if not hasattr(signal, 'SIGUSR1') or threading.current_thread() is not threading.main_thread():
+        return False
+    if signal_thread is None:
+        signal_thread = threading.Thread(target=handle_signal_requests, name='cache-signals', daemon=True)
+        signal_thread.start()
+    signal.signal(signal.SIGUSR1, lambda signum, frame: signal_requests.put(lambda: dump(dump_file)))
+    signal.signal(signal.SIGUSR2, lambda signum, frame: signal_requests.put(clear_memory))
+    return True
+
+def start_refresher(batch_size=50, invalidation_file=None, interval=5):
+    """ refresh stale entries of cached functions in the background """
+    global refresher
+    if refresher is None:
+        refresher = Refresher(batch_size, invalidation_file, interval)
+    refresher.start()
+    return refresher
+
+def invalidate(qids):
+    """ make the entries of cached functions keyed by the wikidata ids
+    in qids stale, or remove them if they have no soft ttl, in their
+    stores and in memory, returning the number of entries """
+    stores = {}
+    n = 0
+    for wrapper in cached_functions:
+        n += wrapper.cache_invalidate(qids)
+        if wrapper.cache_store:
+            stores[id(wrapper.cache_store)] = wrapper.cache_store
+    return n + sum(store.invalidate(qids) for store in stores.values())
+
+
+class Memo:
+    """ a cache of results that callers compute and save themselves,
+    e.g., for calls with arguments that can't be part of a key, kept in
+    memory and, if a store is given, in it under name.  Values are
+    copied going in and out so callers can modify them.  Entries past
+    the soft ttl (the store's, or set_ttls's without one) are treated
+    as missing since there is no function to refresh them with. """
+
+    def __init__(self, name, maxsize, store=None):
+        self.__name__ = name
+        self.cache_store = store
+        self.cache_memory = MemoryCache(maxsize, budgets.get(name, default_budget))   # key => (value, time stored)
+        self.maxsize = maxsize
+        cached_functions.append(self)
+
+    def get(self, key):
+        """ returns (found, value) for a tuple key """
+        key = repr(key)
+        found, entry = self.cache_memory.get(key)
+        if not found and self.cache_store:
+            found, value, stored = self.cache_store.get_entry(self.__name__, key)
+            entry = (value, stored)
+        if found and (stale(self.cache_store, entry[1]) or expired(self.cache_store, entry[1])):
+            self.cache_memory.pop(key)
+            found = False
+        if not found:
+            return (False, None)
+        self.cache_memory.put(key, entry)
+        return (True, deepcopy(entry[0]))
+
+    def put(self, key, value):
+        key, value, stored = repr(key), deepcopy(value), time.time()
+        self.cache_memory.put(key, (value, stored))
+        if self.cache_store:
+            self.cache_store.put(self.__name__, key, value, stored)
+
+    def cache_info(self):
+        memory = self.cache_memory
+        return {'function': self.__name__, 'hits': memory.hits, 'misses': memory.misses,
+                'size': len(memory.data), 'maxsize': self.maxsize, 'bytes': memory.nbytes,
+                'maxbytes': memory.maxbytes, 'evictions': memory.evictions, 'evicted_bytes': memory.evicted_bytes}
+
+    def cache_invalidate(self, qids):
+        return 0   # keys are not wikidata ids
+
+    def cache_clear(self):
+        self.cache_memory.clear()
+        if self.cache_store:
+            self.cache_store.clear(self.__name__)
+
+
+def cached(maxsize, store=None, copy=False, name=None):
+    """ decorator like functools.lru_cache that also reads and writes
+    results to store, a PersistentCache, if one is given.  The wrapped
+    function gets cache_get, cache_put, cache_info and cache_clear
+    attributes so callers that fetch results in bulk can fill the cache.
+    If copy is true, callers get a deep copy of the cached value that
+    they are free to modify.  Entries in store are filed under name,
+    the function's name by default; give a new one when the form of
+    its results changes so old entries are not used.  Entries older
+    than store's ttl are recomputed and ones older than its soft_ttl
+    are returned and refreshed by the refresher, if one is running,
+    using the wrapper's batch_refresh function if it's given one: a
+    function taking a list of argument tuples and returning a list of
+    their results.  Without a store, the ttls given to set_ttls apply
+    to the memory layer.  The memory layer holds maxsize entries unless
+    there's a byte budget for name (see set_budgets). """
+
+    def decorator(func):
+        store_name = name or func.__name__
+        signature = inspect.signature(func)
+        memory = MemoryCache(maxsize, budgets.get(store_name, default_budget))   # key => (value, time stored)
+        stale_hits = 0
+
+        def bind(args, kwargs):
+            # bind so that f(x) and f(x, default) share an entry
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            return tuple(bound.arguments.values())
+
+        def make_key(args, kwargs):
+            return repr(bind(args, kwargs))
+
+        def lookup(key):
+            """ returns a tuple (found, value, stale) """
+            found, entry = memory.get(key)
+            if found and expired(store, entry[1]):
+                memory.pop(key)
+                found = False
+            if not found and store:
+                found, value, stored = store.get_entry(store_name, key)
+                if found:
+                    entry = (value, stored)
+                    memory.put(key, entry)
+            if not found:
+                return (False, None, False)
+            return (True, entry[0], stale(store, entry[1]))
+
+        def save(key, value, stored=None):
+            stored = stored or time.time()
+            memory.put(key, (value, stored))
+            if store:
+                store.put(store_name, key, value, stored)
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            nonlocal stale_hits
+            args = bind(args, kwargs)
+            key = repr(args)
+            found, value, stale = lookup(key)
+            if not found:
+                value = func(*args)
+                save(key, value)
+            elif stale and refresher:
+                stale_hits += 1
+                refresher.schedule(wrapper, key, args)
+            return deepcopy(value) if copy else value
+
+        def cache_get(*args, **kwargs):
+            """ returns (found, value) without calling the function """
+            found, value, stale = lookup(make_key(args, kwargs))
+            return (found, deepcopy(value) if copy else value)
+
+        def cache_put(args, value):
+            """ store value as the result of calling the function with the tuple args """
+            save(make_key(args, {}), value)
+
+        def cache_refresh(arg_tuples):
+            """ recompute and save the results for a list of argument tuples """
+            if wrapper.batch_refresh:
+                values = wrapper.batch_refresh(arg_tuples)
+            else:
+                values = [func(*args) for args in arg_tuples]
+            for args, value in zip(arg_tuples, values):
+                save(repr(args), value)
+
+        def cache_invalidate(qids):
+            """ make the entries in memory keyed by the ids in qids stale,
+            or remove them if there's no soft ttl """
+            n = 0
+            for key in memory.keys():
+                if key_qid(key) in qids:
+                    found, entry = memory.get(key)
+                    soft_ttl = ttls(store)[1]
+                    if found and soft_ttl:
+                        memory.put(key, (entry[0], min(entry[1], time.time() - soft_ttl - 1)))
+                    else:
+                        memory.pop(key)
+                    n += 1
+            return n
+
+        def cache_info():
+            return {'function': store_name, 'hits': memory.hits, 'misses': memory.misses,
+                    'stale': stale_hits, 'size': len(memory.data), 'maxsize': maxsize,
+                    'bytes': memory.nbytes, 'maxbytes': memory.maxbytes,
+                    'evictions': memory.evictions, 'evicted_bytes': memory.evicted_bytes}
+
+        def cache_clear():
+            memory.clear()
+            if store:
+                store.clear(store_name)
+
+        wrapper.cache_get = cache_get
+        wrapper.cache_put = cache_put
+        wrapper.cache_refresh = cache_refresh
+        wrapper.cache_invalidate = cache_invalidate
+        wrapper.cache_info = cache_info
+        wrapper.cache_clear = cache_clear
+        wrapper.cache_store = store
+        wrapper.cache_memory = memory
+        wrapper.batch_refresh = None
+        cached_functions.append(wrapper)
+        return wrapper
+
+    return decorator
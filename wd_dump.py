@@ -0,0 +1,369 @@
+"""
+
+Read a Wikidata JSON dump (or an N-Triples file) in parallel so the local
+indexes (label_index.py, type_index.py, ...) can be built from a 100+ GB
+compressed dump in hours rather than days.
+
+The dump is split into shards that are decompressed, parsed and reduced
+to the records an index needs by a pool of processes:
+
+ * an uncompressed file is split into byte ranges,
+ * a bz2 file made of many streams, as written by pbzip2 or lbzip2, is
+   split at stream boundaries, found by their magic numbers, and
+ * a single-stream bz2 or gz file is decompressed by this process, which
+   hands batches of lines to the pool.
+
+A line belongs to the shard in which it starts, so lines that cross a
+shard boundary are read once.  Each line goes through a cheap substring
+prefilter, then a parse function (json_entity by default), then an
+extract function that returns a record or None to drop it.  Both must be
+picklable, e.g., module-level functions or functools.partials of them.
+
+Each shard's records are pickled to a file in a work directory that only
+gets its final name when the shard is done, so an interrupted run picks
+up where it left off when run again.  records() merges the shards back
+into one stream of records in dump order.  From the command line:
+
+  python wd_dump.py latest-all.json.bz2 shards --extract mymodule:myfunction --prefilter P486 --merge items.pkl
+
+"""
+
+import os
+import re
+import bz2
+import sys
+import gzip
+import json
+import time
+import glob
+import pickle
+import argparse as ap
+import importlib
+from collections import deque
+from multiprocessing import Pool
+
+# bytes of (uncompressed or compressed) dump per shard
+SHARD_SIZE = 256 * 1024 * 1024
+
+# lines per batch sent to the pool when one process decompresses the dump
+BATCH_LINES = 10000
+
+# bytes read at a time
+CHUNK_SIZE = 1024 * 1024
+
+# the start of a bz2 stream: "BZh", the block size and the first block's magic number
+BZ2_STREAM = re.compile(rb'BZh[1-9]1AY&SY')
+
+## parsing
+
+def open_dump(path):
+    """ open a wikidata json dump, possibly compressed, for reading text """
+    if path.endswith('.bz2'):
+        return bz2.open(path, 'rt', encoding='utf-8')
+    elif path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8')
+    return open(path, encoding='utf-8')
+
+def json_entity(line):
+    """ the entity dict on a line of a wikidata json dump, which is a
+    json array with one entity per line, or None """
+    line = line.strip().rstrip(',')
+    if line and line not in ('[', ']'):
+        return json.loads(line)
+    return None
+
+def read_entities(path):
+    """ generates the entity dicts in a wikidata json dump, in one process """
+    with open_dump(path) as f:
+        for line in f:
+            entity = json_entity(line)
+            if entity is not None:
+                yield entity
+
+def extract_lines(lines, extract, parse=json_entity, prefilter=None):
+    """ the records extracted from an iterable of text lines """
+    records = []
+    for line in lines:
+        if prefilter and not any(s in line for s in prefilter):
+            continue
+        item = parse(line) if parse else line
+        if item is not None:
+            record = extract(item)
+            if record is not None:
+                records.append(record)
+    return records
+
+## reading byte ranges
+
+def plain_chunks(f, start, end):
+    """ generates (own, data) for the bytes of a file from start, where
+    own is true for the ones before end """
+    f.seek(start)
+    pos = start
+    while True:
+        data = f.read(CHUNK_SIZE)
+        if not data:
+            return
+        if pos < end < pos + len(data):
+            yield (True, data[:end - pos])
+            yield (False, data[end - pos:])
+        else:
+            yield (pos < end, data)
+        pos += len(data)
+
+def bz2_chunks(f, start, end):
+    """ generates (own, data) for the decompressed bytes of the bz2
+    streams from start, which must be the start of a stream, where own
+    is true for the data from streams that start before end """
+    f.seek(start)
+    pos = stream_start = start
+    decompressor = bz2.BZ2Decompressor()
+    while True:
+        chunk = f.read(CHUNK_SIZE)
+        if not chunk:
+            return
+        while chunk:
+            data = decompressor.decompress(chunk)
+            if data:
+                yield (stream_start < end, data)
+            if decompressor.eof:
+                consumed = len(chunk) - len(decompressor.unused_data)
+                chunk = decompressor.unused_data
+                pos += consumed
+                stream_start = pos
+                decompressor = bz2.BZ2Decompressor()
+            else:
+                pos += len(chunk)
+                chunk = b''
+
+def own_lines(chunks, first):
+    """ generates the lines that start in the own part of chunks from
+    plain_chunks or bz2_chunks.  Unless this is the first shard, the
+    line that starts before it, or at its first byte, belongs to the
+    shard before, which reads past its end to finish its last line. """
+    skipping = not first
+    buf = b''
+    for own, data in chunks:
+        if not own:
+            i = data.find(b'\n')
+            if i < 0:
+                buf += data
+                continue
+            if not skipping:
+                yield (buf + data[:i]).decode('utf-8')
+            return
+        lines = (buf + data).split(b'\n')
+        buf = lines.pop()
+        for line in lines:
+            if skipping:
+                skipping = False
+            else:
+                yield line.decode('utf-8')
+    if buf and not skipping:
+        yield buf.decode('utf-8')
+
+## planning shards
+
+def bz2_streams(path):
+    """ the offsets of the streams in a bz2 file """
+    offsets = []
+    with open(path, 'rb') as f:
+        pos, tail = 0, b''
+        while True:
+            data = f.read(CHUNK_SIZE)
+            if not data:
+                return offsets
+            block = tail + data
+            base = pos - len(tail)
+            for m in BZ2_STREAM.finditer(block):
+                if base + m.start() not in offsets[-1:]:
+                    offsets.append(base + m.start())
+            tail = block[-9:]
+            pos += len(data)
+
+def plan_shards(path, shard_size=SHARD_SIZE):
+    """ returns (mode, ranges) for a dump: 'plain' or 'bz2' with a list of
+    [start, end] byte ranges, or 'reader' if it has to be read by one process """
+    size = os.path.getsize(path)
+    if path.endswith('.gz'):
+        return ('reader', [])
+    if not path.endswith('.bz2'):
+        starts = list(range(0, size, shard_size)) or [0]
+        return ('plain', [[s, min(s + shard_size, size)] for s in starts])
+    offsets = bz2_streams(path)
+    if len(offsets) < 2:
+        return ('reader', [])
+    starts = [offsets[0]]
+    for offset in offsets[1:]:
+        if offset - starts[-1] >= shard_size:
+            starts.append(offset)
+    return ('bz2', [[s, e] for s, e in zip(starts, starts[1:] + [size])])
+
+## running
+
+def shard_file(workdir, n):
+    return os.path.join(workdir, f"shard-{n:05d}.pkl")
+
+def write_shard(path, records):
+    """ write records to a shard file, giving it its name when it's complete """
+    with open(path + '.tmp', 'wb') as out:
+        pickle.dump(records, out, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path + '.tmp', path)
+
+def process_range(task):
+    """ extract the records from one byte range of a dump into a shard file, in a pool process """
+    path, mode, n, start, end, outfile, extract, parse, prefilter = task
+    chunks = bz2_chunks if mode == 'bz2' else plain_chunks
+    with open(path, 'rb') as f:
+        records = extract_lines(own_lines(chunks(f, start, end), n == 0), extract, parse, prefilter)
+    write_shard(outfile, records)
+    return (n, end - start, len(records))
+
+def process_batch(n, lines, extract, parse, prefilter):
+    return (n, extract_lines(lines, extract, parse, prefilter))
+
+def load_manifest(workdir, path, shard_size):
+    """ returns the shard plan for a dump, reusing the one in workdir if
+    it was made for the same file so that finished shards are kept """
+    manifest_file = os.path.join(workdir, 'manifest.json')
+    stat = os.stat(path)
+    dump = {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime': stat.st_mtime, 'shard_size': shard_size}
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+        if manifest['dump'] == dump:
+            return manifest
+        print(f"{workdir} has shards for another dump, starting over")
+    for old in glob.glob(os.path.join(workdir, 'shard-*.pkl*')):
+        os.remove(old)
+    mode, ranges = plan_shards(path, shard_size)
+    manifest = {'dump': dump, 'mode': mode, 'ranges': ranges}
+    with open(manifest_file, 'w') as out:
+        json.dump(manifest, out)
+    return manifest
+
+def progress(start, shards_done, shards, nbytes, total, nrecords):
+    elapsed = time.time() - start
+    rate = nbytes / elapsed / 1e6 if elapsed else 0
+    print(f"{shards_done}/{shards or '?'} shards, {100 * nbytes / max(total, 1):.1f}% of dump, "
+          f"{nrecords} records, {rate:.1f} MB/s, {elapsed:.0f}s", file=sys.stderr, flush=True)
+
+def ingest(path, workdir, extract, parse=json_entity, prefilter=None, workers=None, shard_size=SHARD_SIZE):
+    """ extract records from every line of a dump into shard files in
+    workdir with a pool of workers processes, skipping shards done by an
+    earlier run.  parse turns a line into what extract is given (None
+    passes the line itself) and, if prefilter is a list of strings,
+    only lines containing one of them are parsed.  Returns the number of
+    shards. """
+    os.makedirs(workdir, exist_ok=True)
+    workers = workers or os.cpu_count()
+    prefilter = tuple(prefilter) if prefilter else None
+    manifest = load_manifest(workdir, path, shard_size)
+    total = manifest['dump']['size']
+    start = time.time()
+    with Pool(workers) as pool:
+        if manifest['mode'] == 'reader':
+            return ingest_reader(pool, workers, path, workdir, extract, parse, prefilter, shard_size, total, start)
+        ranges = manifest['ranges']
+        tasks = [(path, manifest['mode'], n, s, e, shard_file(workdir, n), extract, parse, prefilter)
+                 for n, (s, e) in enumerate(ranges) if not os.path.exists(shard_file(workdir, n))]
+        done = len(ranges) - len(tasks)
+        nbytes = sum(e - s for n, (s, e) in enumerate(ranges) if os.path.exists(shard_file(workdir, n)))
+        nrecords = 0
+        if done:
+            print(f"{done} shards already done", file=sys.stderr)
+        for n, size, records in pool.imap_unordered(process_range, tasks):
+            done, nbytes, nrecords = done + 1, nbytes + size, nrecords + records
+            progress(start, done, len(ranges), nbytes, total, nrecords)
+    return len(ranges)
+
+def ingest_reader(pool, workers, path, workdir, extract, parse, prefilter, shard_size, total, start):
+    """ ingest a dump that can't be split by decompressing it here and
+    sending batches of lines to the pool.  Shards are cut every
+    shard_size bytes of text so they are the same each run. """
+    raw = open(path, 'rb')
+    opener = bz2.open if path.endswith('.bz2') else gzip.open if path.endswith('.gz') else None
+    text = opener(raw, 'rt', encoding='utf-8') if opener else open(path, encoding='utf-8')
+
+    def batches():
+        n, size, lines = 0, 0, []
+        for line in text:
+            if not os.path.exists(shard_file(workdir, n)):
+                lines.append(line)
+            size += len(line)
+            if len(lines) >= BATCH_LINES or size >= shard_size:
+                if lines:
+                    yield (n, lines)
+                lines = []
+            if size >= shard_size:
+                yield (n, None)   # end of shard n
+                n, size = n + 1, 0
+        if lines:
+            yield (n, lines)
+        yield (n, None)
+
+    shard, records, shards, nrecords = 0, [], 0, 0
+    def collect(result):
+        nonlocal shard, records, shards, nrecords
+        n, batch = result
+        if batch is None:
+            if not os.path.exists(shard_file(workdir, n)):
+                write_shard(shard_file(workdir, n), records)
+            nrecords += len(records)
+            shards, records = shards + 1, []
+            progress(start, shards, None, raw.tell(), total, nrecords)
+        else:
+            records.extend(batch)
+
+    # keep a bounded number of batches in flight so a huge dump isn't read into memory
+    pending = deque()
+    with raw, text:
+        for n, lines in batches():
+            if lines is None:
+                pending.append(n)
+            else:
+                pending.append(pool.apply_async(process_batch, (n, lines, extract, parse, prefilter)))
+            while len(pending) > 2 * workers or (pending and isinstance(pending[0], int)):
+                head = pending.popleft()
+                collect((head, None) if isinstance(head, int) else head.get())
+        while pending:
+            head = pending.popleft()
+            collect((head, None) if isinstance(head, int) else head.get())
+    return shards
+
+## merging
+
+def read_shard(path):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+def records(workdir):
+    """ generates the records in a work directory's shards in dump order """
+    for path in sorted(glob.glob(os.path.join(workdir, 'shard-*.pkl'))):
+        yield from read_shard(path)
+
+def load_function(name):
+    """ the function for a name like module:function """
+    module, function = name.split(':')
+    return getattr(importlib.import_module(module), function)
+
+def get_args():
+    p = ap.ArgumentParser(description='extract records from a wikidata dump in parallel')
+    p.add_argument('dump', help='wikidata json dump or n-triples file, optionally .bz2 or .gz compressed')
+    p.add_argument('workdir', help='directory for the shard files')
+    p.add_argument('-e', '--extract', required=True, help='module:function called with each entity that returns a record or None')
+    p.add_argument('-p', '--prefilter', nargs='+', help='only parse lines with one of these strings')
+    p.add_argument('--lines', action='store_true', help='pass lines to the extract function rather than parsing them as json')
+    p.add_argument('-w', '--workers', type=int, default=os.cpu_count(), help='number of processes')
+    p.add_argument('-s', '--shard_size', type=int, default=SHARD_SIZE, help='bytes per shard')
+    p.add_argument('-m', '--merge', help='pickle a list of all of the records to this file')
+    return p.parse_args()
+
+if __name__ == '__main__':
+    args = get_args()
+    sys.path.insert(0, os.getcwd())
+    ingest(args.dump, args.workdir, load_function(args.extract), parse=None if args.lines else json_entity,
+           prefilter=args.prefilter, workers=args.workers, shard_size=args.shard_size)
+    if args.merge:
+        with open(args.merge, 'wb') as out:
+            pickle.dump(list(records(args.workdir)), out, protocol=pickle.HIGHEST_PROTOCOL)
@@ -0,0 +1,23 @@
+""" functions to map between wikidata ids and integers: items are
+positive (Q42 => 42) and properties are negative (P31 => -31) so both
+can share one integer array or dictionary """
+
+def qid2int(id):
+    """ returns the integer for a wikidata id like Q42 or P31 """
+    if id[0] == 'Q':
+        return int(id[1:])
+    elif id[0] == 'P':
+        return -int(id[1:])
+    raise ValueError(f"not a wikidata item or property id: {id}")
+
+def int2qid(n):
+    """ returns the wikidata id for an integer from qid2int """
+    return f"Q{n}" if n >= 0 else f"P{-n}"
+
+def qid_keys(dic):
+    """ a copy of a dict keyed by integer ids keyed by wikidata ids instead """
+    return {int2qid(id): value for id, value in dic.items()}
+
+def is_entity_id(id):
+    """ True iff id looks like a wikidata item or property id """
+    return type(id) == str and len(id) > 1 and id[0] in 'QP' and id[1:].isdigit()
@@ -16,14 +16,22 @@ import argparse as ap
 import sys
 import json
 import yaml
-import pickle
+import hashlib
+import inspect
 import re
-from SPARQLWrapper import SPARQLWrapper, JSON
+import threading
+import contextvars
 import requests
+import numpy as np
+from requests.adapters import HTTPAdapter
+from copy import deepcopy
 from collections import defaultdict
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from entity_types import *  #fixme
-from functools import lru_cache
+import wd_cache as wdc
+import wd_throttle as wdth
+from wd_ids import qid2int, int2qid, is_entity_id
+import atexit
 
 config_file="wd_search_config.yml"
 
@@ -55,22 +63,109 @@ SEARCH_ACTION = config.get("SEARCH_ACTION")
 SEARCH_LANGUAGE = config.get("SEARCH_LANGUAGE")
 LANGUAGE_MODEL = config.get("LANGUAGE_MODEL")
 LEMMATIZE_SEARCH_STRING = config.get("LEMMATIZE_SEARCH_STRING")
+LEMMATIZER_MODEL = config.get("LEMMATIZER_MODEL", "en_core_web_sm")
 DECODE_TO_ASCII = config.get("DECODE_TO_ASCII")
 REMOVE_SPECIAL_CHARS = config.get("REMOVE_SPECIAL_CHARS")
 SPECIAL_CHARS = config.get("SPECIAL_CHARS")
 DOMAIN = config.get("DOMAIN")
+BATCH_TYPE_QUERIES = config.get("BATCH_TYPE_QUERIES", False)
+TYPE_BATCH_SIZE = config.get("TYPE_BATCH_SIZE", 25)
+BULK_COMPLETION = config.get("BULK_COMPLETION", False)
+HTTP_POOL_SIZE = config.get("HTTP_POOL_SIZE", 10)
+HTTP_CONNECT_TIMEOUT = config.get("HTTP_CONNECT_TIMEOUT", 10)
+HTTP_READ_TIMEOUT = config.get("HTTP_READ_TIMEOUT", 60)
+CONCURRENT_CANDIDATES = config.get("CONCURRENT_CANDIDATES", False)
+MAX_WORKERS = config.get("MAX_WORKERS", 8)
+THROTTLE = config.get("THROTTLE", False)
+THROTTLE_FILE = config.get("THROTTLE_FILE", "throttle.ctrl")
+RATE_LIMIT = config.get("RATE_LIMIT", 5)
+RATE_BURST = config.get("RATE_BURST", 10)
+MAX_RETRIES = config.get("MAX_RETRIES", 5)
+BACKOFF_BASE = config.get("BACKOFF_BASE", 1)
+BACKOFF_MAX = config.get("BACKOFF_MAX", 60)
+SPECULATIVE_SEARCH = config.get("SPECULATIVE_SEARCH", False)
+ADAPTIVE_CANDIDATES = config.get("ADAPTIVE_CANDIDATES", False)
+CANDIDATE_WINDOW = config.get("CANDIDATE_WINDOW", 5)
+LABEL_INDEX = config.get("LABEL_INDEX", "label_index")
+TYPE_INDEX = config.get("TYPE_INDEX")
+ENTITY_BATCH_SIZE = min(config.get("ENTITY_BATCH_SIZE", 50), 50)   # wbgetentities takes at most 50 ids
+PERSISTENT_CACHE = config.get("PERSISTENT_CACHE", False)
+CACHE_FILE = config.get("CACHE_FILE", "wd_cache.sqlite")
+CACHE_TTL = config.get("CACHE_TTL", 0)
+CACHE_MAX_ENTRIES = config.get("CACHE_MAX_ENTRIES", 0)
+INFERRED_TYPES = config.get("INFERRED_TYPES") or {}
+PROPERTY_INDEX = config.get("PROPERTY_INDEX", "property_index")
+SEED_TYPE_LABELS = config.get("SEED_TYPE_LABELS", False)
+SITELINK_INDEX = config.get("SITELINK_INDEX")
+PRUNE_OBSCURE_CANDIDATES = config.get("PRUNE_OBSCURE_CANDIDATES", False)
+MIN_SITELINKS = config.get("MIN_SITELINKS", 1)
+CACHE_SOFT_TTL = config.get("CACHE_SOFT_TTL", 0)
+CACHE_INVALIDATION_FILE = config.get("CACHE_INVALIDATION_FILE")
+CACHE_REFRESH_BATCH_SIZE = config.get("CACHE_REFRESH_BATCH_SIZE", 50)
+CACHE_BYTES = config.get("CACHE_BYTES", 0)
+CACHE_BUDGETS = config.get("CACHE_BUDGETS") or {}
+CACHE_SIGNALS = config.get("CACHE_SIGNALS", False)
+CACHE_DUMP_FILE = config.get("CACHE_DUMP_FILE", "wd_cache_dump.json")
+EMBEDDING_STORE = config.get("EMBEDDING_STORE")
+IDF_TABLE = config.get("IDF_TABLE", "idf_table")
+RESULT_CACHE = config.get("RESULT_CACHE", False)
+PERSISTENT_RESULT_CACHE = config.get("PERSISTENT_RESULT_CACHE", False)
+
+# results of queries are cached in memory and, if PERSISTENT_CACHE is
+# true, in an sqlite database that can be shared by several processes.
+# Ones older than CACHE_TTL are recomputed and ones older than
+# CACHE_SOFT_TTL are used while they are refreshed in the background, as
+# are ones for the ids written to CACHE_INVALIDATION_FILE, whether or
+# not they are in the database
+cache_store = wdc.PersistentCache(CACHE_FILE, ttl=CACHE_TTL, max_entries=CACHE_MAX_ENTRIES, soft_ttl=CACHE_SOFT_TTL) if PERSISTENT_CACHE else None
+wdc.set_ttls(CACHE_TTL, CACHE_SOFT_TTL)
+if CACHE_SOFT_TTL or CACHE_INVALIDATION_FILE:
+    wdc.start_refresher(CACHE_REFRESH_BATCH_SIZE, CACHE_INVALIDATION_FILE)
+
+# the memory used by each function's cached results is bounded by
+# CACHE_BYTES or its entry in CACHE_BUDGETS if set, else by CACHE_SIZE
+# entries.  If CACHE_SIGNALS, a SIGUSR1 writes a report on the cached
+# results to CACHE_DUMP_FILE and a SIGUSR2 clears them from memory
+wdc.set_budgets(CACHE_BYTES, CACHE_BUDGETS)
+if CACHE_SIGNALS:
+    wdc.install_signal_handlers(CACHE_DUMP_FILE)
+
+# if RESULT_CACHE, the results of link and search are cached in memory
+# and, if PERSISTENT_RESULT_CACHE and PERSISTENT_CACHE, in the cache file
+# so repeated mentions skip searching, type checking and completion
+result_cache = wdc.Memo('link_results', CACHE_SIZE, cache_store if PERSISTENT_RESULT_CACHE else None) if RESULT_CACHE else None
 
 # Procure specific things
-if DOMAIN == 'Procure':
-    with open('mesh_items.pkl', 'rb') as infile: 
-        mesh_items = pickle.load(infile)
+if DOMAIN == 'Procure' and not INFERRED_TYPES:
+    INFERRED_TYPES = {'P486': {'type': 'Q199897', 'label': 'MESH', 'items': 'mesh_items.txt'}}
+
+# items with a property in INFERRED_TYPES get its type.  The items with
+# each property are in a memory-mapped index built by property_index.py,
+# which is built from the property's items file if it's not there yet
+if INFERRED_TYPES:
+    import property_index as pi
+    inferred_types_index = pi.PropertyIndex(PROPERTY_INDEX)
+    for prop, inferred in INFERRED_TYPES.items():
+        if not inferred_types_index.exists(prop) and inferred.get('items'):
+            pi.build_from_file(inferred['items'], PROPERTY_INDEX, prop)
 
 # If USE_CONTEXT is true that we may pass a context sentences with an
 # entity to help select the best match.  The context can be either a
 # raw string or a SpaCy span such as the sentence an entity was
 # mentioned in.
-
-if USE_CONTEXT:
+#
+# LANGUAGE_MODEL picks how hits are scored against a context: by the
+# similarity of their spaCy vectors (md, lg or trf), which needs the model
+# loaded, or by sparse_scorer.py's tfidf or bm25 scores, which only need
+# the IDF_TABLE it builds
+
+nlp = None
+sparse_scorer = None
+
+if USE_CONTEXT and LANGUAGE_MODEL in ('tfidf', 'bm25'):
+    import sparse_scorer as ss
+    sparse_scorer = ss.SparseScorer(IDF_TABLE, LANGUAGE_MODEL)
+elif USE_CONTEXT:
     import spacy
     if LANGUAGE_MODEL == "lg":
         nlp = spacy.load("en_core_web_lg")
@@ -78,11 +173,21 @@ if USE_CONTEXT:
         nlp = spacy.load("en_core_web_md")
     if LANGUAGE_MODEL == "trf":
         nlp = spacy.load("en_core_web_trf")
-        import tensor2attr
+        import tensor2attr   # registers the tensor2attr factory add_pipe needs
         nlp.add_pipe('tensor2attr')
     if  LANGUAGE_MODEL == "stanza":
         print("Context not supported yet")
         USE_CONTEXT = False
+
+# search strings are lemmatized with the context model or, when none is
+# loaded (e.g., for tfidf or bm25 scoring), the small LEMMATIZER_MODEL
+lemmatizer = nlp
+if LEMMATIZE_SEARCH_STRING and lemmatizer is None:
+    try:
+        import spacy
+        lemmatizer = spacy.load(LEMMATIZER_MODEL, disable=['parser', 'ner'])
+    except (ImportError, OSError) as e:
+        print(f"WARNING: not lemmatizing search strings, could not load {LEMMATIZER_MODEL}: {e}")
         
 def get_args( ):
     # PD is s profile of defaults, typically either DF or DFS
@@ -102,21 +207,113 @@ def get_args( ):
     args = p.parse_args()
     return args
 
-# for performance tracking, these will be incremented for each query
-wd_queries = 0
-dbp_queries = 0
-candidates_checked = 0
+# for performance tracking, counts of queries and candidates checked
+
+class QueryStats:
+    """ thread-safe counters, e.g., stats['wd_queries'] """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = defaultdict(int)
+
+    def add(self, name, n=1):
+        with self.lock:
+            self.counts[name] += n
+
+    def __getitem__(self, name):
+        return self.counts[name]
+
+    def as_dict(self):
+        with self.lock:
+            return dict(self.counts)
+
+# counts for everything this process has done and for the current
+# search; worker threads see the stats of the search that started them
+total_stats = QueryStats()
+request_stats = contextvars.ContextVar('request_stats', default=total_stats)
+
+def count(name, n=1):
+    """ increment a performance counter for the current search and the process """
+    total_stats.add(name, n)
+    stats = request_stats.get()
+    if stats is not total_stats:
+        stats.add(name, n)
+
+def get_stats():
+    """ returns a dict with the counts for the most recent search """
+    return request_stats.get().as_dict()
+
+# a bounded pool of threads for sending queries concurrently; a task
+# running in the pool that calls thread_map runs its items itself
+# rather than waiting on the pool
+pool_local = threading.local()
+executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, initializer=lambda: setattr(pool_local, 'worker', True))
+
+# speculative searches get their own threads since callers wait on them
+speculative_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+
+def thread_map(func, items):
+    """ returns [func(item) for item in items], computed concurrently on the thread pool """
+    if getattr(pool_local, 'worker', False):
+        return [func(item) for item in items]
+    futures = [executor.submit(contextvars.copy_context().run, func, item) for item in items]
+    return [future.result() for future in futures]
 
 # sparql endpoint
 default_wd_endpoint = "https://query.wikidata.org/bigdata/namespace/wdq/sparql"
 default_dbpedia_endpoint = "http://dbpedia.org/sparql"
 
+# wikidata api endpoint for searching and getting entities
+default_wd_api = "https://www.wikidata.org/w/api.php"
+
 # user agent for http request (required by wikidata query service) change name as appropriate
 USER_AGENT = "SearchBot/2.0 (Tim Finin)"
 
+# all requests to the wikidata api and the sparql endpoints go through
+# one session that keeps a pool of keep-alive connections for each host
+http = requests.Session()
+http.headers.update({'User-Agent': USER_AGENT, 'Accept-Encoding': 'gzip, deflate'})
+http.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE))
+http.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE))
+
+# requests to the wikidata api and sparql endpoint share one rate limit
+# that retries and backs off when the services are overloaded, and dbpedia
+# gets its own so one host being slow or overloaded doesn't hold up the
+# other.  If THROTTLE is false, requests are sent as fast as they come but
+# still retried.
+def host_throttle(site):
+    return wdth.Throttle(rate=RATE_LIMIT if THROTTLE else None, burst=RATE_BURST, max_concurrency=MAX_WORKERS,
+                         max_retries=MAX_RETRIES, backoff_base=BACKOFF_BASE, backoff_max=BACKOFF_MAX,
+                         ctrl_file=THROTTLE_FILE if THROTTLE else None, site=site)
+
+throttle = host_throttle('wikidata:wikidata')
+dbpedia_throttle = host_throttle('dbpedia:dbpedia')
+atexit.register(throttle.release_ctrl_file)
+atexit.register(dbpedia_throttle.release_ctrl_file)
+
+# longer sparql queries (e.g., ones with a big VALUES clause) are sent with POST
+MAX_GET_QUERY_LENGTH = 2000
+
 
 def link(string, target_types=TARGET_TYPES, ok_types=OK_TYPES, good_types=GOOD_TYPES, bad_types=BAD_TYPES, top=TOP, category=CATEGORY, context=None, ranking=RANKING, langs=LANGS, dbpedia=DBPEDIA, namespace="*"):
-    links = search(string, target_types=target_types, good_types=good_types, ok_types=ok_types, bad_types=bad_types, dbpedia=dbpedia, top=top, category=category, context=context, complete=False, namespace=namespace)
+    if not result_cache:
+        return link1(string, target_types, ok_types, good_types, bad_types, top, category, context, ranking, langs, dbpedia, namespace)
+    key = call_key('link', locals())
+    request_stats.set(QueryStats())
+    found, result = result_cache.get(key)
+    if found:
+        count('result_cache_hits')
+        return result
+    result = link1(string, target_types, ok_types, good_types, bad_types, top, category, context, ranking, langs, dbpedia, namespace)
+    result_cache.put(key, result)
+    return result
+
+def link1(string, target_types, ok_types, good_types, bad_types, top, category, context, ranking, langs, dbpedia, namespace):
+    result = choose_link(string, target_types, ok_types, good_types, bad_types, top, category, context, ranking, namespace)
+    return complete_item(result, langs, dbpedia) if result else None
+
+def choose_link(string, target_types, ok_types, good_types, bad_types, top, category, context, ranking, namespace):
+    """ the best of the hits for a search, before it's completed, or None """
+    links = search(string, target_types=target_types, good_types=good_types, ok_types=ok_types, bad_types=bad_types, top=top, category=category, context=context, complete=False, namespace=namespace)
     #print("LINKS:", links)
     if not links:
         return None
@@ -140,7 +337,7 @@ def link(string, target_types=TARGET_TYPES, ok_types=OK_TYPES, good_types=GOOD_T
                 result = best_links[0]
             else:
                 result = min(best_links, key = lambda link: link['search_rank'])
-    return complete_item(result, langs, dbpedia)
+    return result
 
 
 # search wikidata given a string for entities, filter by requiring a type on the target or ok list and no types on the bad list
@@ -149,16 +346,178 @@ def search(string, langs=LANGS, target_types=TARGET_TYPES, good_types=GOOD_TYPES
     """ generic WD search """
 
     # track these for performance reviews
-    global wd_queries, dbp_queries, candidates_checked
-    wd_queries = dbp_queries = candiates_checked = 0
-    
+    request_stats.set(QueryStats())
+
+    if not result_cache:
+        return search1(string, langs, target_types, good_types, ok_types, bad_types, limit, top, dbpedia, category, context, complete, promote_exact_label_match, namespace)
+    key = call_key('search', locals())
+    found, hits = result_cache.get(key)
+    if found:
+        count('result_cache_hits')
+        return hits
+    hits = search1(string, langs, target_types, good_types, ok_types, bad_types, limit, top, dbpedia, category, context, complete, promote_exact_label_match, namespace)
+    result_cache.put(key, hits)
+    return hits
+
+def search1(string, langs, target_types, good_types, ok_types, bad_types, limit, top, dbpedia, category, context, complete, promote_exact_label_match, namespace):
     hits = string_search(string, target_types=target_types, good_types=good_types, ok_types=ok_types, bad_types=bad_types, category=category, limit=limit, top=top, context=context, extended_context='', promote_exact_label_match=promote_exact_label_match, namespace=namespace)
     if complete:
-        return [complete_item(hit, langs, dbpedia) for hit in hits]
+        return complete_items(hits, langs, dbpedia)
     else:
         return hits
 
 
+def call_key(kind, args):
+    """ the result_key for a call to link or search given a dict of all of its arguments """
+    types = (args['target_types'], args['good_types'], args['ok_types'], args['bad_types'])
+    if kind == 'link':
+        rest = (args['ranking'], args['langs'], args['dbpedia'], args['namespace'])
+    else:
+        rest = (args['langs'], args['limit'], args['dbpedia'], args['complete'], args['promote_exact_label_match'], args['namespace'])
+    return result_key(kind, args['string'], types, args['category'], args['top'], args['context'], *rest)
+
+def result_key(kind, string, types, category, top, context, *args):
+    """ the key for a link or search result: its string with whitespace
+    normalized, the lists of types, category, top, a hash of the context
+    if it's used, the settings that change results and the rest of the
+    call's arguments """
+    text = context if context is None or type(context) == str else context.text
+    fingerprint = hashlib.sha1(text.encode('utf-8')).hexdigest()[:16] if text and USE_CONTEXT else ''
+    types = tuple(tuple(t or ()) for t in types)
+    args = tuple(tuple(arg) if type(arg) == list else arg for arg in args)
+    return (kind, ' '.join(string.split()), types, category, top, fingerprint, SEARCH_ACTION, LANGUAGE_MODEL) + args
+
+## linking or searching for many strings at once
+
+def link_many(mentions, **defaults):
+    """ link each of a list of mentions, returning their results in the
+    same order.  See call_args for the forms a mention can take;
+    defaults are keyword arguments for link that apply to all of them.
+    Identical mentions are linked once, candidates for all of them are
+    searched for concurrently, and their types and what's needed to
+    complete their results are fetched in batches.  get_stats() then
+    returns the stats for the whole batch. """
+    before = total_stats.as_dict()
+    calls = [call_args(link, mention, defaults) for mention in mentions]
+    keys, results, todo = dedupe_calls('link', calls)
+    prefetch(todo.values())
+    chosen = thread_map(lambda args: choose_link(args['string'], args['target_types'], args['ok_types'], args['good_types'], args['bad_types'],
+                                                 args['top'], args['category'], args['context'], args['ranking'], args['namespace']),
+                        list(todo.values()))
+    prefetch_entities([(result['id'], args['langs']) for args, result in zip(todo.values(), chosen) if result])
+    for (key, args), result in zip(todo.items(), chosen):
+        results[key] = complete_item(result, args['langs'], args['dbpedia']) if result else None
+        if result_cache:
+            result_cache.put(key, results[key])
+    return batch_results(keys, results, todo, before)
+
+def search_many(mentions, **defaults):
+    """ search for each of a list of mentions, returning a list of their
+    hits in the same order, like link_many does for link """
+    before = total_stats.as_dict()
+    calls = [call_args(search, mention, defaults) for mention in mentions]
+    keys, results, todo = dedupe_calls('search', calls)
+    prefetch(todo.values())
+    found = thread_map(lambda args: search(**dict(args, complete=False)), list(todo.values()))
+    prefetch_entities([(hit['id'], args['langs']) for args, hits in zip(todo.values(), found) if args['complete'] for hit in hits])
+    for (key, args), hits in zip(todo.items(), found):
+        results[key] = complete_items(hits, args['langs'], args['dbpedia']) if args['complete'] else hits
+        if result_cache:
+            result_cache.put(key, results[key])
+    return batch_results(keys, results, todo, before)
+
+def call_args(func, mention, defaults):
+    """ a dict of all of the arguments of a call to func, link or search,
+    for a mention, which can be a string, a tuple of a string, target
+    types, category and context, or a dict of keyword arguments """
+    if type(mention) == str:
+        mention = (mention,)
+    if type(mention) in (tuple, list):
+        mention = dict(zip(('string', 'target_types', 'category', 'context'), mention))
+    bound = inspect.signature(func).bind(**dict(defaults, **{k: v for k, v in mention.items() if v is not None}))
+    bound.apply_defaults()
+    return bound.arguments
+
+def dedupe_calls(kind, calls):
+    """ returns the key of each call, a dict of the results of the ones
+    in the result cache and a dict mapping the keys of the others to
+    the first call with them """
+    keys = [call_key(kind, args) for args in calls]
+    results = {}
+    todo = {}
+    for key, args in zip(keys, calls):
+        if key in results or key in todo:
+            continue
+        found, result = result_cache.get(key) if result_cache else (False, None)
+        if found:
+            results[key] = result
+        else:
+            todo[key] = args
+    return keys, results, todo
+
+def prefetch(calls):
+    """ get the candidates for a list of calls concurrently and then the
+    type records of the ones that need them TYPE_BATCH_SIZE at a time,
+    also concurrently, so the calls find them in the caches.  With
+    ADAPTIVE_CANDIDATES, only the types of the first window of candidates
+    string_search checks are fetched, since it may not need the rest """
+    calls = list(calls)
+    searches = [(improve_search_string(args['string']), args.get('limit', LIMIT), args['namespace']) for args in calls]
+    unique = list(dict.fromkeys(searches))
+    found = dict(zip(unique, thread_map(lambda s: get_candidates(s[0], SEARCH_ACTION, s[1], SEARCH_LANGUAGE, s[2]), unique)))
+    qids = {}
+    for args, s in zip(calls, searches):
+        profile = get_type_profile(args['target_types'], args['good_types'], args['ok_types'], args['bad_types'])
+        if TYPE_INDEX and get_type_index().covers(profile.type_ids):
+            continue
+        string, candidates = found[s]
+        if ADAPTIVE_CANDIDATES:
+            if PRUNE_OBSCURE_CANDIDATES and SITELINK_INDEX:
+                candidates = popular_first(candidates, string, SEARCH_ACTION,
+                                           args.get('promote_exact_label_match', PROMOTE_EXACT_LABEL_MATCH))[0]
+            candidates = candidates[:max(CANDIDATE_WINDOW, 1)]
+        qids.update(dict.fromkeys(item_ids(candidates)))
+    qids = list(qids)
+    thread_map(get_type_records, [qids[i:i+TYPE_BATCH_SIZE] for i in range(0, len(qids), TYPE_BATCH_SIZE)])
+
+def prefetch_entities(qid_langs):
+    """ with BULK_COMPLETION, get what's needed to complete a list of
+    (qid, langs) results ENTITY_BATCH_SIZE at a time, concurrently """
+    if not BULK_COMPLETION or SCALE:
+        return
+    batches = []
+    for langs in dict.fromkeys(tuple(langs) for qid, langs in qid_langs):
+        qids = list(dict.fromkeys(qid for qid, l in qid_langs if tuple(l) == langs))
+        batches += [(qids[i:i+ENTITY_BATCH_SIZE], langs) for i in range(0, len(qids), ENTITY_BATCH_SIZE)]
+    thread_map(lambda batch: get_entities(*batch), batches)
+
+def batch_results(keys, results, todo, before):
+    """ the results for keys in order, copying ones for repeated keys,
+    after setting the stats for the batch: the differences in the
+    process's counts since before, the number of requests, unique
+    requests and ones answered from the result cache, and an estimate
+    of the queries saved by dropping repeats and batching queries """
+    stats = QueryStats()
+    after = total_stats.as_dict()
+    for name, n in after.items():
+        if n != before.get(name, 0):
+            stats.add(name, n - before.get(name, 0))
+    unique = len(dict.fromkeys(keys))
+    queries = stats['api_queries'] + stats['wd_queries']
+    stats.add('requests', len(keys))
+    stats.add('unique_requests', unique)
+    stats.add('cached_requests', unique - len(todo))
+    stats.add('queries_saved', round((len(keys) - unique) * queries / max(len(todo), 1))
+              + stats['type_records_fetched'] - stats['type_record_queries']
+              + stats['entities_fetched'] - stats['entity_queries'])
+    request_stats.set(stats)
+    seen = set()
+    ordered = []
+    for key in keys:
+        ordered.append(deepcopy(results[key]) if key in seen else results[key])
+        seen.add(key)
+    return ordered
+
 def string_search(string, target_types=TARGET_TYPES, good_types=GOOD_TYPES, ok_types=OK_TYPES, bad_types=BAD_TYPES, category=CATEGORY, limit=LIMIT, top=TOP, action=SEARCH_ACTION, promote_exact_label_match=PROMOTE_EXACT_LABEL_MATCH, lang=SEARCH_LANGUAGE, context='', extended_context='', namespace="*"):
 
     """ search for up to limit items whose text matches string that
@@ -169,21 +528,14 @@ def string_search(string, target_types=TARGET_TYPES, good_types=GOOD_TYPES, ok_t
     acceptable type. Within each category items are ranked by their intial order,
     which reflects a matching strategy. """
 
-    global candidates_checked
-
-    assert category in ['all', 'strictinstance', 'instance', 'strictconcept', 'concept']
+    assert category in CATEGORIES
 
     #print(f"action:{action}, tagets: {target_types}, ok: {ok_types}, top: {top}, limit: {limit}")
-    near_miss_types = []
-    for t in target_types:
-        near_miss_types += NEAR_MISS_TYPES[t] if t in NEAR_MISS_TYPES else []
+    # the type names resolved to Qids (e.g., PER=>Q5), computed once for each combination of types
+    profile = get_type_profile(target_types, good_types, ok_types, bad_types)
 
-    # resolve the type names to Qids (e.g., PER=>Q5)
-    target_types = wd_types(target_types)
-    good_types = wd_types(good_types)
-    ok_types = wd_types(ok_types)
-    bad_types = wd_types(bad_types)
-    near_miss_types = wd_types(near_miss_types)
+    # the local type index can classify the candidates if it has all of the types
+    local = bool(TYPE_INDEX) and get_type_index().covers(profile.type_ids)
 
     # every hit should be in one of these
     target_hits = []      # candidates with a type in target_types and no type in bad_types
@@ -193,33 +545,62 @@ def string_search(string, target_types=TARGET_TYPES, good_types=GOOD_TYPES, ok_t
 
     string = improve_search_string(string)
     string, candidates = get_candidates(string, action, limit, lang, namespace)
-    
-    ##print(f"candidates: {len(candidates)}")
-    # process each candidate until we've found enough hits
-    for item in candidates:
-        candidates_checked += 1 # for debugging
-        id = item['title']
-        #print('checking:', id, item)
-        found_types = get_types(id, target_types, near_miss_types, good_types, ok_types, bad_types, category)
-        if found_types == ([],[],[],[]):   # found neither a target, near miss, nor ok type, skip
-            continue
-        #print('TYPES', id, found_types)
-        tt, nmt, gt, ot = found_types
-        
-        item['types'] = [t[0]+':'+t[1] for t in tt + nmt + gt + ot]
 
-        if action == "label_aliases_description":  #regularize
-            item['description'] = item['snippet'].replace('<span class="searchmatch">','').replace('</span>','')
-            item['label'] = item['titlesnippet'].replace('<span class="searchmatch">','').replace('</span>','')
+    # check the candidates' types in search order.  If ADAPTIVE_CANDIDATES,
+    # do this a window at a time, doubling the window as we go, and stop
+    # when the remaining ones can no longer make it into the top hits
+    window = max(CANDIDATE_WINDOW, 1) if ADAPTIVE_CANDIDATES else len(candidates)
+    todo, deferred = candidates, []
+    if PRUNE_OBSCURE_CANDIDATES and SITELINK_INDEX:
+        # check popular candidates first and only check the obscure ones
+        # if they don't give us top target hits
+        todo, deferred = popular_first(candidates, string, action, promote_exact_label_match)
+    while todo:
+        batch, todo = todo[:window], todo[window:]
+        window *= 2
+        for item, found_types in zip(batch, check_candidates(batch, profile, category, local)):
+            count('candidates_checked') # for debugging
+            #print('checking:', item['title'], item)
+            if found_types == ([],[],[],[]):   # found neither a target, near miss, nor ok type, skip
+                continue
+            #print('TYPES', id, found_types)
+            tt, nmt, gt, ot = found_types
+
+            item['types'] = [t[0]+':'+t[1] for t in tt + nmt + gt + ot]
+
+            if action == "label_aliases_description":  #regularize
+                item['description'] = remove_search_match(item['snippet'])
+                item['label'] = remove_search_match(item['titlesnippet'])
+
+            if tt:
+                target_hits.append(item)
+            elif nmt:
+                near_miss_hits.append(item)
+            elif gt:
+                good_hits.append(item)
+            elif ot:
+                ok_hits.append(item)
+
+        if todo and ADAPTIVE_CANDIDATES and len(target_hits) >= top:
+            # with top target hits, a later candidate would be ranked
+            # after them unless its label is an exact match that gets
+            # promoted, so only those still need to be checked
+            exact = [item for item in todo if promote_exact_label_match and candidate_label(item, action).lower() == string.lower()]
+            count('candidates_skipped', len(todo) - len(exact))
+            todo = exact
+
+        if not todo and deferred:
+            if len(target_hits) >= top:
+                count('candidates_pruned', len(deferred))
+            else:
+                todo = deferred
+            deferred = []
 
-        if tt:
-            target_hits.append(item)
-        elif nmt:
-            near_miss_hits.append(item)
-        elif gt:
-            good_hits.append(item)
-        elif ot:
-            ok_hits.append(item)
+    if PRUNE_OBSCURE_CANDIDATES and SITELINK_INDEX:
+        # put hits from deferred candidates back in search order
+        position = {id(item): i for i, item in enumerate(candidates)}
+        for hit_list in (target_hits, near_miss_hits, good_hits, ok_hits):
+            hit_list.sort(key=lambda item: position[id(item)])
 
     #print(f"T: {[h['title'] for h in target_hits]}")
     #print(f"N: {[h['title'] for h in near_miss_hits]}")
@@ -250,21 +631,9 @@ def string_search(string, target_types=TARGET_TYPES, good_types=GOOD_TYPES, ok_t
     # add rank and context scores 
     for rank, hit in enumerate(hits):
         hit['search_rank'] = rank + 1
-        # add context scores
         hit['score'] = 0.0
-        if context and USE_CONTEXT:
-            if type(context) == str:
-                hit['context'] = context
-                context = nlp(context)
-            else:
-                hit['context'] = context.text
-            if hit['label'] and hit['description']:
-                label = hit['label']
-                desc = hit['description']
-                wd_text = desc if label in desc else label + " " + desc    # add label to description if it's not in it
-                hit['score'] = nlp(wd_text).similarity(context)
-            else:
-                wd_text = ""
+    if context and USE_CONTEXT:
+        score_hits(hits, context)
 
     for n, hit in enumerate(sorted(hits, key=lambda x: x['score'], reverse=True)):
         hit['scores'] = [hit['score']]
@@ -273,6 +642,222 @@ def string_search(string, target_types=TARGET_TYPES, good_types=GOOD_TYPES, ok_t
     
     return hits
 
+## context scores: the cosine similarity of the vector of a hit's label
+## and description and the context's vector, as spaCy's similarity gives,
+## or the sparse scorer's score for them
+
+def score_hits(hits, context):
+    """ set the score of each hit with a label and description to how
+    well it matches context, a string or spaCy span, scoring all of them
+    at once """
+    text = context if type(context) == str else context.text
+    scored = [hit for hit in hits if hit['label'] and hit['description']]
+    for hit in hits:
+        hit['context'] = text
+    if not scored:
+        return
+    if sparse_scorer:
+        texts = item_texts([hit['id'] for hit in scored])
+        scores = sparse_scorer.scores([texts[hit['id']] for hit in scored], text)
+    else:
+        vector = text_vectors([context])[0] if type(context) == str else context.vector
+        scores = cosine_similarities(item_vectors([hit['id'] for hit in scored]), vector)
+    for hit, score in zip(scored, scores):
+        hit['score'] = float(score)
+
+def hit_text(hit):
+    """ a hit's description, with its label in front if it's not in it """
+    label, desc = hit['label'], hit['description']
+    return desc if label in desc else label + " " + desc
+
+def text_vectors(texts):
+    """ a matrix of the vectors of a list of texts, computed in one pass.
+    The static vectors of the md and lg models only need the tokenizer
+    but the trf model's come from running its whole pipeline """
+    disable = [] if LANGUAGE_MODEL == 'trf' else nlp.pipe_names
+    return np.array([doc.vector for doc in nlp.pipe(texts, disable=disable)], dtype=np.float32)
+
+def entity_text(entity):
+    """ the text of an item's english label and description, from its
+    get_entity dict, that its vector is computed from """
+    label, aliases, desc, wname = entity['ladw']['en']
+    return hit_text({'label': label, 'description': desc})
+
+@wdc.cached(CACHE_SIZE, cache_store)
+def get_item_text(qid):
+    """ the entity_text of an item, which hits are scored on """
+    return fetch_item_texts([qid])[qid]
+
+def item_texts(qids):
+    """ returns a dict mapping each qid to its entity_text, taking it
+    from a cached get_entity dict if there is one and otherwise getting
+    just the english labels and descriptions ENTITY_BATCH_SIZE at a time """
+    texts = {}
+    todo = []
+    for qid in dict.fromkeys(qids):
+        found, text = get_item_text.cache_get(qid)
+        if not found:
+            found, entity = get_entity.cache_get(qid, ('en',))
+            text = entity_text(entity) if found else None
+        if found:
+            texts[qid] = text
+        else:
+            todo.append(qid)
+    for i in range(0, len(todo), ENTITY_BATCH_SIZE):
+        count('text_queries')
+        for qid, text in fetch_item_texts(todo[i:i+ENTITY_BATCH_SIZE]).items():
+            get_item_text.cache_put((qid,), text)
+            texts[qid] = text
+    return texts
+
+def refresh_item_texts(arg_tuples):
+    """ get_item_text's batch_refresh, fetching ENTITY_BATCH_SIZE at a time """
+    qids = [args[0] for args in arg_tuples]
+    texts = {}
+    for i in range(0, len(qids), ENTITY_BATCH_SIZE):
+        texts.update(fetch_item_texts(qids[i:i+ENTITY_BATCH_SIZE]))
+    return [texts[qid] for qid in qids]
+
+get_item_text.batch_refresh = refresh_item_texts
+
+@wdc.cached(CACHE_SIZE)
+def item_vector(qid):
+    """ the vector of an item's english label and description """
+    return text_vectors([item_texts([qid])[qid]])[0].copy()
+
+def item_vectors(qids):
+    """ a matrix of the vectors of qids, computing the ones not cached
+    or in the embedding store in one batch and adding them to both.
+    Like item_vector, they're computed from the item's entity_text
+    rather than a hit's search snippets, so a vector is the same
+    whichever search or process computed it.  The cache gets
+    copies of the rows of a batch so each entry holds, and its size
+    counts, just its own vector """
+    vectors = {}
+    todo = []
+    for qid in dict.fromkeys(qids):
+        found, vector = item_vector.cache_get(qid)
+        if found:
+            vectors[qid] = vector
+        else:
+            todo.append(qid)
+    if todo and EMBEDDING_STORE:
+        stored = get_embedding_store().get_many(todo)
+        count('vectors_stored', len(stored))
+        for qid, vector in stored.items():
+            vector = vector.copy()
+            item_vector.cache_put((qid,), vector)
+            vectors[qid] = vector
+        todo = [qid for qid in todo if qid not in stored]
+    if todo:
+        count('vectors_computed', len(todo))
+        texts = item_texts(todo)
+        computed = text_vectors([texts[qid] for qid in todo])
+        for qid, vector in zip(todo, computed):
+            vector = vector.copy()
+            item_vector.cache_put((qid,), vector)
+            vectors[qid] = vector
+        if EMBEDDING_STORE:
+            get_embedding_store().put_many(todo, computed)
+    return np.array([vectors[qid] for qid in qids])
+
+# a store of item vectors shared by processes, opened when first used
+embedding_store = None
+
+def get_embedding_store():
+    global embedding_store
+    if embedding_store is None:
+        import embedding_store as es
+        embedding_store = es.EmbeddingStore(EMBEDDING_STORE, LANGUAGE_MODEL)
+    return embedding_store
+
+def cosine_similarities(vectors, vector):
+    """ the cosine similarity of each row of a matrix and a vector, 0 where either has no length """
+    norms = np.linalg.norm(vectors, axis=1) * np.linalg.norm(vector)
+    dots = vectors @ vector
+    return np.divide(dots, norms, out=np.zeros_like(dots), where=norms > 0)
+
+def check_candidates(candidates, profile, category, local=False):
+    """ returns a list with get_types's tuple of found types for each candidate """
+    qids = item_ids(candidates)
+    if BATCH_TYPE_QUERIES:
+        # get the types of all of the candidates with one query rather than one per candidate
+        qid2types = query_for_types_batch(qids, category, local)
+        found = [profile.classify(qid2types[qid] | infer_types(qid, category)) for qid in qids]
+    else:
+        # get the types of each candidate, optionally several at once
+        classify = lambda qid: profile.classify(query_for_types(qid, category, local) | infer_types(qid, category))
+        found = thread_map(classify, qids) if CONCURRENT_CANDIDATES else [classify(qid) for qid in qids]
+    return found_type_tuples(qids, found)
+
+class TypeProfile:
+    """ the integer ids of the target, near miss, good, ok and bad types
+    of a search, with the kind of each so a candidate's types can be
+    classified with one dict lookup per type """
+
+    KINDS = ['target', 'near_miss', 'good', 'ok', 'bad']
+
+    def __init__(self, target_types, near_miss_types, good_types, ok_types, bad_types):
+        self.kind = {}
+        # a type in more than one list gets the kind checked first by get_types
+        for k, types in reversed(list(enumerate([target_types, near_miss_types, good_types, ok_types]))):
+            for t in types:
+                self.kind[qid2int(t)] = k
+        for t in bad_types:
+            self.kind[qid2int(t)] = 4
+        self.type_ids = frozenset(int2qid(id) for id in self.kind)
+
+    def classify(self, types):
+        """ returns a tuple of lists of the integer ids in types that
+        are target, near miss, good and ok types, or four empty lists if
+        one is a bad type """
+        found = ([], [], [], [])
+        for id in types:
+            k = self.kind.get(id)
+            if k == 4:
+                return ([], [], [], [])
+            elif k is not None:
+                found[k].append(id)
+        return found
+
+@wdc.cached(CACHE_SIZE)
+def get_type_profile(target_types, good_types, ok_types, bad_types):
+    """ returns the TypeProfile for lists of type names or ids and the
+    near miss types of the target types """
+    near_miss_types = []
+    for t in target_types:
+        near_miss_types += NEAR_MISS_TYPES[t] if t in NEAR_MISS_TYPES else []
+    return TypeProfile(wd_types(target_types), wd_types(near_miss_types), wd_types(good_types), wd_types(ok_types), wd_types(bad_types))
+
+def found_type_tuples(qids, found):
+    """ turn the integer ids in TypeProfile.classify's results for qids into
+    (id, label) tuples, getting the labels they need all at once """
+    get_type_labels([id for qid, f in zip(qids, found) for ids in f for id in ids if id != qid2int(qid)])
+    return [tuple([type_tuple(id, qid) for id in ids] for ids in f) for qid, f in zip(qids, found)]
+
+def popular_first(candidates, string, action, promote_exact_label_match):
+    """ splits candidates into popular ones, with at least MIN_SITELINKS
+    sitelinks in the local sitelink index, unknown to it or with a label
+    that's an exact match that gets promoted, and obscure ones """
+    popular, obscure = [], []
+    for item in candidates:
+        local = get_local_sitelinks(item['title'])
+        if local is None or local[0] >= MIN_SITELINKS or (promote_exact_label_match and candidate_label(item, action).lower() == string.lower()):
+            popular.append(item)
+        else:
+            obscure.append(item)
+    return popular, obscure
+
+def candidate_label(item, action):
+    """ the label string_search will give a candidate """
+    if action == "label_aliases_description":
+        return remove_search_match(item.get('titlesnippet', ''))
+    return item.get('label', '')
+
+def remove_search_match(snippet):
+    """ remove the markup the search api puts around matched text """
+    return snippet.replace('<span class="searchmatch">','').replace('</span>','')
+
 def promote_matches(hits, string_lower):
     if not hits:
         return hits
@@ -290,14 +875,18 @@ def promote_matches(hits, string_lower):
 def get_candidates(string, action=SEARCH_ACTION, limit=LIMIT, lang=SEARCH_LANGUAGE, namespace="*"):
     """ return a tuple of the string and a list of limit candidates matching string """
 
-    assert action in ['label_aliases_description', 'label_aliases']
+    assert action in ['label_aliases_description', 'label_aliases', 'local_index']
+
+    truncated = ' '.join(string.split(' ')[1:])
+    if SPECULATIVE_SEARCH and truncated and not get_candidates1.cache_get(string, action, limit, lang, namespace)[0]:
+        return get_candidates_speculative(string, truncated, action, limit, lang, namespace)
 
     hits = get_candidates1(string, action, limit, lang, namespace)
     if hits:
         return (string, hits)
     #print(f"Search string {string} produced no hits")
     # try removing first token
-    string = ' '.join(string.split(' ')[1:])
+    string = truncated
     if string:
         hits = get_candidates1(string, action, limit, lang,   namespace)
         #print(f"Truncated string {string} produced candidates {item_ids(hits)}")
@@ -306,9 +895,28 @@ def get_candidates(string, action=SEARCH_ACTION, limit=LIMIT, lang=SEARCH_LANGUA
         print(f"Truncated string {string} produced no candidates")        
         return (string, [])
 
+def get_candidates_speculative(string, truncated, action, limit, lang, namespace):
+    """ like get_candidates, but searches for the string without its
+    first token at the same time as the full string so a miss doesn't
+    have to wait for a second search.  The full search is submitted
+    first, so when the pool is busy the speculative one is queued behind
+    it and cancelled if the full string has hits; once it has started
+    its result is just ignored. """
+    full = speculative_executor.submit(contextvars.copy_context().run, get_candidates1, string, action, limit, lang, namespace)
+    speculative = speculative_executor.submit(contextvars.copy_context().run, get_candidates1, truncated, action, limit, lang, namespace)
+    count('speculative_searches')
+    hits = full.result()
+    if hits:
+        if speculative.cancel():
+            count('speculative_searches_cancelled')
+        return (string, hits)
+    return (truncated, speculative.result())
+
+# candidates are cached, including empty lists for strings with no
+# hits, and copied since string_search modifies them
+@wdc.cached(CACHE_SIZE, cache_store, copy=True)
 def get_candidates1(string, action, limit, lang, namespace):
     """ return a list of limit candidates matching string """
-    api_url = "https://www.wikidata.org/w/api.php"
 
     nsd = {'Q':'0', 'P':'120', '*':"120|0"}
     ns = nsd[namespace]
@@ -318,13 +926,16 @@ def get_candidates1(string, action, limit, lang, namespace):
         params = {'action':'query', 'list':'search', 'srsearch':string, 'srlimit':limit, \
                       'format':'json', 'srprop':'titlesnippet|snippet' , 'srnamespace':ns}
         #print('PARAMS1', params)
-        result = requests.Session().get(url=api_url, params=params).json()
+        result = api_get(params)
         hits = [item for item in result['query']['search']]
     elif action == "label_aliases":
         params = {'action':'wbsearchentities', 'search':string, "language":lang, 'format':'json', 'limit':limit, 'srnamespace':ns}
         #print('PARAMS2', params)
-        result = requests.Session().get(url=api_url, params=params).json()
+        result = api_get(params)
         hits = [item for item in result['search']]
+    elif action == "local_index":
+        count('index_searches')
+        hits = get_label_index().search(string, limit, namespace)
     for h in hits:
         h['search_string'] = string
     #print('HITS:', [h['title'] for h in hits])
@@ -334,6 +945,16 @@ def get_candidates1(string, action, limit, lang, namespace):
             hit['title'] = id[9:]
     return hits
 
+# a local label index built from a wikidata dump by label_index.py, opened when first used
+local_label_index = None
+
+def get_label_index():
+    global local_label_index
+    if local_label_index is None:
+        import label_index
+        local_label_index = label_index.LabelIndex(LABEL_INDEX)
+    return local_label_index
+
 def item_ids(hits):
     return [h['title'] for h in hits]
 
@@ -346,7 +967,7 @@ def improve_search_string(string):
         else:
             #string2 = re.sub(r'[^\x00-\x7f]',r'', string)
             string = string.encode('utf-8').decode('ascii', errors='ignore')
-    if LEMMATIZE_SEARCH_STRING:
+    if LEMMATIZE_SEARCH_STRING and lemmatizer:
         string = lemmatize_string(string)
     if REMOVE_SPECIAL_CHARS:
         string = remove_special_chars(string)
@@ -355,7 +976,7 @@ def improve_search_string(string):
 
 def lemmatize_string(string):
     """ Returns a new string with each of the tokens in the input replaced by their lemma """
-    doc = nlp(string)
+    doc = lemmatizer(string)
     return ' '.join([t.lemma_ for t in doc[:]])
 
 def remove_special_chars(string):
@@ -374,6 +995,14 @@ def pop_keys(dic, keys):
 # ?x wikibase:sitelinks ?sitelinks .
 # SERVICE wikibase:label { bd:serviceParam wikibase:language "en" . }
 
+def complete_items(items, langs, dbpedia):
+    """ complete_item for a list of items.  With BULK_COMPLETION, the
+    Wikidata information for all of them is first fetched together,
+    ENTITY_BATCH_SIZE items per request. """
+    if BULK_COMPLETION:
+        get_entities([item['id'] for item in items], langs)
+    return [complete_item(item, langs, dbpedia) for item in items]
+
 def complete_item(item, langs, dbpedia):
     """ item is a dict with an id property that's a wikidata id. Add
     more useful information in a set of languages and, id dbpedia is
@@ -381,31 +1010,36 @@ def complete_item(item, langs, dbpedia):
 
     if SCALE:
         # scale 2021 uses a slightly different result
-        return complete_item_scale(item)
+        return complete_item_scale(item, langs)
     
     id = item['id']
     item['wd_uri'] = f"https://www.wikidata.org/wiki/{id}"
-    item['immediate_types'] = get_immediate_types_labels(id)
-    item['immediate_supertypes'] = get_immediate_supertype_labels(id)
-    item['sitelinks'] = get_sitelinks(id)    
-    item['wikipedia'] = wp_name = get_en_wikipedia_name(id)
+    if BULK_COMPLETION:
+        entity = get_entity(id, tuple(langs))
+        item['immediate_types'] = entity['immediate_types']
+        item['immediate_supertypes'] = entity['immediate_supertypes']
+        item['sitelinks'] = entity['sitelinks']
+        item['wikipedia'] = wp_name = entity['wikipedia']
+    else:
+        item['immediate_types'] = get_immediate_types_labels(id)
+        item['immediate_supertypes'] = get_immediate_supertype_labels(id)
+        item['sitelinks'] = get_sitelinks(id)    
+        item['wikipedia'] = wp_name = get_en_wikipedia_name(id)
     item['is_instance'] = bool(item['immediate_types'])
     item['is_concept'] = bool(item['immediate_supertypes'])
     for lang in langs:
         item[lang] = d = {}
-        ladw = get_ladw(id, lang)
+        ladw = entity['ladw'][lang] if BULK_COMPLETION else get_ladw(id, lang)
         d['label'], d['aliases'], d['description'], d['wikiname'] = ladw
     if dbpedia:
         item['DBpedia_types'] = get_dbpedia_types(id, wp_name)
         for lang, text in get_dbpedia_abstracts(id, langs, wp_name):
             item[lang]['abstract'] = text
-    #item['metadata']['wd_queries'] = wd_queries
-    #item['metadata']['dbp_queries'] = dbp_queries
-    #item['metadata']['candidates_checked'] = dbp_queries    
+    #item['metadata'] = get_stats()
     return item
 
 # version for HLTCOE scale 2021
-def complete_item_scale(item):
+def complete_item_scale(item, langs=LANGS):
     """ item is a dict with an id property that's a wikidata id. Add
     more useful information in a set of languages and, id dbpedia is
     true, from DBpedia. Returns the dict. """
@@ -416,7 +1050,13 @@ def complete_item_scale(item):
     descriptions = {}
     aliases = {}
 
-    for (lang, lab, al, desc) in get_scale_llads(id):
+    if BULK_COMPLETION:
+        entity = get_entity(id, tuple(langs))
+        llads = [(lang,) + entity['ladw'][lang][:3] for lang in langs]
+    else:
+        llads = get_scale_llads(id)
+
+    for (lang, lab, al, desc) in llads:
         labels[lang] = lab
         aliases[lang] = al
         descriptions[lang] = desc
@@ -428,150 +1068,350 @@ def complete_item_scale(item):
     item['aliases'] = aliases
     item['descriptions'] = descriptions
 
-    item['sitelinks'] = get_sitelinks(id)
+    item['sitelinks'] = entity['sitelinks'] if BULK_COMPLETION else get_sitelinks(id)
 
     return item
 
-@lru_cache(maxsize=CACHE_SIZE)
+## bulk completion: get the information complete_item needs for many items at once
+
+@wdc.cached(CACHE_SIZE, cache_store)
+def get_entity(qid, langs):
+    """ Given a wikidata id and a tuple of languages, returns a dict with
+    the item's immediate types and supertypes, number of sitelinks, en
+    wikipedia name and, for each language, a tuple of its label,
+    aliases, description and wikiname like get_ladw returns """
+    return fetch_entities([qid], langs)[qid]
+
+def get_entities(qids, langs):
+    """ returns a dict mapping each qid to its get_entity dict, fetching
+    the ones that are not already cached ENTITY_BATCH_SIZE at a time """
+    langs = tuple(langs)
+    qid2entity = {}
+    todo = []
+    for qid in dict.fromkeys(qids):
+        found, entity = get_entity.cache_get(qid, langs)
+        if found:
+            qid2entity[qid] = entity
+        else:
+            todo.append(qid)
+    for i in range(0, len(todo), ENTITY_BATCH_SIZE):
+        count('entity_queries')
+        count('entities_fetched', len(todo[i:i+ENTITY_BATCH_SIZE]))
+        for qid, entity in fetch_entities(todo[i:i+ENTITY_BATCH_SIZE], langs).items():
+            get_entity.cache_put((qid, langs), entity)
+            qid2entity[qid] = entity
+    return qid2entity
+
+def refresh_entities(arg_tuples):
+    """ get_entity's batch_refresh, fetching ENTITY_BATCH_SIZE at a time """
+    results = {}
+    for langs in {args[1] for args in arg_tuples}:
+        qids = [args[0] for args in arg_tuples if args[1] == langs]
+        for i in range(0, len(qids), ENTITY_BATCH_SIZE):
+            for qid, entity in fetch_entities(qids[i:i+ENTITY_BATCH_SIZE], langs).items():
+                results[(qid, langs)] = entity
+    return [results[args] for args in arg_tuples]
+
+get_entity.batch_refresh = refresh_entities
+
+# SPARQL query for the immediate types and supertypes of a set of items
+q_immediate_types_query = """
+select ?item ?p ?class {{
+  VALUES ?item {{ {QIDS} }}
+  VALUES ?p {{ wdt:P31 wdt:P279 }}
+  ?item ?p ?class }}"""
+
+def fetch_entities(qids, langs):
+    """ gets the labels, aliases, descriptions and sitelinks of up to 50
+    qids with one wbgetentities API call and their immediate types and
+    supertypes with one SPARQL query """
+    params = {'action':'wbgetentities', 'ids':'|'.join(qids), 'props':'labels|aliases|descriptions|sitelinks',
+              'languages':'|'.join(langs), 'format':'json'}
+    result = api_get(params)
+    entities = result.get('entities', {})
+    qid2entity = {}
+    for qid in qids:
+        data = entities.get(qid, {})
+        sitelinks = data.get('sitelinks', {})
+        entity = {'sitelinks': len(sitelinks), 'immediate_types': set(), 'immediate_supertypes': set(), 'ladw': {}}
+        enwiki = sitelinks.get('enwiki', {}).get('title', '')
+        entity['wikipedia'] = enwiki.replace(' ', '_')
+        for lang in langs:
+            label = data.get('labels', {}).get(lang, {}).get('value', '')
+            aliases = [a['value'] for a in data.get('aliases', {}).get(lang, [])]
+            desc = data.get('descriptions', {}).get(lang, {}).get('value', '')
+            wname = sitelinks.get(lang + 'wiki', {}).get('title', '')
+            wname = '' if ':' in wname else wname
+            entity['ladw'][lang] = (label, aliases, desc, wname)
+        qid2entity[qid] = entity
+    results = query_wd(q_immediate_types_query.format(QIDS=' '.join('wd:' + qid for qid in qids)))
+    for x in results['results']['bindings']:
+        entity = qid2entity[x['item']['value'].rsplit('/',1)[1]]
+        field = 'immediate_types' if x['p']['value'].endswith('P31') else 'immediate_supertypes'
+        entity[field].add(x['class']['value'].rsplit('/',1)[1])
+    labels = get_type_labels([qid2int(c) for entity in qid2entity.values()
+                              for c in entity['immediate_types'] | entity['immediate_supertypes'] if is_entity_id(c)])
+    for entity in qid2entity.values():
+        entity['immediate_types'] = class_labels(entity['immediate_types'], labels)
+        entity['immediate_supertypes'] = class_labels(entity['immediate_supertypes'], labels)
+    return qid2entity
+
+def class_labels(classes, labels):
+    """ a list of "id:label" strings for the classes in a set that have a label """
+    return [c + ':' + labels[qid2int(c)] for c in classes if is_entity_id(c) and labels[qid2int(c)]]
+
+@wdc.cached(CACHE_SIZE, cache_store)
 def wikidata_search(string, limit=20):
     # search wikidata for items containing string in their name, alias or description
     # I think the service is limited to 50 results
     limit = min(limit, 50)    
-    api_url = "https://www.wikidata.org/w/api.php"
     params = {'action':'query', 'list':'search', 'srsearch':string, 'srlimit':limit, 'format':'json'}
-    result = requests.Session().get(url=api_url, params=params).json()
+    result = api_get(params)
     return [item for item in result['query']['search']]
 
-# Three SPARQL queries to get a wikidata item's type IDs and en labels
-# of type covering (1) get both entity and class views, (2) get only
-# entity view, (3) get only class view
-
-q_types_labels_query_all = """
-select distinct ?type ?typeLabel {{
-   wd:{QID} wdt:P31/wdt:P279*|wdt:P279+ ?type .
-   ?type rdfs:label ?typeLabel .
-   FILTER (lang(?typeLabel) = "en") }}"""
-
-q_types_labels_query_instance = """
-select distinct ?type ?typeLabel {{ 
-   wd:{QID} wdt:P31/wdt:P279* ?type .
-   ?type rdfs:label ?typeLabel .
-   FILTER (lang(?typeLabel) = "en") }}"""
-
-q_types_labels_query_strictinstance = """
-select distinct ?type ?typeLabel {{ 
-   wd:{QID} wdt:P31/wdt:P279* ?type .
-   FILTER NOT EXISTS {{wd:{QID} wdt:P279 []}}
-   ?type rdfs:label ?typeLabel .
-   FILTER (lang(?typeLabel) = "en") }}"""
-
-q_types_labels_query_concept = """
-select distinct ?type ?typeLabel {{ 
-   wd:{QID} wdt:P279* ?type .
-   ?type rdfs:label ?typeLabel .
-   FILTER (lang(?typeLabel) = "en") }} """
-
-q_types_labels_query_strictconcept = """
-select distinct ?type ?typeLabel {{ 
-   wd:{QID} wdt:P279* ?type .
-   FILTER NOT EXISTS {{wd:{QID} wdt:P31 []}}
-   ?type rdfs:label ?typeLabel .
-   FILTER (lang(?typeLabel) = "en") }}"""
-
-def get_types(qid, target_types, near_miss_types, good_types, ok_types, bad_types, category):
+# SPARQL query to get the type closure of a set of wikidata items bound
+# to ?item: the types reached via wdt:P31/wdt:P279* (the entity view),
+# the ones reached via wdt:P279+ (the class view) and whether the item
+# has any P31 or P279 values.  {QIDS} is a space-separated list like
+# "wd:Q42 wd:Q5", so one query can cover many candidates.
+
+q_type_closure_query = """
+select distinct ?item ?type ?view ?p31 ?p279 {{
+   VALUES ?item {{ {QIDS} }}
+   BIND (EXISTS {{?item wdt:P31 []}} AS ?p31)
+   BIND (EXISTS {{?item wdt:P279 []}} AS ?p279)
+   {{ BIND ("self" AS ?view) }}
+   UNION
+   {{ ?item wdt:P31/wdt:P279* ?type . BIND ("instance" AS ?view) }}
+   UNION
+   {{ ?item wdt:P279+ ?type . BIND ("concept" AS ?view) }} }}"""
+
+CATEGORIES = ['all', 'strictinstance', 'instance', 'strictconcept', 'concept', 'property']
+
+def get_types(qid, target_types, near_miss_types, good_types, ok_types, bad_types, category, local=False):
     """
     Given a wikidata id (e.g., Q7803487) returns a tuple with its types in target_types, ok_types.
     returns immediaely with ([],[]) if a type in bad_types. We assume that target_types, preferred_types, acceptable_types,
     and bad_types are disjoint.  Each type is represented as a tuple (id, name), e.g., ('Q5', 'human').  If target_types and
     preferred_types are both an empty list or set, all types not in bad_types are considered preferred.
     category should be on of all, instance, strictinstance or, cconcept
+    If local is true, the types come from the local type index when it has qid.
     """
     ##print('called:', qid, target_types, near_miss_types, ok_types, bad_types, category)
-    ttypes =  [ ]
-    nmtypes = [ ]
-    gtypes = [ ]
-    oktypes = [ ]
-
-    types = query_for_types(qid, category)
-    inferred = infer_types(qid, category, types)
-    types = types.union(inferred)
-
-    if not types:
-        return ([], [], [], [])
-
-    for id_label in types:
-        id = id_label[0]
-        #print(f"get_type checking {id}")
-        if id in bad_types:
-            #print(f"{qid} bailing on bad type:{id_label}")
-            return ([], [], [], [])
-        elif id in target_types:
-            #print(f"{id} in target types")
-            ttypes.append(id_label)
-        elif id in near_miss_types:
-            #print(f"{id} in near miss types")
-            nmtypes.append(id_label)
-        elif id in good_types:
-            #print(f"{id} in near miss types")
-            gtypes.append(id_label)            
-        elif id in ok_types:
-            oktypes.append(id_label)
-    found = (ttypes, nmtypes, gtypes, oktypes)
-    return found
-
-@lru_cache(maxsize= CACHE_SIZE * 2)
-def query_for_types(qid, category):
-    """ returns a list of (id, label) tuples for qid's types """
+    profile = TypeProfile(target_types, near_miss_types, good_types, ok_types, bad_types)
+    types = query_for_types(qid, category, local) | infer_types(qid, category)
+    return found_type_tuples([qid], [profile.classify(types)])[0]
+
+# types are kept as integer ids (see wd_ids.py) and their english labels
+# in one dict shared by all items, starting with the labels given to
+# inferred types and, if SEED_TYPE_LABELS, the first names of the types
+# in entity_types.py; they become (id, label) tuples again only for the
+# types get_types returns.  Type queries only return ids and the labels
+# are loaded when needed by get_type_labels.
+type_labels = {qid2int(inferred['type']): inferred['label'] for inferred in INFERRED_TYPES.values()}
+if SEED_TYPE_LABELS:
+    for id, names in wdtype2names.items():
+        if names and is_entity_id(id):
+            type_labels.setdefault(qid2int(id), names[0])
+
+def get_type_labels(ids):
+    """ returns a dict mapping integer ids to their english labels,
+    getting the ones not in type_labels from get_label's cache or, in
+    batches of ENTITY_BATCH_SIZE, from the wikidata api """
+    todo = []
+    for id in dict.fromkeys(ids):
+        if id not in type_labels:
+            found, label = get_label.cache_get(int2qid(id), 'en')
+            if found:
+                type_labels[id] = label
+            else:
+                todo.append(id)
+    for i in range(0, len(todo), ENTITY_BATCH_SIZE):
+        for qid, label in fetch_labels([int2qid(id) for id in todo[i:i+ENTITY_BATCH_SIZE]]).items():
+            get_label.cache_put((qid, 'en'), label)
+            type_labels[qid2int(qid)] = label
+    return {id: type_labels.get(id, '') for id in ids}
+
+def fetch_item_texts(qids):
+    """ gets the entity_text of up to 50 qids from their english labels
+    and descriptions with one wbgetentities API call """
+    params = {'action':'wbgetentities', 'ids':'|'.join(qids), 'props':'labels|descriptions', 'languages':'en', 'format':'json'}
+    entities = api_get(params).get('entities', {})
+    texts = {}
+    for qid in qids:
+        data = entities.get(qid, {})
+        label = data.get('labels', {}).get('en', {}).get('value', '')
+        desc = data.get('descriptions', {}).get('en', {}).get('value', '')
+        texts[qid] = hit_text({'label': label, 'description': desc})
+    return texts
+
+def fetch_labels(qids, lang='en'):
+    """ gets the labels of up to 50 qids with one wbgetentities API call, '' for ones without one """
+    params = {'action':'wbgetentities', 'ids':'|'.join(qids), 'props':'labels', 'languages':lang, 'format':'json'}
+    entities = api_get(params).get('entities', {})
+    return {qid: entities.get(qid, {}).get('labels', {}).get(lang, {}).get('value', '') for qid in qids}
+
+def type_tuple(id, qid):
+    """ the (id, label) tuple for an integer type id of qid, which is a type of itself """
+    if id == qid2int(qid):
+        return (qid, 'SELF')
+    return (int2qid(id), type_labels.get(id) or int2qid(id))
+
+def query_for_types(qid, category, local=False):
+    """ returns a set of the integer ids of qid's types, including qid """
+    if category not in CATEGORIES:
+        print('ERROR: bad category value in get_types', category)
+        return set()
+    record = get_local_type_record(qid) if local else None
+    return category_types(qid, record or get_type_record(qid), category)
+
+def query_for_types_batch(qids, category, local=False):
+    """ returns a dict mapping each qid to the set of integer ids of
+    its types, getting the type records of all of them with as few
+    queries as possible """
+    if category not in CATEGORIES:
+        print('ERROR: bad category value in get_types', category)
+        return {}
+    return {qid: category_types(qid, record, category) for qid, record in get_type_records(qids, local).items()}
+
+def category_types(qid, record, category):
+    """ the integer ids of qid's types in a category, computed from its type record """
     if category == 'all':
-        query = q_types_labels_query_all.format(QID=qid)
-    elif category == 'strictinstance':
-        query = q_types_labels_query_strictinstance.format(QID=qid)        
+        types = set(record['instance']).union(record['concept'])
     elif category == 'instance':
-        query = q_types_labels_query_instance.format(QID=qid)
+        types = set(record['instance'])
+    elif category == 'strictinstance':
+        types = set() if record['P279'] else set(record['instance'])
     elif category == 'strictconcept':
-        query = q_types_labels_query_strictconcept.format(QID=qid)
-    elif category in ['concept', 'property']:
-        query = q_types_labels_query_concept.format(QID=qid)
-    else:
-        print('ERROR: bad category value in get_types', category)
-        return [ ]
-    type_ids = set()
+        types = set() if record['P31'] else set(record['concept'])
+    else:   # concept or property
+        types = set(record['concept'])
+    types.add(qid2int(qid))
+    return types
+
+# named so persistent caches made when records held (id, label) tuples aren't used
+@wdc.cached(CACHE_SIZE * 2, cache_store, name='get_type_record_ints')
+def get_type_record(qid):
+    """ returns a dict with qid's instance types (via P31/P279*) and
+    concept types (via P279+) as sorted tuples of integer ids, which
+    take up less of the cache than sets, and whether it
+    has P31 and P279 values.  Every category's types and whether qid
+    is an instance or a type can be computed from it. """
+    return fetch_type_records([qid])[qid]
+
+def get_type_records(qids, local=False):
+    """ returns a dict mapping each qid to its type record, querying
+    only for the ones that are not already cached, TYPE_BATCH_SIZE
+    qids per query.  The results are added to get_type_record's cache.
+    If local is true, records come from the local type index when it
+    has them. """
+    qid2record = {}
+    todo = []
+    for qid in dict.fromkeys(qids):   # dedupe but keep the order
+        record = get_local_type_record(qid) if local else None
+        found = record is not None
+        if not found:
+            found, record = get_type_record.cache_get(qid)
+        if found:
+            qid2record[qid] = record
+        else:
+            todo.append(qid)
+    for i in range(0, len(todo), TYPE_BATCH_SIZE):
+        count('type_record_queries')
+        count('type_records_fetched', len(todo[i:i+TYPE_BATCH_SIZE]))
+        for qid, record in fetch_type_records(todo[i:i+TYPE_BATCH_SIZE]).items():
+            get_type_record.cache_put((qid,), record)
+            qid2record[qid] = record
+    return qid2record
+
+def refresh_type_records(arg_tuples):
+    """ get_type_record's batch_refresh, querying for TYPE_BATCH_SIZE at a time """
+    qids = [args[0] for args in arg_tuples]
+    qid2record = {}
+    for i in range(0, len(qids), TYPE_BATCH_SIZE):
+        qid2record.update(fetch_type_records(qids[i:i+TYPE_BATCH_SIZE]))
+    return [qid2record[qid] for qid in qids]
+
+get_type_record.batch_refresh = refresh_type_records
+
+# a local type index built from a wikidata dump by type_index.py, opened when first used
+local_type_index = None
+
+def get_type_index():
+    global local_type_index
+    if local_type_index is None:
+        import type_index
+        local_type_index = type_index.TypeIndex(TYPE_INDEX)
+        for id, label in local_type_index.labels.items():
+            type_labels.setdefault(id, label)
+    return local_type_index
+
+def get_local_type_record(qid):
+    """ returns qid's type record from the local type index, which
+    only has the types it was built for, or None if qid is newer than
+    the dump it was built from """
+    record = get_type_index().record(qid)
+    if record is not None:
+        count('index_type_lookups')
+    return record
+
+def fetch_type_records(qids):
+    """ query for the type records of a list of qids, returning a dict mapping each to its record """
+    query = q_type_closure_query.format(QIDS=' '.join('wd:' + qid for qid in qids))
+    qid2record = {qid: {'instance': set(), 'concept': set(), 'P31': False, 'P279': False} for qid in qids}
     results = query_wd(query)
     for result in results["results"]["bindings"]:
-        id_label = (result['type']['value'].rsplit('/',1)[-1], result['typeLabel']['value'])
-        type_ids.add(id_label)
-    type_ids.add((qid, 'SELF'))
-    return type_ids
-
-def infer_types(qid, category, types):
-    """ returnsd a list of additional types inferred via various means """
+        record = qid2record[result['item']['value'].rsplit('/',1)[-1]]
+        view = result['view']['value']
+        if view == 'self':
+            record['P31'] = result['p31']['value'] == 'true'
+            record['P279'] = result['p279']['value'] == 'true'
+        else:
+            record[view].add(qid2int(result['type']['value'].rsplit('/',1)[-1]))
+    for record in qid2record.values():
+        record['instance'] = tuple(sorted(record['instance']))
+        record['concept'] = tuple(sorted(record['concept']))
+    return qid2record
+
+def infer_types(qid, category):
+    """ returns a set of the integer ids of the types inferred from
+    qid having a property in INFERRED_TYPES """
     inferred_types = set()
-    if qid in mesh_items:
-        # an item that is has a P486 property linking it to a UMLS Medical Subject Heading controled term
-        types.add(('Q199897', 'MESH'))
+    for prop, inferred in INFERRED_TYPES.items():
+        if inferred_types_index.has(prop, qid):
+            inferred_types.add(qid2int(inferred['type']))
     # Add more hacks here
     return inferred_types
 
 ## send query to enpoints
 
 def query_wd(query, endpoint=default_wd_endpoint):
-    global wd_queries
-    wd_queries += 1
+    count('wd_queries')
     return query_endpoint(query, endpoint)
 
 def query_dbpedia(query, endpoint=default_dbpedia_endpoint):
-    global dbp_queries
-    dbp_queries += 1
-    return query_endpoint(query, endpoint)
+    count('dbp_queries')
+    return query_endpoint(query, endpoint, dbpedia_throttle)
     
-def query_endpoint(query, endpoint):
-    """ send query to endpoint and return response as JSON """
-    sparql = SPARQLWrapper(endpoint, agent=USER_AGENT)
-    sparql.setReturnFormat(JSON)
-    sparql.setQuery(query)
-    return sparql.query().convert()
-
-@lru_cache(maxsize=CACHE_SIZE)
+def query_endpoint(query, endpoint, throttle=throttle):
+    """ send query to endpoint, paced by its host's throttle, and return response as JSON """
+    headers = {'Accept': 'application/sparql-results+json'}
+    timeout = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+    if len(query) <= MAX_GET_QUERY_LENGTH:
+        response = throttle.request(lambda: http.get(endpoint, params={'query': query}, headers=headers, timeout=timeout))
+    else:
+        response = throttle.request(lambda: http.post(endpoint, data={'query': query}, headers=headers, timeout=timeout))
+    response.raise_for_status()
+    return response.json()
+
+def api_get(params, url=default_wd_api):
+    """ send a request to the wikidata api and return response as JSON """
+    count('api_queries')
+    response = throttle.request(lambda: http.get(url, params=params, timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)))
+    response.raise_for_status()
+    return response.json()
+
+@wdc.cached(CACHE_SIZE, cache_store)
 def get_label(id, lang="en"):
     """ given a wikidata id (e.g., Q42) return it's label in a given language """
     query = "select ?L {{wd:{ID} rdfs:label ?L. FILTER (langMatches(lang(?L),'{LANG}'))}} LIMIT 1"
@@ -582,6 +1422,18 @@ def get_label(id, lang="en"):
         return rs[0]['L']['value'] if rs else ''
     return ''
 
+def refresh_labels(arg_tuples):
+    """ get_label's batch_refresh, fetching ENTITY_BATCH_SIZE at a time """
+    results = {}
+    for lang in {args[1] for args in arg_tuples}:
+        qids = [args[0] for args in arg_tuples if args[1] == lang]
+        for i in range(0, len(qids), ENTITY_BATCH_SIZE):
+            for qid, label in fetch_labels(qids[i:i+ENTITY_BATCH_SIZE], lang).items():
+                results[(qid, lang)] = label
+    return [results[args] for args in arg_tuples]
+
+get_label.batch_refresh = refresh_labels
+
 # SPARQL query to get entity's label, description, aliases and wikiname for a language
 q_ladw_query = """
 SELECT DISTINCT ?label ?desc (group_concat(distinct ?alias; separator='|') as ?aliases) ?wname
@@ -597,7 +1449,7 @@ GROUP BY  ?label ?desc ?wname """
 
     
 
-@lru_cache(maxsize=CACHE_SIZE)
+@wdc.cached(CACHE_SIZE, cache_store)
 def get_ladw(id, lang):
     """ Given a Wikidata id, returns a tuple of the item's label, aliases, description, and wikiname for a language"""
     results = query_wd(q_ladw_query.format(QID=id, LANG=lang))
@@ -635,7 +1487,7 @@ q_scale_lad_query = """select ?lang ?label ?desc (group_concat(distinct ?alias;
 }}
 GROUP BY ?lang ?label ?desc """
 
-@lru_cache(maxsize=CACHE_SIZE)
+@wdc.cached(CACHE_SIZE, cache_store)
 def get_scale_llads(id):
     """ Given a Wikidata id (e.g Q42), returns a list of tuple of item's language, label, aliases, and description for en, ru, zh and fa"""
     results = query_wd(q_scale_lad_query.format(QID=id))
@@ -650,38 +1502,62 @@ def get_scale_llads(id):
             llads.append((lang, label, aliases, desc))
     return llads
         
-@lru_cache(maxsize=CACHE_SIZE)
+@wdc.cached(CACHE_SIZE, cache_store)
 def get_immediate_types_labels(id):
     """ Returns a set of the id's immediate types and immediate supertypes"""
 #    q = f'select ?class ?classLabel where {{wd:{id} wdt:P31 ?class. SERVICE wikibase:label {{ bd:serviceParam wikibase:language "en".}}}}'
-    q = f"select ?class ?label {{wd:{id} wdt:P31 ?class. ?class rdfs:label ?label. FILTER (lang(?label) = 'en') }}"
+    q = f"select ?class {{wd:{id} wdt:P31 ?class }}"
     result =  query_wd(q)
-    class_labels = set()
-    for x in result['results']['bindings']:
-        class_labels.add(x['class']['value'].rsplit('/',1)[1] + ':' +  x['label']['value'])
-    return list(class_labels)
+    classes = {x['class']['value'].rsplit('/',1)[1] for x in result['results']['bindings']}
+    return class_labels(classes, get_type_labels([qid2int(c) for c in classes if is_entity_id(c)]))
 
-@lru_cache(maxsize=CACHE_SIZE)
+@wdc.cached(CACHE_SIZE, cache_store)
 def get_immediate_supertype_labels(id):
     """ id should be a class. Returns a set of the id's immediate supertypes """
-    q = f"select ?class ?label {{wd:{id} wdt:P279 ?class. ?class rdfs:label ?label. FILTER (lang(?label) = 'en') }}"
+    q = f"select ?class {{wd:{id} wdt:P279 ?class }}"
     result =  query_wd(q)
-    class_labels = set()
-    for x in result['results']['bindings']:
-        class_labels.add((x['class']['value'].rsplit('/',1)[1] + ':' + x['label']['value']))
-    return list(class_labels)
+    classes = {x['class']['value'].rsplit('/',1)[1] for x in result['results']['bindings']}
+    return class_labels(classes, get_type_labels([qid2int(c) for c in classes if is_entity_id(c)]))
+
+# a local sitelink table built from a wikidata dump by sitelink_index.py, opened when first used
+local_sitelink_index = None
+
+def get_sitelink_index():
+    global local_sitelink_index
+    if local_sitelink_index is None:
+        import sitelink_index
+        local_sitelink_index = sitelink_index.SitelinkIndex(SITELINK_INDEX)
+    return local_sitelink_index
+
+def get_local_sitelinks(qid):
+    """ returns a tuple of qid's number of sitelinks and enwiki title from
+    the local sitelink index or None if there isn't one or it doesn't know qid """
+    if not (SITELINK_INDEX and is_entity_id(qid)):
+        return None
+    local = get_sitelink_index().lookup(qid)
+    if local is not None:
+        count('index_sitelink_lookups')
+    return local
 
-@lru_cache(maxsize=CACHE_SIZE)
 def get_sitelinks(qid):
+    local = get_local_sitelinks(qid)
+    return local[0] if local else query_sitelinks(qid)
+
+@wdc.cached(CACHE_SIZE, cache_store, name='get_sitelinks')
+def query_sitelinks(qid):
     results = query_wd(f"select ?n {{ wd:{qid} wikibase:sitelinks ?n}}")
     if results["results"]["bindings"]:
         return int(results["results"]["bindings"][0]['n']['value'])
     else:
         return 0
 
-@lru_cache(maxsize=CACHE_SIZE)
 def get_en_wikipedia_name(qid):
     """ Given a wikidata QID, get its en Wikipedia name if it has one, else '' """
+    local = get_local_sitelinks(qid)
+    return local[1].replace(' ', '_') if local else query_en_wikipedia_name(qid)
+
+@wdc.cached(CACHE_SIZE, cache_store, name='get_en_wikipedia_name')
+def query_en_wikipedia_name(qid):
     query = f'SELECT ?name {{?art schema:about wd:{qid}; schema:inLanguage "en"; schema:name ?name; schema:isPartOf <https://en.wikipedia.org/>.}} LIMIT 1'
     results = query_wd(query)
     if results["results"]["bindings"]:
@@ -702,7 +1578,7 @@ def get_dbpedia_abstracts(qid, langs=['en'], name=''):
 
 def quote_str(s): return "'"+s+"'"
 
-@lru_cache(maxsize=CACHE_SIZE)
+@wdc.cached(CACHE_SIZE, cache_store)
 def get_dbpedia_types(qid, name=''):
     """ returns a list of dbpedia types given qid, a wikidata id """
     if not name:
@@ -725,25 +1601,23 @@ def get_dbpedia_types(qid, name=''):
 def remove_prefix(text, prefix):
     return text[len(prefix):] if text.startswith(prefix) else text
     
-@lru_cache(maxsize=CACHE_SIZE)
 def get_isinstance_istype(id):
     """ Returns a tuple of two Booleans idicating if id is an instance and is a type """
-    q = f"""select distinct ?instance ?type where {{
-          BIND (exists {{wd:{id} wdt:P31 []}} AS ?instance) 
-          BIND (exists {{wd:{id} wdt:P279 []}} AS ?type) }}"""
-    results = query_wd(q)
-    bindings = results["results"]["bindings"][0]
-    return (bindings['instance']['value'], bindings['type']['value'])
-
-@lru_cache(maxsize=CACHE_SIZE)
+    record = get_type_record(id)
+    return (record['P31'], record['P279'])
+
 def isa_type(id):
     """ returns True iff id is a wikidata type, i.e., has an instance, a subtype or a supertype """
-    return query_wd(f"ASK {{?x wdt:P31|wdt:P279|^wdt:P279 wd:{id} }}")['boolean']
+    return get_type_record(id)['P279'] or has_instance_or_subtype(id)
+
+@wdc.cached(CACHE_SIZE, cache_store)
+def has_instance_or_subtype(id):
+    """ returns True iff some item is an instance or subtype of id """
+    return query_wd(f"ASK {{?x wdt:P31|wdt:P279 wd:{id} }}")['boolean']
 
-@lru_cache(maxsize=CACHE_SIZE)
 def isa_instance(id):
     """ returns True iff id isa wikidata instance """
-    return query_wd(f"ASK {{wd:{id} wdt:P31 ?x}}")['boolean']
+    return get_type_record(id)['P31']
 
 def wd_entity_id(url):
     """ returns entity id if url is an entity, else the url"""
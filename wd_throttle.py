@@ -0,0 +1,259 @@
+"""
+
+Pacing and retrying for the requests wd_search.py sends to the Wikidata
+API and query service, which answer with 429 (too many requests) or time
+out when clients push them too hard.
+
+A Throttle combines
+
+ * a token bucket that allows rate requests per second with bursts of up
+   to burst requests (no limit if rate is None),
+ * a limit on the number of requests in flight that is halved when the
+   recent error rate gets high and grows back by one while it stays low,
+ * retries with exponential backoff and jitter for 429s, 5xx responses,
+   timeouts and connection errors, honouring a Retry-After header by
+   pausing all requests until then, and
+ * throttle.ctrl, the pywikibot throttle file with one "pid time site"
+   line per running process, e.g. "1 1700000000.5 wikidata:wikidata".
+   Each process registers itself there and divides the rate by the
+   number of processes active for the site in the last PROCESS_EXPIRY
+   seconds, as pywikibot does.  The file is not created: if it's
+   missing, each process gets the whole rate.
+
+Counts of requests, retries, errors and time spent waiting are returned
+by metrics().
+
+"""
+
+import time
+import random
+import threading
+from collections import deque, defaultdict
+from email.utils import parsedate_to_datetime
+
+try:
+    import fcntl
+except ImportError:   # no file locking on windows
+    fcntl = None
+
+import requests
+
+# seconds after which a process in the throttle file is considered gone
+PROCESS_EXPIRY = 600
+
+# seconds between updates of our entry in the throttle file
+CTRL_REFRESH = 60
+
+# http status codes worth retrying
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+# number of recent requests used to compute the error rate, the fewest
+# needed before cutting concurrency, and the error rates above which
+# concurrency is cut and below which it grows
+ERROR_WINDOW = 50
+MIN_ERROR_SAMPLE = 10
+HIGH_ERROR_RATE = 0.1
+LOW_ERROR_RATE = 0.02
+
+
+class Throttle:
+
+    def __init__(self, rate=5.0, burst=10, max_concurrency=8, max_retries=5, backoff_base=1.0, backoff_max=60.0,
+                 ctrl_file=None, site='wikidata:wikidata'):
+        self.rate = self.process_rate = rate   # None means no limit
+        self.burst = burst
+        self.max_concurrency = self.concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.ctrl_file = ctrl_file
+        self.site = site
+        self.ctrl_pid = None
+        self.ctrl_checked = 0
+
+        self.lock = threading.Condition()
+        self.tokens = float(burst)
+        self.last_refill = time.monotonic()
+        self.paused_until = 0.0
+        self.in_flight = 0
+        self.outcomes = deque(maxlen=ERROR_WINDOW)   # True for each recent error
+        self.counts = defaultdict(int)
+        self.wait_time = 0.0
+        self.check_ctrl_file()
+
+    ## throttle.ctrl
+
+    def check_ctrl_file(self):
+        """ register this process in the throttle file and set the rate
+        to our share of it given the other active processes for the site """
+        if not self.ctrl_file:
+            return
+        now = time.time()
+        self.ctrl_checked = now
+        try:
+            with open(self.ctrl_file, 'r+') as f:
+                if fcntl:
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                f.seek(0)
+                entries = []
+                for line in f:
+                    try:
+                        pid, stamp, site = line.split(' ')
+                        entries.append((int(pid), float(stamp), site.strip()))
+                    except ValueError:
+                        continue
+                entries = [e for e in entries if e[0] != self.ctrl_pid and now - e[1] < PROCESS_EXPIRY]
+                if self.ctrl_pid is None:
+                    used = {e[0] for e in entries}
+                    self.ctrl_pid = min(pid for pid in range(1, len(used) + 2) if pid not in used)
+                entries.append((self.ctrl_pid, now, self.site))
+                f.seek(0)
+                f.truncate()
+                for pid, stamp, site in sorted(entries):
+                    f.write(f"{pid} {stamp} {site}\n")
+        except FileNotFoundError:   # no shared throttle
+            self.ctrl_file = None
+            return
+        except OSError as e:
+            print(f"WARNING: could not use throttle file {self.ctrl_file}: {e}")
+            self.ctrl_file = None
+            return
+        processes = sum(1 for e in entries if e[2] == self.site)
+        if self.rate:
+            with self.lock:
+                self.process_rate = self.rate / max(processes, 1)
+
+    def release_ctrl_file(self):
+        """ remove this process from the throttle file """
+        if not (self.ctrl_file and self.ctrl_pid):
+            return
+        try:
+            with open(self.ctrl_file, 'r+') as f:
+                if fcntl:
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                lines = [line for line in f if not line.startswith(f"{self.ctrl_pid} ")]
+                f.seek(0)
+                f.truncate()
+                f.writelines(lines)
+        except OSError:
+            pass
+
+    ## pacing
+
+    def acquire(self):
+        """ wait until a request can be sent """
+        if self.ctrl_file and time.time() - self.ctrl_checked > CTRL_REFRESH:
+            self.check_ctrl_file()
+        start = time.monotonic()
+        with self.lock:
+            while True:
+                now = time.monotonic()
+                if self.process_rate:
+                    self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.process_rate)
+                self.last_refill = now
+                if now < self.paused_until:
+                    delay = self.paused_until - now
+                elif self.in_flight >= self.concurrency:
+                    delay = None   # woken by release
+                elif self.process_rate and self.tokens < 1:
+                    delay = (1 - self.tokens) / self.process_rate
+                else:
+                    if self.process_rate:
+                        self.tokens -= 1
+                    self.in_flight += 1
+                    break
+                self.lock.wait(delay)
+            waited = time.monotonic() - start
+            self.wait_time += waited
+            self.counts['requests'] += 1
+
+    def release(self, error):
+        """ record the outcome of a request and adapt the concurrency to the error rate """
+        with self.lock:
+            self.in_flight -= 1
+            self.outcomes.append(error)
+            errors = sum(self.outcomes)
+            if error and len(self.outcomes) >= MIN_ERROR_SAMPLE and errors / len(self.outcomes) > HIGH_ERROR_RATE:
+                self.concurrency = max(1, self.concurrency // 2)
+                self.outcomes.clear()
+            elif (not error and len(self.outcomes) == ERROR_WINDOW and errors / ERROR_WINDOW < LOW_ERROR_RATE
+                  and self.concurrency < self.max_concurrency):
+                self.concurrency += 1
+                self.outcomes.clear()
+            self.lock.notify_all()
+
+    def pause(self, seconds):
+        """ stop sending any requests for seconds """
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def backoff(self, attempt):
+        """ seconds to wait before retry number attempt: exponential with full jitter """
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    ## sending
+
+    def request(self, send):
+        """ calls send(), a function that sends an http request and
+        returns a requests response, retrying it if needed.  Returns the
+        last response or raises the last exception. """
+        attempt = 0
+        while True:
+            self.acquire()
+            response = None
+            try:
+                response = send()
+                error = response.status_code in RETRY_STATUS
+            except (requests.ConnectionError, requests.Timeout):
+                error = True
+                if attempt >= self.max_retries:
+                    self.count('failures')
+                    raise
+            finally:
+                self.release(response is None or response.status_code in RETRY_STATUS)
+            if not error:
+                return response
+            if attempt >= self.max_retries:
+                self.count('failures')
+                return response
+            attempt += 1
+            self.count('retries')
+            if response is None:
+                self.count('connection_errors')
+                delay = self.backoff(attempt)
+            else:
+                self.count(f'status_{response.status_code}')
+                delay = retry_after(response)
+                if delay is None:
+                    delay = self.backoff(attempt)
+                if response.status_code == 429:
+                    # the service wants everyone to slow down, not just this thread
+                    self.pause(delay)
+            time.sleep(delay)
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def metrics(self):
+        """ returns a dict of counts and current settings """
+        with self.lock:
+            m = dict(self.counts)
+            m.update({'wait_time': round(self.wait_time, 3), 'concurrency': self.concurrency,
+                      'in_flight': self.in_flight, 'rate': self.process_rate})
+            return m
+
+
+def retry_after(response):
+    """ returns the seconds to wait from a response's Retry-After header or None """
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None